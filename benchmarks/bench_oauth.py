@@ -0,0 +1,139 @@
+"""
+Benchmarks for the library's hot paths.  Everything runs offline: the
+refresh path posts to a fake Canvas on localhost.
+"""
+import os
+import subprocess
+import sys
+from datetime import timedelta
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet
+from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from benchmarks.harness import benchmark
+from canvas_oauth import settings, token_cache
+from canvas_oauth.canvas import get_oauth_login_url
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token, handle_missing_token
+from canvas_oauth.tests.fake_canvas import FakeCanvas
+
+KEY = Fernet.generate_key()
+
+
+class Environment(object):
+    """Fixtures shared by the benchmarks: a user with a token and a fake
+    Canvas."""
+
+    def __init__(self):
+        self.request_factory = RequestFactory()
+        self.fake_canvas = FakeCanvas(strict=False).start()
+        self.user = User.objects.create_user(username='benchmark')
+        self.oauth_token = CanvasOAuth2Token.objects.create(
+            user=self.user,
+            domain=self.fake_canvas.domain,
+            access_token='access-token',
+            refresh_token='refresh-token',
+            expires=timezone.now() + timedelta(days=365))
+
+    def close(self):
+        self.fake_canvas.stop()
+
+    def store(self, access_token, refresh_token):
+        CanvasOAuth2Token.objects.filter(pk=self.oauth_token.pk).update(
+            access_token=access_token, refresh_token=refresh_token)
+
+    def make_request(self, session=None):
+        request = self.request_factory.get('/index', {'page': 2})
+        # A fresh user instance, so the token is not cached on it
+        request.user = User(pk=self.user.pk, username=self.user.username)
+        request.session = {} if session is None else session
+        request.canvas_oauth_canvas_domain = self.fake_canvas.domain
+        return request
+
+
+@benchmark('get_oauth_token.plain')
+def get_oauth_token_plain(env):
+    env.store('access-token', 'refresh-token')
+    yield lambda: get_oauth_token(env.make_request())
+
+
+@benchmark('get_oauth_token.session_key')
+def get_oauth_token_session_key(env):
+    fernet = Fernet(KEY)
+    env.store(fernet.encrypt(b'access-token').decode(), fernet.encrypt(b'refresh-token').decode())
+    session = {'canvas_oauth_token_key': KEY}
+    yield lambda: get_oauth_token(env.make_request(session))
+
+
+@benchmark('get_oauth_token.keyring')
+def get_oauth_token_keyring(env):
+    fernet = Fernet(KEY)
+    env.store(fernet.encrypt(b'access-token').decode(), fernet.encrypt(b'refresh-token').decode())
+    with patch.object(settings, 'CANVAS_OAUTH_ENCRYPTION_KEYS', [KEY]):
+        yield lambda: get_oauth_token(env.make_request())
+
+
+@benchmark('get_oauth_token.token_cache')
+def get_oauth_token_token_cache(env):
+    env.store('access-token', 'refresh-token')
+    token_cache.clear()
+    with patch.object(settings, 'CANVAS_OAUTH_TOKEN_CACHE', True):
+        yield lambda: get_oauth_token(env.make_request())
+    token_cache.clear()
+
+
+@benchmark('get_oauth_token.memoized', iterations=20000)
+def get_oauth_token_memoized(env):
+    env.store('access-token', 'refresh-token')
+    request = env.make_request()
+    get_oauth_token(request)
+    yield lambda: get_oauth_token(request)
+
+
+@benchmark('get_oauth_token.refresh', iterations=300)
+def get_oauth_token_refresh(env):
+    env.store('access-token', 'refresh-token')
+    # Every token is within the buffer, so every call refreshes
+    with patch.object(settings, 'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER', timedelta(days=3650)), \
+            env.fake_canvas.patch_urls():
+        yield lambda: get_oauth_token(env.make_request())
+
+
+@benchmark('handle_missing_token')
+def handle_missing_token_benchmark(env):
+    yield lambda: handle_missing_token(env.make_request())
+
+
+@benchmark('get_oauth_login_url', iterations=5000)
+def get_oauth_login_url_benchmark(env):
+    scopes = ['url:GET|/api/v1/courses', 'url:GET|/api/v1/courses/:id']
+    yield lambda: get_oauth_login_url(
+        settings.CANVAS_OAUTH_CLIENT_ID, 'https://app.localhost/oauth/oauth-callback',
+        state='ABC-123-RANDOM-STRING', scopes=scopes)
+
+
+@benchmark('fernet.encrypt', iterations=5000)
+def fernet_encrypt(env):
+    fernet = Fernet(KEY)
+    yield lambda: fernet.encrypt(b'1~abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+
+@benchmark('fernet.decrypt', iterations=5000)
+def fernet_decrypt(env):
+    fernet = Fernet(KEY)
+    token = fernet.encrypt(b'1~abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+    yield lambda: fernet.decrypt(token)
+
+
+IMPORT_SCRIPT = "import django; django.setup(); import canvas_oauth.oauth, canvas_oauth.middleware"
+
+
+@benchmark('import.canvas_oauth', iterations=20, warmup=2)
+def import_canvas_oauth(env):
+    # Starts a fresh interpreter each time, as a worker or management command
+    # process would, so this also includes Python and Django start up
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    yield lambda: subprocess.check_call([sys.executable, '-c', IMPORT_SCRIPT], cwd=cwd)
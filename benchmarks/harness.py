@@ -0,0 +1,131 @@
+"""
+A small micro-benchmark harness.
+
+Each benchmark is a context manager that sets up its fixtures and yields the
+operation to measure.  The operation is timed call by call, then run again
+to count database queries and, with tracemalloc, the memory blocks it leaves
+allocated and the peak memory it allocates.
+"""
+import json
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+BENCHMARKS = []
+
+
+def benchmark(name, iterations=2000, warmup=50):
+    """Registers a benchmark.  Decorates a generator function that takes the
+    shared environment and yields the operation to measure."""
+    def decorator(func):
+        BENCHMARKS.append((name, contextmanager(func), iterations, warmup))
+        return func
+    return decorator
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    index = min(int(round(fraction * (len(samples) - 1))), len(samples) - 1)
+    return samples[index]
+
+
+def measure(operation, iterations, warmup):
+    for _ in range(warmup):
+        operation()
+
+    timings = []
+    perf_counter = time.perf_counter
+    for _ in range(iterations):
+        started = perf_counter()
+        operation()
+        timings.append(perf_counter() - started)
+
+    sample = max(iterations // 10, 1)
+    with CaptureQueriesContext(connection) as queries:
+        for _ in range(sample):
+            operation()
+
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        blocks_before = _count_blocks()
+        for _ in range(sample):
+            operation()
+        retained_blocks = _count_blocks() - blocks_before
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    total = sum(timings)
+    return {
+        'ops_per_sec': iterations / total if total else 0.0,
+        'p50_us': percentile(timings, 0.5) * 1e6,
+        'p99_us': percentile(timings, 0.99) * 1e6,
+        'mean_us': statistics.mean(timings) * 1e6,
+        'queries_per_op': len(queries) / sample,
+        'retained_blocks_per_op': retained_blocks / sample,
+        'peak_kib': (peak - baseline) / 1024,
+    }
+
+
+def _count_blocks():
+    snapshot = tracemalloc.take_snapshot()
+    return sum(stat.count for stat in snapshot.statistics('filename'))
+
+
+def run(env, selected=None, iterations=None):
+    results = {}
+    for name, setup, default_iterations, warmup in BENCHMARKS:
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        with setup(env) as operation:
+            results[name] = measure(operation, iterations or default_iterations, warmup)
+    return results
+
+
+def format_results(results, baseline=None):
+    lines = ["%-40s %12s %10s %10s %8s %10s %9s" % (
+        "benchmark", "ops/sec", "p50 us", "p99 us", "queries", "retained", "peak KiB")]
+    for name, result in results.items():
+        line = "%-40s %12.1f %10.1f %10.1f %8.2f %10.1f %9.1f" % (
+            name, result['ops_per_sec'], result['p50_us'], result['p99_us'],
+            result['queries_per_op'], result['retained_blocks_per_op'], result['peak_kib'])
+        if baseline and name in baseline:
+            line += "  %+6.1f%%" % change(baseline[name]['ops_per_sec'], result['ops_per_sec'])
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def find_regressions(results, baseline, threshold):
+    """Returns a message for each benchmark that is slower than the baseline
+    by more than `threshold` percent, or runs more queries."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        slowdown = -change(before['ops_per_sec'], result['ops_per_sec'])
+        if slowdown > threshold:
+            regressions.append("%s: %.1f%% fewer ops/sec" % (name, slowdown))
+        if result['queries_per_op'] > before['queries_per_op']:
+            regressions.append("%s: %.2f queries per op, up from %.2f" % (
+                name, result['queries_per_op'], before['queries_per_op']))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,114 @@
+"""
+Opt-in conditional-request cache for Canvas API reads made by CanvasClient.
+
+GET responses that carry an ETag or Last-Modified validator are stored in
+the Django cache named by CANVAS_OAUTH_API_CACHE_ALIAS.  The next GET of the
+same URL sends If-None-Match / If-Modified-Since, and a 304 from Canvas is
+answered with the stored body.  Entries are keyed by the user the token
+belongs to, so responses are never shared between users.  Bodies larger
+than CANVAS_OAUTH_API_CACHE_MAX_SIZE bytes are not stored; beyond that,
+eviction is left to the cache backend (e.g. MAX_ENTRIES).
+"""
+import hashlib
+
+from django.core.cache import caches
+
+from canvas_oauth import metrics, settings
+
+KEY_PATTERN = "canvas_oauth:api:%s:%s"
+
+# Headers that describe the connection or the user agent rather than the
+# resource, and so are not stored
+UNSTORED_HEADERS = ('connection', 'keep-alive', 'set-cookie', 'transfer-encoding', 'content-encoding',
+                    'content-length')
+
+
+def is_enabled():
+    return settings.CANVAS_OAUTH_API_CACHE_ALIAS is not None
+
+
+def get_cache():
+    return caches[settings.CANVAS_OAUTH_API_CACHE_ALIAS]
+
+
+def get_key(user_id, url, params=None, headers=None):
+    """Returns the cache key of a GET request by the given user.  The URL is
+    the one requests would send, and request headers such as Accept are part
+    of the key since they can change the response."""
+    import requests
+    prepared_url = requests.Request('GET', url, params=params).prepare().url
+    varies = sorted((key.lower(), value) for key, value in (headers or {}).items())
+    digest = hashlib.sha256(repr((prepared_url, varies)).encode()).hexdigest()
+    return KEY_PATTERN % (user_id, digest)
+
+
+def get(key):
+    return get_cache().get(key)
+
+
+def add_validators(entry, headers=None):
+    """Returns a copy of the request headers with the validators of the
+    cached entry added."""
+    headers = dict(headers or {})
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def handle_response(key, entry, r):
+    """Returns the response to hand back for a GET made with the validators
+    of `entry` (if any): the cached response for a 304, or else `r`, which
+    is stored if it can be revalidated later."""
+    if r.status_code == 304 and entry is not None:
+        metrics.increment('canvas_oauth_api_cache_total', result='hit')
+        return build_response(entry, r)
+    metrics.increment('canvas_oauth_api_cache_total', result='miss')
+    if r.status_code == 200 and _is_storable(r):
+        get_cache().set(key, build_entry(r), settings.CANVAS_OAUTH_API_CACHE_TIMEOUT)
+        metrics.increment('canvas_oauth_api_cache_total', result='store')
+    return r
+
+
+def _is_storable(r):
+    if not (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+        return False
+    if 'no-store' in r.headers.get('Cache-Control', ''):
+        return False
+    content_length = r.headers.get('Content-Length')
+    if content_length and int(content_length) > settings.CANVAS_OAUTH_API_CACHE_MAX_SIZE:
+        return False
+    return len(r.content) <= settings.CANVAS_OAUTH_API_CACHE_MAX_SIZE
+
+
+def build_entry(r):
+    return {
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'status': r.status_code,
+        'headers': {key: value for key, value in r.headers.items() if key.lower() not in UNSTORED_HEADERS},
+        'encoding': r.encoding,
+        'body': r.content,
+    }
+
+
+def build_response(entry, not_modified):
+    """Builds a response from a cached entry, with any headers Canvas sent
+    along with the 304 (e.g. a fresh Link or rate limit header)."""
+    import requests
+    from requests.structures import CaseInsensitiveDict
+
+    r = requests.Response()
+    r.status_code = entry['status']
+    r.reason = 'OK'
+    r.headers = CaseInsensitiveDict(entry['headers'])
+    r.headers.update({key: value for key, value in not_modified.headers.items()
+                      if key.lower() not in UNSTORED_HEADERS})
+    r.encoding = entry['encoding']
+    r._content = entry['body']
+    r.url = not_modified.url
+    r.request = not_modified.request
+    r.elapsed = not_modified.elapsed
+    r.from_cache = True
+    return r
@@ -6,3 +6,19 @@ from django.apps import AppConfig
 class CanvasOAuthConfig(AppConfig):
     name = 'canvas_oauth'
     verbose_name = 'Django Canvas OAuth'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+
+        from canvas_oauth import canvas, settings
+        from canvas_oauth.models import get_default_token
+        # Registers the signal handlers that invalidate cached tokens
+        from canvas_oauth import token_cache  # noqa: F401
+
+        user_model = get_user_model()
+        if not hasattr(user_model, 'canvas_oauth2_token'):
+            user_model.canvas_oauth2_token = property(get_default_token)
+
+        warm_pools = settings.CANVAS_OAUTH_HTTP_WARM_POOLS
+        if warm_pools:
+            canvas.warm_sessions(None if warm_pools is True else warm_pools)
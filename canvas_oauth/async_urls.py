@@ -0,0 +1,6 @@
+from django.urls import path
+from .oauth import aoauth_callback
+
+urlpatterns = [
+    path('oauth-callback', aoauth_callback, name='canvas-oauth-callback'),
+]
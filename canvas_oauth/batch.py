@@ -0,0 +1,216 @@
+"""
+Concurrent Canvas API requests under one user's token, for bulk reads such
+as syncing a term.
+
+    specs = ['courses/%s/enrollments' % course_id for course_id in course_ids]
+    for result in batch(request, specs, concurrency=16, timeout=30):
+        if result.error is None:
+            ...
+
+Each spec is a path, as accepted by `CanvasClient`, or a dict with a 'path'
+and optionally a 'method' (GET by default), a 'timeout', and the keyword
+arguments of `httpx.AsyncClient.request` (params, json, data, headers).
+
+Requests run on an event loop, at most `concurrency` at a time, over the
+pooled `httpx.AsyncClient` of the request's Canvas domain.  Results are
+yielded in completion order as `BatchResult`s; a failed or timed out request
+does not stop the batch but is reported in its result's `error`.  If the
+token expires or Canvas rejects it partway through, it is refreshed once
+for the whole batch and the affected requests are replayed.
+
+`abatch` is the async generator behind `batch`, for async code.
+"""
+import asyncio
+import logging
+from collections import namedtuple
+
+from canvas_oauth import canvas, crypto, metrics, oauth, settings, tracing
+from canvas_oauth.client import get_api_url, is_canvas_url, is_invalid_token_response
+
+logger = logging.getLogger(__name__)
+
+# `index` is the position of the spec in the batch.  `response` is the
+# `httpx.Response`, whatever its status, or None if `error` is set.
+BatchResult = namedtuple('BatchResult', ['index', 'spec', 'response', 'error'])
+
+_DONE = object()
+
+
+def parse_spec(spec):
+    """Returns the method, path, timeout and request keyword arguments of a
+    request spec."""
+    if isinstance(spec, str):
+        return 'GET', spec, None, {}
+    kwargs = dict(spec)
+    path = kwargs.pop('path')
+    method = kwargs.pop('method', 'GET').upper()
+    timeout = kwargs.pop('timeout', None)
+    return method, path, timeout, kwargs
+
+
+class BatchToken(object):
+    """The access token shared by the requests of a batch, refreshed at most
+    once while the batch runs."""
+
+    def __init__(self, request, access_token):
+        self.request = request
+        self.access_token = access_token
+        self.refreshed = False
+        self._lock = asyncio.Lock()
+
+    def is_expiring(self):
+        memo = getattr(self.request, '_canvas_oauth_token_memo', None)
+        return memo is not None and memo[0].expires_within(settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER)
+
+    async def get(self):
+        if not self.refreshed and self.is_expiring():
+            await self.refresh(self.access_token)
+        return self.access_token
+
+    async def refresh(self, rejected_access_token):
+        """Refreshes the token unless it was already replaced, and returns
+        whether there is a new token to retry with."""
+        async with self._lock:
+            if self.access_token != rejected_access_token:
+                return True
+            if self.refreshed:
+                return False
+            self.refreshed = True
+            request = self.request
+            metrics.increment('canvas_oauth_api_token_refreshes_total', domain=oauth.get_canvas_domain(request))
+            memo = getattr(request, '_canvas_oauth_token_memo', None)
+            oauth_token = await oauth.arefresh_oauth_token(request, memo[0] if memo is not None else None)
+            # request.user may be lazy, and loading it here would block
+            logger.info("Refreshed the token of user %s during a batch", oauth_token.user_id)
+            self.access_token = crypto.decrypt(oauth_token.access_token, crypto.get_cipher(request))
+            request._canvas_oauth_token_memo = (oauth_token, self.access_token)
+            return True
+
+
+async def send_request(domain, token, method, url, timeout, kwargs):
+    """Sends one request with the batch's token through the domain's pooled
+    async client, refreshing the token and replaying the request once if
+    Canvas rejects it.  `timeout` bounds the whole request, if set.  URLs
+    on other hosts are sent without the token."""
+    httpx = canvas._import_httpx()
+    client = canvas.get_async_client(domain)
+    on_canvas = is_canvas_url(domain, url)
+    access_token = await token.get() if on_canvas else None
+    attempts = 0
+    while True:
+        attempts += 1
+        headers = dict(kwargs.get('headers') or {})
+        if on_canvas:
+            headers['Authorization'] = 'Bearer %s' % access_token
+        traceparent = tracing.get_traceparent()
+        if traceparent:
+            headers['traceparent'] = traceparent
+        with metrics.timer('canvas_oauth_api_request_seconds', domain=domain, method=method) as labels:
+            try:
+                r = await asyncio.wait_for(client.request(method, url, **dict(kwargs, headers=headers)), timeout)
+            except asyncio.TimeoutError:
+                labels['status'] = 'timeout'
+                raise
+            except httpx.TransportError as e:
+                connected = not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                labels['status'] = 'timeout' if connected else 'connection'
+                raise
+            labels['status'] = r.status_code
+        if (attempts > 1 or not on_canvas or not is_invalid_token_response(r) or
+                not await token.refresh(access_token)):
+            return r
+        await r.aclose()
+        access_token = token.access_token
+
+
+async def _get_result(domain, token, index, spec, timeout):
+    method = path = None
+    try:
+        method, path, spec_timeout, kwargs = parse_spec(spec)
+        with tracing.span('canvas_oauth.api_request', {'http.method': method}):
+            r = await send_request(domain, token, method, get_api_url(domain, path),
+                                   timeout if spec_timeout is None else spec_timeout, kwargs)
+            tracing.set_attribute('http.status_code', r.status_code)
+    except Exception as e:
+        logger.warning("Batch request %s %s failed: %r", method, path, e)
+        return BatchResult(index, spec, None, e)
+    return BatchResult(index, spec, r, None)
+
+
+async def _run(request, specs, access_token, concurrency, timeout):
+    domain = oauth.get_canvas_domain(request)
+    token = BatchToken(request, access_token)
+    specs = enumerate(specs)
+    # Bounded, so that requests wait rather than pile up results while the
+    # consumer is busy
+    results = asyncio.Queue(maxsize=concurrency)
+
+    async def worker():
+        try:
+            for index, spec in specs:
+                await results.put(await _get_result(domain, token, index, spec, timeout))
+        except Exception as e:
+            # Iterating over the specs failed
+            await results.put(e)
+        else:
+            await results.put(_DONE)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    running = len(workers)
+    try:
+        while running:
+            result = await results.get()
+            if result is _DONE:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        # The consumer stopped early, or the batch failed or was cancelled
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def abatch(request, specs, concurrency=None, timeout=None):
+    """Runs the requests described by `specs` concurrently and yields a
+    `BatchResult` for each as it completes.  At most `concurrency` requests
+    (by default CANVAS_OAUTH_API_MAX_CONCURRENCY) are in flight at once, and
+    each may take up to `timeout` seconds, unless its spec sets its own.
+    """
+    concurrency = concurrency or settings.CANVAS_OAUTH_API_MAX_CONCURRENCY
+    access_token = await oauth.aget_oauth_token(request)
+    async for result in _run(request, specs, access_token, concurrency, timeout):
+        yield result
+
+
+def batch(request, specs, concurrency=None, timeout=None):
+    """Synchronous version of `abatch`, for views and workers.  The event loop
+    runs in the calling thread while the caller waits for the next result,
+    so it must not be called from async code.
+
+    Each call runs on a new event loop with its own `httpx.AsyncClient`,
+    closed when the batch ends, so connections are not reused across calls;
+    prefer one large batch to many small ones.  A token refreshed partway
+    through is saved by the async ORM from another thread, and so on
+    another database connection than the caller's.
+    """
+    concurrency = concurrency or settings.CANVAS_OAUTH_API_MAX_CONCURRENCY
+    access_token = oauth.get_oauth_token(request)
+    loop = asyncio.new_event_loop()
+    results = _run(request, specs, access_token, concurrency, timeout)
+    try:
+        while True:
+            try:
+                result = loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                return
+            yield result
+    finally:
+        try:
+            loop.run_until_complete(results.aclose())
+            loop.run_until_complete(canvas.aclose_async_clients())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
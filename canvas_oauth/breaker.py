@@ -0,0 +1,97 @@
+"""
+Per-domain circuit breakers for the Canvas token endpoint.
+
+After `CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD` consecutive failed token
+requests to a domain (timeouts, connection errors and 5xx responses), the
+breaker opens and further requests fail fast with CanvasUnavailableError
+instead of piling onto an unhealthy Canvas.  After
+`CANVAS_OAUTH_CIRCUIT_BREAKER_RESET_TIMEOUT` seconds one trial request is let
+through: if it succeeds the breaker closes, otherwise it opens again.
+Breakers are kept per process.
+"""
+import logging
+import threading
+import time
+
+from canvas_oauth import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns whether a request may be made now."""
+        if self.state == CLOSED or not settings.CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD:
+            return True
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if time.monotonic() - self.opened_at < settings.CANVAS_OAUTH_CIRCUIT_BREAKER_RESET_TIMEOUT:
+                return False
+            # Let one trial request through, or another one if the last trial
+            # never reported back
+            self.opened_at = time.monotonic()
+            if self.state == OPEN:
+                self._set_state(HALF_OPEN)
+            return True
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        threshold = settings.CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD
+        with self._lock:
+            self.failures += 1
+            if threshold and (self.state == HALF_OPEN or
+                              (self.state == CLOSED and self.failures >= threshold)):
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def _set_state(self, state):
+        logger.log(logging.WARNING if state == OPEN else logging.INFO,
+                   "Circuit breaker for %s is %s", self.domain, state)
+        self.state = state
+        metrics.increment('canvas_oauth_circuit_breaker_transitions_total',
+                          domain=self.domain, state=state)
+
+
+def get_breaker(domain):
+    breaker = _breakers.get(domain)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(domain)
+            if breaker is None:
+                breaker = _breakers[domain] = CircuitBreaker(domain)
+    return breaker
+
+
+def get_breaker_stats():
+    """Reports the state and consecutive failure count of each domain's
+    breaker, keyed by domain."""
+    return {domain: {'state': breaker.state, 'failures': breaker.failures}
+            for domain, breaker in list(_breakers.items())}
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
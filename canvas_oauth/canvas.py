@@ -1,17 +1,132 @@
+import asyncio
 import logging
+import os
+import random
+import threading
+import time
+import weakref
 from datetime import timedelta
+from urllib.parse import urlencode
 
-import requests
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
 
-from canvas_oauth.exceptions import InvalidOAuthReturnError, InvalidOAuthTimeoutError
-from canvas_oauth import settings
+from canvas_oauth.exceptions import (
+    CanvasUnavailableError, InvalidOAuthReturnError, InvalidOAuthTimeoutError)
+from canvas_oauth import breaker, metrics, settings, tracing
 
 logger = logging.getLogger(__name__)
 
 AUTHORIZE_URL_PATTERN = "https://%s/login/oauth2/auth"
 ACCESS_TOKEN_URL_PATTERN = "https://%s/login/oauth2/token"
 
+# Server errors worth another attempt; 429 is retried separately
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# requests is imported on first use, so that processes which never talk to
+# Canvas (e.g. most management commands) do not pay for importing it.
+#
+# One pooled, keep-alive session per Canvas domain, shared by every thread in
+# the process.  The urllib3 connection pools behind the sessions are
+# thread-safe; the lock only guards creation of new sessions.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Async clients, keyed by event loop and then by domain
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _reset_sessions():
+    """Drop all pooled sessions.  Open sockets must never be shared between a
+    parent process and its forked children (e.g. gunicorn workers), so this is
+    also registered to run in the child after a fork.
+    """
+    global _sessions_lock
+    for session in list(_sessions.values()):
+        session.close()
+    _sessions.clear()
+    _sessions_lock = threading.Lock()
+    _async_clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_sessions)
+
+
+def get_timeout():
+    """Returns the (connect, read) timeout tuple used for Canvas requests."""
+    return (settings.CANVAS_OAUTH_HTTP_CONNECT_TIMEOUT,
+            settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT)
+
+
+def get_session(domain=None):
+    """Returns the pooled `requests.Session` for the given Canvas domain,
+    creating it on first use.  Connections to the domain are kept alive and
+    reused across calls, up to `CANVAS_OAUTH_HTTP_POOL_SIZE` connections.
+    The session is shared by every user's requests, so it keeps no cookies.
+    """
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    session = _sessions.get(domain)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(domain)
+            if session is None:
+                from http.cookiejar import DefaultCookiePolicy
+
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=settings.CANVAS_OAUTH_HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[domain] = session
+    return session
+
+
+def warm_sessions(domains=None):
+    """Opens a keep-alive connection to each of the given Canvas domains (by
+    default the configured `CANVAS_OAUTH_CANVAS_DOMAIN`) so that the first
+    token request does not pay for the TCP and TLS handshakes.  Failures are
+    logged and otherwise ignored.
+    """
+    import requests
+    if domains is None:
+        domains = [settings.CANVAS_OAUTH_CANVAS_DOMAIN]
+    for domain in domains:
+        if not domain:
+            continue
+        try:
+            get_session(domain).head("https://%s/" % domain, timeout=get_timeout())
+        except requests.RequestException as e:
+            logger.warning("Unable to warm connection pool for %s: %s", domain, e)
+
+
+def get_pool_stats():
+    """Reports connection pool statistics for every pooled Canvas session,
+    keyed by domain.  `reused` is the number of requests that were served over
+    an already open connection.
+    """
+    stats = {}
+    for domain, session in list(_sessions.items()):
+        adapter = session.get_adapter("https://%s/" % domain)
+        pools = adapter.poolmanager.pools
+        connections = requests_made = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_made += pool.num_requests
+        stats[domain] = {
+            'pool_size': adapter._pool_maxsize,
+            'connections_opened': connections,
+            'requests': requests_made,
+            'reused': max(requests_made - connections, 0),
+        }
+    return stats
+
 
 def get_oauth_login_url(client_id, redirect_uri, response_type='code',
                         state=None, scopes=None, purpose=None,
@@ -33,31 +148,14 @@ def get_oauth_login_url(client_id, redirect_uri, response_type='code',
         'purpose': purpose,
         'force_login': force_login,
     }
-    auth_request_params = sorted(auth_request_params.items(), key=lambda val: val[0])
+    # Scrub any None key-value pairs, as requests would when preparing the url
+    auth_request_params = sorted((key, value) for key, value in auth_request_params.items()
+                                 if value is not None)
+    return "%s?%s" % (authorize_url, urlencode(auth_request_params))
 
-    # Use requests library to help build our url
-    auth_request = requests.Request('GET', authorize_url,
-                                    params=auth_request_params)
-    # Prepared request url uses urlencode for encoding and scrubs any None
-    # key-value pairs
-    return auth_request.prepare().url
 
-
-def get_access_token(grant_type, client_id, client_secret, redirect_uri,
-                     code=None, refresh_token=None, domain=None):
-    """Performs one of the two grant types supported by Canvas' OAuth endpoint to
-    to retrieve an access token.  Expect a `code` kwarg when performing an
-    `authorization_code` grant; otherwise, assume we're doing a `refresh_token`
-    grant.
-
-    Return a tuple of the access token, expiration date as a timezone aware DateTime,
-    and refresh token (returned by `authorization_code` requests only).
-    """
-    # Call Canvas endpoint to
-    if domain:
-        oauth_token_url = ACCESS_TOKEN_URL_PATTERN % domain
-    else:
-        oauth_token_url = ACCESS_TOKEN_URL_PATTERN % settings.CANVAS_OAUTH_CANVAS_DOMAIN
+def _get_token_params(grant_type, client_id, client_secret, redirect_uri,
+                      code=None, refresh_token=None):
     post_params = {
         'grant_type': grant_type,  # Use 'authorization_code' for new tokens
         'client_id': client_id,
@@ -70,12 +168,21 @@ def get_access_token(grant_type, client_id, client_secret, redirect_uri,
         post_params['code'] = code
     else:
         post_params['refresh_token'] = refresh_token
+    return post_params
 
-    try:
-        r = requests.post(oauth_token_url, post_params, timeout=5)
-    except requests.Timeout:
-        raise InvalidOAuthTimeoutError("%s request failed to get a token:" % (
-            grant_type))
+
+def _get_trace_headers(domain, grant_type):
+    """Records the request on the current span, if any, and returns the
+    headers that propagate it to Canvas."""
+    span = tracing.get_current_span()
+    if span is None:
+        return None
+    span.set_attribute('canvas_oauth.domain', domain)
+    span.set_attribute('canvas_oauth.grant_type', grant_type)
+    return {'traceparent': span.traceparent}
+
+
+def _parse_token_response(grant_type, r):
     if r.status_code != 200:
         raise InvalidOAuthReturnError("%s request failed to get a token: %s" % (
             grant_type, r.text))
@@ -95,3 +202,237 @@ def get_access_token(grant_type, client_id, client_secret, redirect_uri,
         refresh_token = response_data['refresh_token']
 
     return (access_token, expires, refresh_token)
+
+
+@tracing.traced('canvas_oauth.get_access_token')
+def get_access_token(grant_type, client_id, client_secret, redirect_uri,
+                     code=None, refresh_token=None, domain=None):
+    """Performs one of the two grant types supported by Canvas' OAuth endpoint to
+    to retrieve an access token.  Expect a `code` kwarg when performing an
+    `authorization_code` grant; otherwise, assume we're doing a `refresh_token`
+    grant.
+
+    Return a tuple of the access token, expiration date as a timezone aware DateTime,
+    and refresh token (returned by `authorization_code` requests only).
+    """
+    # Call Canvas endpoint to
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    oauth_token_url = ACCESS_TOKEN_URL_PATTERN % domain
+    post_params = _get_token_params(grant_type, client_id, client_secret,
+                                    redirect_uri, code, refresh_token)
+
+    import requests
+    policy = _RetryPolicy(domain, grant_type)
+    while True:
+        timeout = policy.start()
+        with metrics.timer('canvas_oauth_token_request_seconds',
+                           domain=domain, grant_type=grant_type) as labels:
+            kwargs = {'timeout': timeout}
+            headers = _get_trace_headers(domain, grant_type)
+            if headers:
+                kwargs['headers'] = headers
+            try:
+                r = get_session(domain).post(oauth_token_url, post_params, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                r = None
+                outcome = labels['status'] = _get_error_outcome(e)
+            else:
+                outcome = labels['status'] = r.status_code
+                tracing.set_attribute('http.status_code', r.status_code)
+            delay = policy.finish(outcome, r.headers.get('Retry-After') if r is not None else None)
+            if delay is None:
+                return _get_token_result(grant_type, outcome, r)
+            labels['result'] = 'retried'
+        time.sleep(delay)
+
+
+def _get_error_outcome(e):
+    """Classifies a requests exception by whether the request may have
+    reached Canvas: 'connection' if it cannot have, otherwise 'timeout' or
+    'disconnected' for a connection dropped after the request was sent.
+    """
+    import requests
+    from urllib3.exceptions import ProtocolError
+    # A ConnectTimeout is both, but the request never reached Canvas
+    if isinstance(e, requests.ConnectTimeout):
+        return 'connection'
+    if isinstance(e, requests.Timeout):
+        return 'timeout'
+    if e.args and isinstance(e.args[0], ProtocolError):
+        return 'disconnected'
+    return 'connection'
+
+
+class _RetryPolicy(object):
+    """Tracks the attempts, deadline and circuit breaker of one token
+    request.  Connection errors and 429s are retried with jittered exponential
+    backoff, within `CANVAS_OAUTH_HTTP_DEADLINE`; so are timeouts, dropped
+    connections and 5xx responses, except for `authorization_code` grants.
+    """
+
+    def __init__(self, domain, grant_type):
+        self.domain = domain
+        self.grant_type = grant_type
+        self.breaker = breaker.get_breaker(domain)
+        self.deadline = time.monotonic() + settings.CANVAS_OAUTH_HTTP_DEADLINE
+        self.attempts = 0
+
+    def start(self):
+        """Returns the (connect, read) timeout for the next attempt, or
+        raises CanvasUnavailableError if the domain's breaker is open or the
+        deadline has passed."""
+        if not self.breaker.allow():
+            metrics.increment('canvas_oauth_circuit_breaker_rejections_total', domain=self.domain)
+            raise CanvasUnavailableError("%s request not made: Canvas at %s is unavailable" % (
+                self.grant_type, self.domain))
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise CanvasUnavailableError("%s request not made: deadline for Canvas at %s exceeded" % (
+                self.grant_type, self.domain))
+        self.attempts += 1
+        connect, read = get_timeout()
+        return (min(connect, remaining), min(read, remaining))
+
+    def finish(self, outcome, retry_after=None):
+        """Records the outcome of an attempt, either a status code or one of
+        'timeout', 'disconnected' and 'connection', and returns the number of
+        seconds to wait before retrying, or None if the request should not be
+        retried.
+        """
+        if outcome in ('timeout', 'disconnected', 'connection') or outcome in RETRY_STATUSES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        if not self._is_retryable(outcome) or self.attempts > settings.CANVAS_OAUTH_HTTP_RETRIES:
+            return None
+
+        backoff = settings.CANVAS_OAUTH_HTTP_RETRY_BACKOFF
+        backoff_max = settings.CANVAS_OAUTH_HTTP_RETRY_BACKOFF_MAX
+        delay = random.uniform(0, min(backoff_max, backoff * 2 ** (self.attempts - 1)))
+        if retry_after:
+            try:
+                retry_after = float(retry_after)
+            except ValueError:
+                retry_after = 0
+            # Give up rather than wait longer than we would back off for
+            if retry_after > backoff_max:
+                return None
+            delay = max(delay, retry_after)
+        if time.monotonic() + delay >= self.deadline:
+            return None
+
+        logger.info("Retrying %s request to %s in %.2fs after %s (attempt %s)",
+                    self.grant_type, self.domain, delay, outcome, self.attempts)
+        metrics.increment('canvas_oauth_token_request_retries_total',
+                          domain=self.domain, grant_type=self.grant_type, reason=outcome)
+        return delay
+
+    def _is_retryable(self, outcome):
+        if outcome in ('connection', 429):
+            return True
+        # An authorization code can only be redeemed once, so if Canvas may
+        # have received the request a retry would fail anyway
+        if self.grant_type == 'authorization_code':
+            return False
+        return outcome in ('timeout', 'disconnected') or outcome in RETRY_STATUSES
+
+
+def _get_token_result(grant_type, outcome, r):
+    if outcome == 'timeout':
+        raise InvalidOAuthTimeoutError("%s request failed to get a token:" % (
+            grant_type))
+    elif outcome == 'disconnected':
+        raise CanvasUnavailableError("%s request lost its connection to Canvas" % (
+            grant_type))
+    elif outcome == 'connection':
+        raise CanvasUnavailableError("%s request failed to connect to Canvas" % (
+            grant_type))
+    elif outcome in RETRY_STATUSES or outcome == 429:
+        raise CanvasUnavailableError("%s request failed to get a token: %s" % (
+            grant_type, r.text))
+    return _parse_token_response(grant_type, r)
+
+
+def _import_httpx():
+    try:
+        import httpx
+    except ImportError:
+        raise ImproperlyConfigured(
+            "The async API of the Django Canvas OAuth library requires httpx: "
+            "pip install canvas-oauth[async]")
+    return httpx
+
+
+def get_async_client(domain=None):
+    """Returns the pooled `httpx.AsyncClient` for the given Canvas domain on
+    the running event loop, creating it on first use.  Clients are bound to
+    the loop they were created on, so each loop gets its own.  As with
+    `get_session`, the client keeps no cookies.
+    """
+    from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+    httpx = _import_httpx()
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = _async_clients[loop] = {}
+    client = clients.get(domain)
+    if client is None:
+        pool_size = settings.CANVAS_OAUTH_HTTP_POOL_SIZE
+        client = clients[domain] = httpx.AsyncClient(
+            cookies=CookieJar(DefaultCookiePolicy(allowed_domains=[])),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT,
+                                  connect=settings.CANVAS_OAUTH_HTTP_CONNECT_TIMEOUT))
+    return client
+
+
+async def aclose_async_clients():
+    """Closes the pooled async clients of the running event loop, for loops
+    that are about to be closed."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+
+@tracing.traced('canvas_oauth.get_access_token')
+async def aget_access_token(grant_type, client_id, client_secret, redirect_uri,
+                            code=None, refresh_token=None, domain=None):
+    """Async version of `get_access_token`, which makes the request through a
+    pooled, non-blocking HTTP client.
+    """
+    httpx = _import_httpx()
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    oauth_token_url = ACCESS_TOKEN_URL_PATTERN % domain
+    post_params = _get_token_params(grant_type, client_id, client_secret,
+                                    redirect_uri, code, refresh_token)
+    # Unlike requests, httpx sends None values as empty strings
+    post_params = {key: value for key, value in post_params.items() if value is not None}
+
+    policy = _RetryPolicy(domain, grant_type)
+    while True:
+        connect, read = policy.start()
+        with metrics.timer('canvas_oauth_token_request_seconds',
+                           domain=domain, grant_type=grant_type) as labels:
+            try:
+                r = await get_async_client(domain).post(
+                    oauth_token_url, data=post_params, headers=_get_trace_headers(domain, grant_type),
+                    timeout=httpx.Timeout(read, connect=connect))
+            except httpx.TransportError as e:
+                r = None
+                if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+                    outcome = 'connection'
+                elif isinstance(e, httpx.TimeoutException):
+                    outcome = 'timeout'
+                else:
+                    outcome = 'disconnected'
+                labels['status'] = outcome
+            else:
+                outcome = labels['status'] = r.status_code
+                tracing.set_attribute('http.status_code', r.status_code)
+            delay = policy.finish(outcome, r.headers.get('Retry-After') if r is not None else None)
+            if delay is None:
+                return _get_token_result(grant_type, outcome, r)
+            labels['result'] = 'retried'
+        await asyncio.sleep(delay)
@@ -0,0 +1,270 @@
+"""
+A client for the Canvas API, authenticated as the user of a request.
+
+    client = CanvasClient(request)
+    courses = client.get('courses').json()
+
+Requests go through the same pooled, keep-alive session per Canvas domain as
+the token requests.  The user's token comes from `get_oauth_token`, so it is
+looked up once per request and refreshed when it expires.  If Canvas still
+rejects it as invalid, e.g. because it was revoked or expired early, the
+token is refreshed once and the request replayed.
+
+With CANVAS_OAUTH_API_THROTTLE set, requests are paced to stay within the
+token's Canvas rate limit (see `canvas_oauth.throttle`).  With
+CANVAS_OAUTH_API_CACHE_ALIAS set, GET responses are revalidated with
+ETags (see `canvas_oauth.api_cache`).
+
+List endpoints are paginated with Link headers; `paginate` yields their
+items page by page, optionally fetching the following pages concurrently.
+"""
+import contextvars
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.db import connection
+
+from canvas_oauth import api_cache, canvas, metrics, oauth, settings, throttle, tracing
+
+logger = logging.getLogger(__name__)
+
+API_PATH_PREFIX = '/api/v1/'
+
+
+def is_invalid_token_response(r):
+    """Returns whether Canvas rejected the request's access token.  Canvas
+    answers an invalid or expired token with a 401 and a WWW-Authenticate
+    header, and a token that lacks a scope with a plain 401.
+    """
+    return r.status_code == 401 and 'WWW-Authenticate' in r.headers
+
+
+def get_api_url(domain, path):
+    """Returns the URL of an API path on the given Canvas domain.  Paths are
+    relative to /api/v1/ unless they start with a slash; absolute URLs are
+    returned as is."""
+    if path.startswith(('https://', 'http://')):
+        return path
+    if not path.startswith('/'):
+        path = API_PATH_PREFIX + path
+    return "https://%s%s" % (domain, path)
+
+
+def is_canvas_url(domain, url):
+    """Returns whether the URL is on the given Canvas domain, and so may be
+    sent the user's token."""
+    parts = urlsplit(url)
+    return parts.scheme == 'https' and parts.netloc == domain
+
+
+def get_page_number(url):
+    """Returns the numeric `page` parameter of a pagination link, or None if
+    it has none, e.g. for bookmark pagination."""
+    pages = [value for key, value in parse_qsl(urlsplit(url).query) if key == 'page']
+    if len(pages) == 1 and pages[0].isdigit():
+        return int(pages[0])
+    return None
+
+
+def set_page_number(url, page):
+    parts = urlsplit(url)
+    query = [(key, str(page) if key == 'page' else value) for key, value in parse_qsl(parts.query)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def get_page_urls(r):
+    """Returns an iterator over the URLs of the pages after the given one,
+    if Canvas gave numbered `next` and `last` links, or None if the pages
+    can only be found by following `next` links.
+    """
+    links = r.links
+    if 'next' not in links or 'last' not in links:
+        return None
+    next_url = links['next']['url']
+    next_page = get_page_number(next_url)
+    last_page = get_page_number(links['last']['url'])
+    if next_page is None or last_page is None:
+        return None
+    return (set_page_number(next_url, page) for page in range(next_page, last_page + 1))
+
+
+class CanvasClient(object):
+    """Makes Canvas API requests on behalf of the request's user, against
+    the request's Canvas domain.  Paths are relative to /api/v1/ unless they
+    start with a slash; absolute URLs, such as pagination links, are used
+    as is, but the token is only sent to the Canvas domain itself.
+
+    Request bodies may be sent twice, so pass data rather than streams.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def domain(self):
+        return oauth.get_canvas_domain(self.request)
+
+    def get_url(self, path):
+        return get_api_url(self.domain, path)
+
+    def call(self, method, path, **kwargs):
+        """Sends a request and returns the `requests.Response`.  Accepts the
+        keyword arguments of `requests.Session.request`.
+        """
+        return self._call(method, path, None, kwargs)
+
+    def _call(self, method, path, access_token, kwargs):
+        """Sends a request with the given access token, or else the one
+        `get_oauth_token` returns."""
+        url = self.get_url(path)
+        cache_key = cached = None
+        if method == 'GET' and not kwargs.get('stream') and api_cache.is_enabled():
+            cache_key = api_cache.get_key(self.request.user.pk, url, kwargs.get('params'), kwargs.get('headers'))
+            cached = api_cache.get(cache_key)
+            if cached is not None:
+                kwargs['headers'] = api_cache.add_validators(cached, kwargs.get('headers'))
+
+        with tracing.span('canvas_oauth.api_request', {'http.method': method}):
+            on_canvas = is_canvas_url(self.domain, url)
+            if not on_canvas:
+                access_token = None
+            elif access_token is None:
+                access_token = oauth.get_oauth_token(self.request)
+            r = self._send(method, url, access_token, **kwargs)
+            if on_canvas and is_invalid_token_response(r):
+                r.close()
+                access_token = self._refresh(access_token)
+                r = self._send(method, url, access_token, **kwargs)
+            tracing.set_attribute('http.status_code', r.status_code)
+        if cache_key is not None:
+            r = api_cache.handle_response(cache_key, cached, r)
+        return r
+
+    def get(self, path, params=None, **kwargs):
+        return self.call('GET', path, params=params, **kwargs)
+
+    def post(self, path, data=None, json=None, **kwargs):
+        return self.call('POST', path, data=data, json=json, **kwargs)
+
+    def put(self, path, data=None, json=None, **kwargs):
+        return self.call('PUT', path, data=data, json=json, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.call('DELETE', path, **kwargs)
+
+    def paginate(self, path, params=None, prefetch=0, key=None, **kwargs):
+        """Yields the items of a paginated list endpoint as each page arrives,
+        raising `requests.HTTPError` for a failed page.  `key` names the list
+        in endpoints that wrap it in an object.
+
+        With `prefetch`, when Canvas numbers the pages, up to that many of
+        the following pages are fetched concurrently.  Pages are still yielded
+        in order, and at most `prefetch` of them are held in memory at once.
+        """
+        r = self._get_page(path, params=params, **kwargs)
+        page_urls = get_page_urls(r) if prefetch else None
+        next_link = r.links.get('next')
+        yield from self._get_items(r, key)
+
+        if page_urls is not None:
+            yield from self._prefetch_pages(page_urls, prefetch, key, kwargs)
+            return
+        while next_link:
+            # The next link already carries the query parameters
+            r = self._get_page(next_link['url'], **kwargs)
+            next_link = r.links.get('next')
+            yield from self._get_items(r, key)
+
+    def _get_page(self, path, access_token=None, **kwargs):
+        r = self._call('GET', path, access_token, kwargs)
+        r.raise_for_status()
+        return r
+
+    def _prefetch_page(self, url, access_token, kwargs):
+        try:
+            return self._get_page(url, access_token, **kwargs)
+        finally:
+            # Pool threads are not reused, so do not leave a connection open
+            connection.close()
+
+    def _get_items(self, r, key):
+        items = r.json()
+        return items[key] if key is not None else items
+
+    def _prefetch_pages(self, page_urls, prefetch, key, kwargs):
+        # Looked up here, so the pool threads only touch the database if
+        # Canvas rejects the token
+        access_token = oauth.get_oauth_token(self.request)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            try:
+                for url in page_urls:
+                    # Each page runs in a copy of this context, so it is
+                    # traced as part of the current span
+                    pending.append(executor.submit(contextvars.copy_context().run, self._prefetch_page,
+                                                   url, access_token, kwargs))
+                    if len(pending) >= prefetch:
+                        yield from self._get_items(pending.popleft().result(), key)
+                while pending:
+                    yield from self._get_items(pending.popleft().result(), key)
+            finally:
+                # The consumer stopped early, or a page failed
+                for future in pending:
+                    future.cancel()
+
+    def _send(self, method, url, access_token, headers=None, **kwargs):
+        """Sends the request with the given access token, or with none to a
+        host other than the Canvas domain."""
+        headers = dict(headers or {})
+        traceparent = tracing.get_traceparent()
+        if traceparent:
+            headers['traceparent'] = traceparent
+        kwargs.setdefault('timeout', canvas.get_timeout())
+        if access_token is None:
+            return self._send_once(urlsplit(url).netloc, method, url, headers, kwargs)
+
+        domain = self.domain
+        headers['Authorization'] = 'Bearer %s' % access_token
+        if not settings.CANVAS_OAUTH_API_THROTTLE:
+            return self._send_once(domain, method, url, headers, kwargs)
+
+        token_throttle = throttle.get_throttle(domain, access_token)
+        attempts = 0
+        while True:
+            attempts += 1
+            token_throttle.acquire()
+            r = None
+            try:
+                r = self._send_once(domain, method, url, headers, kwargs)
+            finally:
+                token_throttle.release(r)
+            # A throttled request was not carried out, so it is safe to send
+            # again once the budget has refilled
+            if not throttle.is_throttled_response(r) or attempts > settings.CANVAS_OAUTH_HTTP_RETRIES:
+                return r
+            r.close()
+
+    def _send_once(self, domain, method, url, headers, kwargs):
+        with metrics.timer('canvas_oauth_api_request_seconds', domain=domain, method=method) as labels:
+            r = canvas.get_session(domain).request(method, url, headers=headers, **kwargs)
+            labels['status'] = r.status_code
+        return r
+
+    def _refresh(self, rejected_access_token):
+        """Refreshes the token that Canvas rejected and returns the new access
+        token.  If another thread of this client already replaced it, its token
+        is used instead.  Across requests and processes, refreshes are
+        coalesced by CANVAS_OAUTH_REFRESH_LOCK.
+        """
+        with self._refresh_lock:
+            memo = getattr(self.request, '_canvas_oauth_token_memo', None)
+            if memo is not None and memo[1] != rejected_access_token:
+                return memo[1]
+            logger.info("Canvas rejected the token of user %s; refreshing", self.request.user.pk)
+            metrics.increment('canvas_oauth_api_token_refreshes_total', domain=self.domain)
+            oauth.refresh_oauth_token(self.request, memo[0] if memo is not None else None)
+            return oauth.get_oauth_token(self.request)
@@ -0,0 +1,101 @@
+"""
+Encryption of stored tokens.
+
+Tokens are encrypted with the server-side keyring in
+CANVAS_OAUTH_ENCRYPTION_KEYS when it is set, so that they can be decrypted
+outside of a request (e.g. by background workers).  Otherwise they are
+encrypted with the per-session key in `request.session['canvas_oauth_token_key']`
+if there is one, or stored as plain text.
+
+cryptography is only imported once a key is actually used.
+"""
+import threading
+
+from canvas_oauth import settings
+
+SESSION_KEY = 'canvas_oauth_token_key'
+
+_keyring = None
+_keyring_keys = None
+_keyring_lock = threading.Lock()
+
+
+def _get_fernets():
+    global _keyring, _keyring_keys
+    keys = settings.CANVAS_OAUTH_ENCRYPTION_KEYS
+    if not keys:
+        return None
+    if keys is not _keyring_keys:
+        with _keyring_lock:
+            if keys is not _keyring_keys:
+                from cryptography.fernet import Fernet
+                _keyring = [Fernet(key) for key in keys]
+                _keyring_keys = keys
+    return _keyring
+
+
+def get_keyring():
+    """Returns a MultiFernet for the server-side keyring, or None if no keys
+    are configured.  The first key encrypts; all keys decrypt.  The ciphers
+    are built once per process.
+    """
+    fernets = _get_fernets()
+    if not fernets:
+        return None
+    from cryptography.fernet import MultiFernet
+    return MultiFernet(fernets)
+
+
+def get_cipher(request=None):
+    """Returns the cipher used for the tokens of the given request, or None if
+    tokens are stored as plain text.
+
+    When both the keyring and a session key are available, tokens are
+    encrypted with the keyring but tokens encrypted with the session key can
+    still be decrypted, so they are moved to the keyring on their next refresh.
+    """
+    fernets = _get_fernets()
+    session_key = None
+    if request is not None and SESSION_KEY in request.session:
+        session_key = request.session[SESSION_KEY]
+    if not fernets and not session_key:
+        return None
+    from cryptography.fernet import Fernet, MultiFernet
+    if fernets and session_key:
+        return MultiFernet(fernets + [Fernet(session_key)])
+    elif fernets:
+        return MultiFernet(fernets)
+    return Fernet(session_key)
+
+
+def encrypt(value, cipher):
+    if cipher is None:
+        return value
+    return cipher.encrypt(value.encode()).decode()
+
+
+def decrypt(value, cipher):
+    """Decrypts a stored value.  Values stored as plain text, e.g. before
+    the keyring was configured, are returned as they are, and encrypted on
+    their next save."""
+    if cipher is None or not is_encrypted(value):
+        return value
+    return cipher.decrypt(value.encode()).decode()
+
+
+def decrypt_stored(value, cipher):
+    """Decrypts a stored value outside of a request, with the keyring as
+    `cipher`.  Raises InvalidToken if the value is encrypted but there is no
+    keyring, as with a per-session key that only the user's requests have.
+    """
+    if cipher is None and is_encrypted(value):
+        from cryptography.fernet import InvalidToken
+        raise InvalidToken("Encrypted with a session key, which is only available in the user's requests")
+    return decrypt(value, cipher)
+
+
+def is_encrypted(value):
+    """Returns whether the value looks like a Fernet token.  Fernet tokens
+    always start with the version byte 0x80, which base64 encodes as 'gAAAAA'.
+    """
+    return value.startswith('gAAAAA')
@@ -0,0 +1,221 @@
+"""
+Streaming downloads of Canvas files and exports, in constant memory.
+
+    stats = download(request, export['attachment']['url'], '/tmp/export.zip')
+    logger.info("%d bytes at %.0f bytes/s", stats.bytes, stats.throughput)
+
+Canvas answers a file URL with a redirect to a signed URL on its storage
+service.  Redirects are followed one by one, and the user's token is only
+sent to the Canvas domain itself, never to the storage service.  The body is
+written to the sink in chunks of at most `chunk_size` bytes as it arrives.
+
+If the connection drops or the storage service fails, the download is
+resumed from the last byte written with a Range request, up to
+CANVAS_OAUTH_HTTP_RETRIES times.  Each attempt starts again from the Canvas
+URL, so that an expired signed URL is replaced with a fresh one.
+"""
+import logging
+import os
+import random
+import re
+import time
+from urllib.parse import urljoin, urlsplit
+
+from canvas_oauth import canvas, metrics, settings
+from canvas_oauth.client import CanvasClient
+from canvas_oauth.exceptions import CanvasDownloadError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+MAX_REDIRECTS = 5
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+CONTENT_RANGE_RE = re.compile(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)')
+
+
+class DownloadStats(object):
+    """The progress of a download.  `position` is the number of bytes of
+    the file in the sink, including any there before the download started,
+    and `bytes` the number transferred by this download."""
+
+    def __init__(self, url, position=0):
+        self.url = url
+        self.position = position
+        self.total = None
+        self.bytes = 0
+        self.attempts = 0
+        self.started_at = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """Bytes transferred per second."""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def record(self, size):
+        self.position += size
+        self.bytes += size
+        self.elapsed = time.monotonic() - self.started_at
+
+
+def download(request, url, sink, offset=None, chunk_size=CHUNK_SIZE, progress=None):
+    """Downloads a file from Canvas on behalf of the request's user and
+    returns its `DownloadStats`.  `url` is a Canvas URL or path, such as the
+    `url` of a file object or '/files/123/download'.
+
+    `sink` is a path or a binary file-like object.  A download to an existing
+    path resumes after the bytes already in it.  For a file-like object,
+    pass `offset` to resume after that many bytes, already written before
+    its current position.  If Canvas can only send the whole file again, the
+    sink is rewound to where the file starts, which needs a seekable sink.
+    `progress` is called with the stats after each chunk.
+    """
+    if isinstance(sink, (str, os.PathLike)):
+        with open(sink, 'r+b' if os.path.exists(sink) else 'wb') as f:
+            size = f.seek(0, os.SEEK_END)
+            return Download(request, url, f, size if offset is None else offset,
+                            chunk_size, progress).run()
+    return Download(request, url, sink, offset or 0, chunk_size, progress).run()
+
+
+class Download(object):
+
+    def __init__(self, request, url, sink, offset, chunk_size, progress):
+        self.client = CanvasClient(request)
+        self.url = self.client.get_url(url)
+        self.sink = sink
+        # Where byte 0 of the file is, or would be, in the sink
+        self.start = sink.tell() - offset if _is_seekable(sink) else None
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.validator = None
+        self.stats = DownloadStats(self.url, offset)
+
+    def run(self):
+        import requests
+        stats = self.stats
+        while True:
+            stats.attempts += 1
+            transferred = stats.bytes
+            try:
+                if self._attempt():
+                    break
+                error = CanvasDownloadError("Download of %s ended after %s of %s bytes" % (
+                    self.url, stats.position, stats.total))
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+            except requests.HTTPError as e:
+                if e.response.status_code not in canvas.RETRY_STATUSES:
+                    raise
+                error = e
+            finally:
+                metrics.increment('canvas_oauth_download_bytes_total', stats.bytes - transferred,
+                                  domain=self.client.domain)
+            if stats.attempts > settings.CANVAS_OAUTH_HTTP_RETRIES:
+                raise error
+            backoff = settings.CANVAS_OAUTH_HTTP_RETRY_BACKOFF
+            delay = random.uniform(0, min(settings.CANVAS_OAUTH_HTTP_RETRY_BACKOFF_MAX,
+                                          backoff * 2 ** (stats.attempts - 1)))
+            logger.info("Resuming download of %s at byte %s in %.2fs after %r",
+                        self.url, stats.position, delay, error)
+            metrics.increment('canvas_oauth_download_retries_total', domain=self.client.domain)
+            time.sleep(delay)
+
+        stats.elapsed = time.monotonic() - stats.started_at
+        logger.info("Downloaded %s bytes of %s in %.2fs (%.0f bytes/s, %s attempts)",
+                    stats.bytes, self.url, stats.elapsed, stats.throughput, stats.attempts)
+        return stats
+
+    def _attempt(self):
+        """Makes one attempt at the rest of the file, and returns whether
+        the whole file has been written."""
+        stats = self.stats
+        headers = {'Accept-Encoding': 'identity'}
+        if stats.position:
+            headers['Range'] = 'bytes=%d-' % stats.position
+            if self.validator:
+                headers['If-Range'] = self.validator
+        r = self._open(headers)
+        try:
+            if r.status_code == 416:
+                # Nothing left after the given position, if it was the end
+                total = self._parse_content_range(r)[1]
+                if total == stats.position:
+                    stats.total = total
+                    return True
+                self._rewind()
+                return False
+            r.raise_for_status()
+            if r.status_code == 206:
+                first_byte, stats.total = self._parse_content_range(r)
+                if first_byte != stats.position:
+                    raise CanvasDownloadError("Canvas resumed %s at byte %s rather than %s" % (
+                        self.url, first_byte, stats.position))
+            else:
+                # The whole file, either because no range was asked for or
+                # because the file changed since the first attempt
+                if stats.position:
+                    self._rewind()
+                content_length = r.headers.get('Content-Length')
+                stats.total = int(content_length) if content_length else None
+            self.validator = self._get_validator(r)
+
+            for chunk in r.iter_content(self.chunk_size):
+                self.sink.write(chunk)
+                stats.record(len(chunk))
+                if self.progress is not None:
+                    self.progress(stats)
+        finally:
+            r.close()
+        return stats.total is None or stats.position >= stats.total
+
+    def _open(self, headers):
+        """Sends the request, following redirects, and returns the streamed
+        response.  Only requests to the Canvas domain carry the token."""
+        url = self.url
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme == 'https' and parts.netloc == self.client.domain:
+                r = self.client.get(url, headers=headers, stream=True, allow_redirects=False)
+            else:
+                r = canvas.get_session(parts.netloc).get(
+                    url, headers=headers, stream=True, allow_redirects=False, timeout=canvas.get_timeout())
+            if r.status_code not in REDIRECT_STATUSES:
+                return r
+            url = urljoin(url, r.headers['Location'])
+            r.close()
+        raise CanvasDownloadError("Too many redirects downloading %s" % self.url)
+
+    def _parse_content_range(self, r):
+        match = CONTENT_RANGE_RE.match(r.headers.get('Content-Range', ''))
+        if match is None:
+            raise CanvasDownloadError("Invalid Content-Range for %s: %r" % (
+                self.url, r.headers.get('Content-Range')))
+        first_byte, total = match.groups()
+        return (int(first_byte) if first_byte else None,
+                int(total) if total != '*' else None)
+
+    def _get_validator(self, r):
+        """Returns the value for If-Range that makes sure a resumed download
+        continues the same version of the file."""
+        etag = r.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return r.headers.get('Last-Modified')
+
+    def _rewind(self):
+        if self.start is None:
+            raise CanvasDownloadError("Unable to resume %s, and the sink cannot be rewound" % self.url)
+        logger.info("Restarting download of %s from the first byte", self.url)
+        self.sink.seek(self.start)
+        self.sink.truncate()
+        self.stats.position = 0
+        self.validator = None
+
+
+def _is_seekable(sink):
+    seekable = getattr(sink, 'seekable', None)
+    return seekable is not None and seekable()
@@ -14,5 +14,28 @@ class InvalidOAuthReturnError(CanvasOAuthError):
     pass
 
 
-class InvalidOAuthTimeoutError(CanvasOAuthError):
+class CanvasUnavailableError(CanvasOAuthError):
+    """Canvas could not be reached, or answered with a server error, so no
+    token could be retrieved.  The stored token is not at fault."""
+    pass
+
+
+class InvalidOAuthTimeoutError(CanvasUnavailableError):
+    pass
+
+
+class CanvasGraphQLError(Exception):
+    """Canvas answered a GraphQL query with errors.  `errors` holds them as
+    Canvas returned them, and `data` whatever part of the result it could
+    still resolve."""
+
+    def __init__(self, errors, data=None):
+        super().__init__('; '.join(error.get('message', '') for error in errors))
+        self.errors = errors
+        self.data = data
+
+
+class CanvasDownloadError(Exception):
+    """A download could not be completed, e.g. because it could not be
+    resumed after the connection dropped."""
     pass
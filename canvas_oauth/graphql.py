@@ -0,0 +1,435 @@
+"""
+A client for the Canvas GraphQL API that batches queries into one request.
+
+    graphql = get_graphql_client(request)
+    results = [graphql.query(COURSE_QUERY, {'id': course_id}) for course_id in course_ids]
+    names = [result.data['course']['name'] for result in results]
+
+`query` only queues a query and returns a `GraphQLResult`.  When the first
+result is read, every query queued on the client so far is sent in a single
+request to /api/graphql: their documents are merged into one, with the
+top-level fields, variables and fragments of each prefixed with `q<n>_`, and
+the response is split back into each query's own result.  From async code,
+`aexecute` batches the queries issued in the same tick of the event loop.
+
+Parsed and merged documents are cached per process, so a view that issues
+the same queries on every request only builds its batch document once.
+Documents that cannot be merged, such as mutations, documents with several
+operations and queries with fragment spreads at the top level, are sent on
+their own.
+"""
+import asyncio
+import functools
+import re
+import threading
+
+from canvas_oauth import batch, metrics, oauth
+from canvas_oauth.client import CanvasClient, get_api_url
+from canvas_oauth.exceptions import CanvasGraphQLError
+
+GRAPHQL_PATH = '/api/graphql'
+
+# The most queries merged into one request, to stay within the complexity
+# limits Canvas puts on a single query
+MAX_BATCH_SIZE = 50
+
+# Parsed and merged documents are kept for this many documents per process
+MAX_DOCUMENTS = 256
+
+TOKEN_RE = re.compile(r'''
+    (?P<ignored>[\s,\ufeff]+|\#[^\n\r]*)
+  | (?P<token>
+        """(?:\\"""|[^"]|"(?!""))*"""
+      | "(?:\\.|[^"\\\n\r])*"
+      | \.\.\.
+      | [!$&()\[\]{}:=@|]
+      | [_A-Za-z][_0-9A-Za-z]*
+      | -?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?
+    )
+''', re.VERBOSE)
+
+NAME_RE = re.compile(r'[_A-Za-z]')
+
+KEY_RE = re.compile(r'q(\d+)_(.*)', re.DOTALL)
+
+OPENING = ('(', '{', '[')
+CLOSING = (')', '}', ']')
+
+
+def tokenize(text):
+    """Splits a GraphQL document into its tokens, leaving out whitespace,
+    commas and comments."""
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKEN_RE.match(text, position)
+        if match is None:
+            raise ValueError("Unexpected character at position %d" % position)
+        if match.group('token') is not None:
+            tokens.append(match.group('token'))
+        position = match.end()
+    return tokens
+
+
+class Document(object):
+    """A GraphQL document, parsed just enough to merge it with others.  For
+    documents that cannot be merged, only `text` is set."""
+
+    def __init__(self, text, variables=None, selections=None, fragments=None):
+        self.text = text
+        self.mergeable = selections is not None
+        # The tokens of each variable definition
+        self.variables = variables or []
+        # The response key and tokens of each top-level field
+        self.selections = selections or []
+        # The tokens of each fragment definition
+        self.fragments = fragments or []
+
+
+@functools.lru_cache(maxsize=MAX_DOCUMENTS)
+def parse_document(text):
+    try:
+        return _parse(text)
+    except (ValueError, IndexError):
+        # Sent as is, for Canvas to run or report on
+        return Document(text)
+
+
+def _parse(text):
+    tokens = tokenize(text)
+    operation = None
+    fragments = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == 'fragment':
+            end = _skip(tokens, tokens.index('{', i))
+            fragments.append(tokens[i:end])
+            i = end
+        elif operation is None and tokens[i] in ('{', 'query'):
+            operation, i = _parse_query(tokens, i)
+        else:
+            raise ValueError("Only documents with a single query can be merged")
+    if operation is None:
+        raise ValueError("The document has no query")
+    variables, selections = operation
+    return Document(text, variables, selections, fragments)
+
+
+def _parse_query(tokens, i):
+    variables = []
+    if tokens[i] == 'query':
+        i += 1
+        if tokens[i] not in ('(', '{'):
+            # The operation name
+            i += 1
+        if tokens[i] == '(':
+            end = _skip(tokens, i)
+            variables = _split_variables(tokens[i + 1:end - 1])
+            i = end
+    if tokens[i] != '{':
+        raise ValueError("Queries with directives cannot be merged")
+    end = _skip(tokens, i)
+    return (variables, _split_selections(tokens[i + 1:end - 1])), end
+
+
+def _skip(tokens, start):
+    """Returns the index after the bracket that closes the one at `start`."""
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i] in OPENING:
+            depth += 1
+        elif tokens[i] in CLOSING:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    raise ValueError("Unbalanced brackets")
+
+
+def _split_variables(tokens):
+    definitions = []
+    depth = 0
+    for token in tokens:
+        if token == '$' and depth == 0:
+            definitions.append([])
+        elif token in OPENING:
+            depth += 1
+        elif token in CLOSING:
+            depth -= 1
+        definitions[-1].append(token)
+    return definitions
+
+
+def _split_selections(tokens):
+    selections = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == '...':
+            raise ValueError("Fragment spreads at the top level cannot be merged")
+        # An alias is dropped, since the field is aliased again when merged
+        start = i + 2 if i + 1 < len(tokens) and tokens[i + 1] == ':' else i
+        key = tokens[i]
+        i = start + 1
+        if i < len(tokens) and tokens[i] == '(':
+            i = _skip(tokens, i)
+        while i < len(tokens) and tokens[i] == '@':
+            i += 2
+            if i < len(tokens) and tokens[i] == '(':
+                i = _skip(tokens, i)
+        if i < len(tokens) and tokens[i] == '{':
+            i = _skip(tokens, i)
+        selections.append((key, tokens[start:i]))
+    return selections
+
+
+def _rename(tokens, prefix):
+    """Prefixes the variables and fragment spreads in the given tokens."""
+    renamed = list(tokens)
+    for i in range(1, len(tokens)):
+        if tokens[i - 1] == '$' or (tokens[i - 1] == '...' and tokens[i] != 'on' and NAME_RE.match(tokens[i])):
+            renamed[i] = prefix + tokens[i]
+    return renamed
+
+
+@functools.lru_cache(maxsize=MAX_DOCUMENTS)
+def get_batch_document(texts):
+    """Merges the given mergeable documents into one query, in which the
+    top-level fields, variables and fragments of the document at index n are
+    prefixed with `q<n>_`."""
+    variables = []
+    selections = []
+    fragments = []
+    for index, text in enumerate(texts):
+        document = parse_document(text)
+        prefix = 'q%d_' % index
+        variables.extend(' '.join(_rename(definition, prefix)) for definition in document.variables)
+        selections.extend('%s%s: %s' % (prefix, key, ' '.join(_rename(field, prefix)))
+                          for key, field in document.selections)
+        for fragment in document.fragments:
+            fragment = _rename(fragment, prefix)
+            fragment[1] = prefix + fragment[1]
+            fragments.append(' '.join(fragment))
+    parts = ['query']
+    if variables:
+        parts.append('(%s)' % ' '.join(variables))
+    parts.append('{ %s }' % ' '.join(selections))
+    return ' '.join(parts + fragments)
+
+
+def get_batches(queries, max_batch_size=MAX_BATCH_SIZE):
+    """Groups the queries into batches to send together, each query that
+    cannot be merged in a batch of its own."""
+    merged = []
+    for query in queries:
+        if not parse_document(query.document).mergeable:
+            yield [query]
+            continue
+        merged.append(query)
+        if len(merged) >= max_batch_size:
+            yield merged
+            merged = []
+    if merged:
+        yield merged
+
+
+def build_payload(queries):
+    if len(queries) == 1:
+        return {'query': queries[0].document, 'variables': queries[0].variables}
+    variables = {}
+    for index, query in enumerate(queries):
+        variables.update(('q%d_%s' % (index, name), value) for name, value in query.variables.items())
+    return {'query': get_batch_document(tuple(query.document for query in queries)), 'variables': variables}
+
+
+def split_response(body, count):
+    """Splits the response to a merged document into a `(data, errors)`
+    pair per query.  Errors without a path are given to every query."""
+    data = body.get('data')
+    results = [({} if data is not None else None, []) for _ in range(count)]
+
+    def split_key(key):
+        match = KEY_RE.match(key) if isinstance(key, str) else None
+        if match is None or int(match.group(1)) >= count:
+            return None, key
+        return int(match.group(1)), match.group(2)
+
+    for key, value in (data or {}).items():
+        index, key = split_key(key)
+        if index is not None:
+            results[index][0][key] = value
+    for error in body.get('errors') or []:
+        path = error.get('path')
+        index, key = split_key(path[0]) if path else (None, None)
+        if index is None:
+            for _, errors in results:
+                errors.append(error)
+        else:
+            results[index][1].append(dict(error, path=[key] + path[1:]))
+    return results
+
+
+def resolve(queries, body):
+    if len(queries) == 1:
+        queries[0].set_result(body.get('data'), body.get('errors') or [])
+        return
+    for query, (data, errors) in zip(queries, split_response(body, len(queries))):
+        query.set_result(data, errors)
+
+
+class GraphQLResult(object):
+    """The result of a query queued on a `GraphQLClient`.  Reading `data` or
+    `errors` first sends the client's pending queries, if this one has not
+    been sent yet."""
+
+    def __init__(self, client, document, variables=None):
+        self.client = client
+        self.document = document
+        self.variables = variables or {}
+        self.done = False
+        self._data = None
+        self._errors = []
+        self._exception = None
+
+    def set_result(self, data, errors):
+        self._data = data
+        self._errors = errors
+        self.done = True
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self.done = True
+
+    def _resolve(self):
+        if not self.done:
+            self.client.flush()
+        if self._exception is not None:
+            raise self._exception
+
+    @property
+    def errors(self):
+        self._resolve()
+        return self._errors
+
+    @property
+    def data(self):
+        """The data of the query, raising `CanvasGraphQLError` if Canvas
+        returned errors for it."""
+        self._resolve()
+        if self._errors:
+            raise CanvasGraphQLError(self._errors, self._data)
+        return self._data
+
+
+class GraphQLClient(object):
+    """Sends GraphQL queries on behalf of the request's user, batching those
+    queued before a result is needed into one request."""
+
+    def __init__(self, request, max_batch_size=MAX_BATCH_SIZE):
+        self.request = request
+        self.max_batch_size = max_batch_size
+        self.client = CanvasClient(request)
+        self._pending = []
+        self._lock = threading.RLock()
+        self._apending = []
+        self._aflush_task = None
+
+    def query(self, document, variables=None):
+        """Queues a query and returns its `GraphQLResult`."""
+        result = GraphQLResult(self, document, variables)
+        with self._lock:
+            self._pending.append(result)
+        return result
+
+    def execute(self, document, variables=None):
+        """Sends the query, along with any others pending, and returns its
+        data."""
+        return self.query(document, variables).data
+
+    def flush(self):
+        """Sends the pending queries."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            for queries in get_batches(pending, self.max_batch_size):
+                self._send(queries)
+
+    def _send(self, queries):
+        metrics.observe('canvas_oauth_graphql_batch_size', len(queries))
+        try:
+            r = self.client.post(GRAPHQL_PATH, json=build_payload(queries))
+            r.raise_for_status()
+            body = r.json()
+        except Exception as e:
+            for query in queries:
+                query.set_exception(e)
+            return
+        if len(queries) > 1 and body.get('data') is None:
+            # The merged document failed as a whole, e.g. because one of the
+            # queries is invalid, so each is sent on its own
+            for query in queries:
+                self._send([query])
+            return
+        resolve(queries, body)
+
+    async def aexecute(self, document, variables=None):
+        """Async version of `execute`.  Queries issued in the same tick of the
+        event loop, e.g. by tasks run with `asyncio.gather`, are sent together.
+        """
+        loop = asyncio.get_running_loop()
+        query = GraphQLResult(self, document, variables)
+        waiter = loop.create_future()
+        self._apending.append((query, waiter))
+        if len(self._apending) == 1:
+            # Sent once the tasks already scheduled have queued their queries
+            loop.call_soon(self._start_aflush)
+        await waiter
+        return query.data
+
+    def _start_aflush(self):
+        self._aflush_task = asyncio.ensure_future(self._aflush())
+
+    async def _aflush(self):
+        pending, self._apending = self._apending, []
+        queries = [query for query, _ in pending]
+        try:
+            try:
+                access_token = await oauth.aget_oauth_token(self.request)
+            except Exception as e:
+                for query in queries:
+                    query.set_exception(e)
+                return
+            token = batch.BatchToken(self.request, access_token)
+            await asyncio.gather(*(self._asend(token, queries)
+                                   for queries in get_batches(queries, self.max_batch_size)))
+        finally:
+            for query, waiter in pending:
+                if waiter.done():
+                    continue
+                if query.done:
+                    waiter.set_result(None)
+                else:
+                    waiter.cancel()
+
+    async def _asend(self, token, queries):
+        metrics.observe('canvas_oauth_graphql_batch_size', len(queries))
+        domain = oauth.get_canvas_domain(self.request)
+        try:
+            r = await batch.send_request(domain, token, 'POST', get_api_url(domain, GRAPHQL_PATH), None,
+                                         {'json': build_payload(queries)})
+            r.raise_for_status()
+            body = r.json()
+        except Exception as e:
+            for query in queries:
+                query.set_exception(e)
+            return
+        if len(queries) > 1 and body.get('data') is None:
+            await asyncio.gather(*(self._asend(token, [query]) for query in queries))
+            return
+        resolve(queries, body)
+
+
+def get_graphql_client(request):
+    """Returns the GraphQL client of the request, so that queries issued
+    anywhere while handling it are batched together."""
+    client = getattr(request, '_canvas_oauth_graphql_client', None)
+    if client is None:
+        client = request._canvas_oauth_graphql_client = GraphQLClient(request)
+    return client
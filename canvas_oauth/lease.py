@@ -0,0 +1,155 @@
+"""
+Token leases for long-running jobs.
+
+A job that holds a token for hours (exports, grade syncs) takes a lease
+instead of calling `get_oauth_token` over and over:
+
+    with canvas_token_lease(user) as lease:
+        for course in courses:
+            call_canvas(course, lease.token)
+
+A background timer refreshes the token ahead of its expiration and swaps
+the new access token in at once, so `lease.token` never blocks on or races
+a refresh.  As in `canvas_oauth.refresh`, there is no session key outside of
+a request, so tokens must be stored as plain text or encrypted with
+CANVAS_OAUTH_ENCRYPTION_KEYS.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from canvas_oauth import crypto, metrics, settings, singleflight, storage
+from canvas_oauth.exceptions import MissingTokenError
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.refresh import refresh_token_grant
+
+logger = logging.getLogger(__name__)
+
+# Leases refresh at least this long before the token expires, even with no
+# CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER, so API calls never see it expire
+MIN_REFRESH_AHEAD = timedelta(minutes=1)
+
+# Seconds to wait before trying again after a background refresh fails
+RETRY_INTERVAL = 30
+
+
+class TokenLease(object):
+    """Holds a user's token for one Canvas domain and keeps it fresh in the
+    background until closed.  `token` is the current access token; `error`
+    is the exception raised by the last background refresh, or None if it
+    succeeded.
+    """
+
+    def __init__(self, oauth_token, cipher=None):
+        self._oauth_token = oauth_token
+        self._cipher = cipher
+        # Replaced as a whole, so readers always see a matching pair
+        self._current = (crypto.decrypt_stored(oauth_token.access_token, cipher), oauth_token.expires)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+        self._closed = False
+        self.error = None
+
+    @property
+    def token(self):
+        return self._current[0]
+
+    @property
+    def expires(self):
+        return self._current[1]
+
+    def refresh_at(self):
+        """Returns when the token will next be refreshed, or None if it does
+        not expire."""
+        if self.expires is None:
+            return None
+        buffer = max(settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER, MIN_REFRESH_AHEAD)
+        return self.expires - buffer
+
+    def start(self):
+        """Refreshes the token now if it is about to expire, then schedules
+        the background refresh."""
+        refresh_at = self.refresh_at()
+        if refresh_at is not None and refresh_at <= timezone.now():
+            self.refresh()
+        self._schedule_next()
+        return self
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def refresh(self):
+        """Refreshes the token and swaps the new access token in.  If
+        CANVAS_OAUTH_REFRESH_LOCK is set, a refresh of the same token by
+        another process or request is reused instead.
+        """
+        with self._refresh_lock, metrics.timer('canvas_oauth_refresh_seconds'):
+            if settings.CANVAS_OAUTH_REFRESH_LOCK:
+                oauth_token = singleflight.refresh(self._oauth_token, self._refresh)
+            else:
+                oauth_token = self._refresh(self._oauth_token)
+            self._oauth_token = oauth_token
+            self._current = (crypto.decrypt_stored(oauth_token.access_token, self._cipher), oauth_token.expires)
+        logger.info("Refreshed leased token for user %s", oauth_token.user_id)
+
+    def _refresh(self, oauth_token):
+        refresh_token_grant(oauth_token, self._cipher)
+        storage.get_storage().update(oauth_token)
+        return oauth_token
+
+    def _schedule_next(self):
+        refresh_at = self.refresh_at()
+        if refresh_at is not None:
+            self._schedule((refresh_at - timezone.now()).total_seconds())
+
+    def _schedule(self, delay):
+        with self._lock:
+            if self._closed:
+                return
+            self._timer = threading.Timer(max(delay, 0), self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning("Unable to refresh leased token for user %s: %s",
+                           self._oauth_token.user_id, e)
+            self.error = e
+            self._schedule(RETRY_INTERVAL)
+        else:
+            self.error = None
+            self._schedule_next()
+        finally:
+            # Timer threads are not reused, so do not leave a connection open
+            connection.close()
+
+
+@contextmanager
+def canvas_token_lease(user_or_id, domain=None):
+    """Leases the user's token for the given Canvas domain (by default
+    CANVAS_OAUTH_CANVAS_DOMAIN) for the duration of the block.  Raises
+    MissingTokenError if the user has no token.
+    """
+    user_id = getattr(user_or_id, 'pk', user_or_id)
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    try:
+        oauth_token = storage.get_storage().get(user_id, domain)
+    except CanvasOAuth2Token.DoesNotExist:
+        raise MissingTokenError("No token found for user %s" % user_id)
+
+    lease = TokenLease(oauth_token, crypto.get_cipher()).start()
+    try:
+        yield lease
+    finally:
+        lease.close()
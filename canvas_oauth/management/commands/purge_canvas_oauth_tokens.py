@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from canvas_oauth.models import CanvasOAuth2Token
+
+
+class Command(BaseCommand):
+    help = ("Deletes tokens that have not been refreshed on behalf of a user within --days days. "
+            "Access tokens are short-lived, so a token that is still in use is refreshed at least "
+            "once per token lifetime.  Stale tokens are deleted --batch-size at a time in primary key "
+            "order, pausing --sleep seconds between batches so locks are never held for long.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=180,
+                            help="Delete tokens not refreshed within this many days.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of tokens deleted per batch.")
+        parser.add_argument('--sleep', type=float, default=0.5,
+                            help="Seconds to pause between batches.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count the tokens that would be deleted without deleting them.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        stale_tokens = CanvasOAuth2Token.objects.filter(updated_on__lt=cutoff)
+
+        if options['dry_run']:
+            self.stdout.write("%d tokens not refreshed since %s would be deleted." % (
+                stale_tokens.count(), cutoff.isoformat()))
+            return
+
+        deleted = 0
+        started = time.monotonic()
+        last_pk = None
+        while True:
+            # Walk the stale tokens themselves in primary key order, so gaps in
+            # the keys cost nothing
+            batch = stale_tokens.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:options['batch_size']])
+            if not pks:
+                break
+            # Every batch scanned the table, even one whose tokens were all
+            # refreshed before they could be deleted
+            if last_pk is not None and options['sleep']:
+                time.sleep(options['sleep'])
+            # Tokens refreshed since they were selected are kept
+            count, _ = stale_tokens.filter(pk__in=pks).delete()
+            last_pk = pks[-1]
+            deleted += count
+            self.stdout.write("Deleted %d tokens through id %d (%.1f rows/sec)" % (
+                deleted, last_pk, self.get_rate(deleted, started)))
+
+        self.stdout.write(self.style.SUCCESS("Deleted %d tokens (%.1f rows/sec)." % (
+            deleted, self.get_rate(deleted, started))))
+
+    def get_rate(self, deleted, started):
+        elapsed = time.monotonic() - started
+        return deleted / elapsed if elapsed else 0.0
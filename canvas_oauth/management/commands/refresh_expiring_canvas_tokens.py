@@ -0,0 +1,85 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from canvas_oauth import storage
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.refresh import refresh_tokens, write_tokens
+
+
+class Command(BaseCommand):
+    help = ("Refreshes tokens that expire within --window seconds, so that requests do not "
+            "have to.  Only tokens refreshed on behalf of a user within --active-within hours "
+            "are kept alive; refreshes made by this command do not count as activity.  Tokens "
+            "must be stored as plain text or encrypted with CANVAS_OAUTH_ENCRYPTION_KEYS.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=600,
+                            help="Refresh tokens expiring within this many seconds.")
+        parser.add_argument('--active-within', type=int, default=24,
+                            help="Only refresh tokens last refreshed for a user within this many hours.")
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Maximum number of concurrent refresh requests.")
+        parser.add_argument('--jitter', type=float, default=5,
+                            help="Delay each refresh by a random number of seconds up to this.")
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Tokens refreshed and written back per batch.")
+        parser.add_argument('--daemon', action='store_true',
+                            help="Keep running, checking for expiring tokens every --interval seconds.")
+        parser.add_argument('--interval', type=int, default=60,
+                            help="Seconds between checks in daemon mode.")
+
+    def handle(self, *args, **options):
+        if not options['daemon']:
+            self.refresh_expiring(options)
+            return
+        try:
+            while True:
+                # Drop connections that went stale or broke while sleeping
+                close_old_connections()
+                self.refresh_expiring(options)
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+    def refresh_expiring(self, options):
+        now = timezone.now()
+        # Uses the index on `expires`.  Tokens that have already expired, e.g.
+        # while the command was not running, are refreshed first.
+        tokens = (CanvasOAuth2Token.objects
+                  .filter(expires__lte=now + timedelta(seconds=options['window']),
+                          updated_on__gte=now - timedelta(hours=options['active_within']))
+                  .order_by('expires'))
+
+        self.counts = {'refreshed': 0, 'failed': 0, 'skipped': 0}
+        started = time.monotonic()
+        batch = []
+        for oauth_token in tokens.iterator(chunk_size=options['batch_size']):
+            batch.append(oauth_token)
+            if len(batch) >= options['batch_size']:
+                self.refresh_batch(batch, options)
+                batch = []
+        if batch:
+            self.refresh_batch(batch, options)
+
+        elapsed = time.monotonic() - started
+        total = sum(self.counts.values())
+        self.stdout.write("Refreshed %d tokens, %d failed, %d skipped (%.1f tokens/sec)" % (
+            self.counts['refreshed'], self.counts['failed'], self.counts['skipped'],
+            total / elapsed if elapsed else 0.0))
+
+    def refresh_batch(self, batch, options):
+        stored_access_tokens = {storage.get_key(oauth_token): oauth_token.access_token for oauth_token in batch}
+        refreshed = []
+        for oauth_token, error in refresh_tokens(batch, options['workers'], options['jitter']):
+            if error is None:
+                refreshed.append(oauth_token)
+            else:
+                self.counts['failed'] += 1
+        # `updated_on` is deliberately left alone so it keeps recording user activity
+        written = write_tokens(refreshed, ['access_token', 'refresh_token', 'expires'], stored_access_tokens)
+        self.counts['refreshed'] += len(written)
+        self.counts['skipped'] += len(refreshed) - len(written)
@@ -0,0 +1,79 @@
+import time
+
+from cryptography.fernet import InvalidToken
+from django.core.management.base import BaseCommand, CommandError
+
+from canvas_oauth import crypto, storage
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.refresh import write_tokens
+
+
+class Command(BaseCommand):
+    help = ("Re-encrypts stored tokens with the first key in CANVAS_OAUTH_ENCRYPTION_KEYS. "
+            "The table is streamed and updated in batches, and the command can be resumed "
+            "with --start-after using the last id it reported.  Tokens that cannot be "
+            "decrypted with the keyring, or that are refreshed during the run, are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="Rows fetched from the database at a time.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Rows written back per transaction.")
+        parser.add_argument('--start-after', type=int, default=0,
+                            help="Only rotate tokens with an id greater than this.")
+        parser.add_argument('--encrypt-plaintext', action='store_true',
+                            help="Encrypt tokens that are stored as plain text.")
+
+    def handle(self, *args, **options):
+        keyring = crypto.get_keyring()
+        if keyring is None:
+            raise CommandError("CANVAS_OAUTH_ENCRYPTION_KEYS is not set.")
+        self.keyring = keyring
+        self.encrypt_plaintext = options['encrypt_plaintext']
+
+        tokens = (CanvasOAuth2Token.objects
+                  .filter(pk__gt=options['start_after'])
+                  .order_by('pk')
+                  .only('pk', 'user_id', 'domain', 'access_token', 'refresh_token'))
+
+        self.rotated = self.skipped = 0
+        self.started = time.monotonic()
+        batch = {}
+        for oauth_token in tokens.iterator(chunk_size=options['chunk_size']):
+            stored_access_token = oauth_token.access_token
+            try:
+                oauth_token.access_token = self.rotate(oauth_token.access_token)
+                oauth_token.refresh_token = self.rotate(oauth_token.refresh_token)
+            except InvalidToken:
+                self.skipped += 1
+                continue
+            batch[oauth_token] = stored_access_token
+            if len(batch) >= options['batch_size']:
+                self.write_batch(batch)
+                batch = {}
+        if batch:
+            self.write_batch(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            "Rotated %d tokens and skipped %d (%.1f rows/sec)." % (
+                self.rotated, self.skipped, self.get_rate())))
+
+    def rotate(self, value):
+        if not crypto.is_encrypted(value):
+            if not self.encrypt_plaintext:
+                raise InvalidToken
+            return crypto.encrypt(value, self.keyring)
+        return self.keyring.rotate(value.encode()).decode()
+
+    def write_batch(self, batch):
+        tokens = list(batch)
+        written = write_tokens(tokens, ['access_token', 'refresh_token'],
+                               {storage.get_key(oauth_token): stored for oauth_token, stored in batch.items()})
+        self.rotated += len(written)
+        self.skipped += len(tokens) - len(written)
+        self.stdout.write("Rotated %d tokens through id %d (%.1f rows/sec)" % (
+            self.rotated, tokens[-1].pk, self.get_rate()))
+
+    def get_rate(self):
+        elapsed = time.monotonic() - self.started
+        return (self.rotated + self.skipped) / elapsed if elapsed else 0.0
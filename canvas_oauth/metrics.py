@@ -0,0 +1,173 @@
+"""
+Pluggable metrics for token lookups, refreshes, Canvas requests, callbacks
+and middleware redirects.
+
+The backend is chosen with the CANVAS_OAUTH_METRICS_BACKEND setting, a dotted
+path to a class.  By default metrics are disabled and every call returns
+straight away.  `InMemoryBackend` keeps counters and histograms in memory,
+e.g. for tests, and `PrometheusBackend` also renders them in the Prometheus
+text format for `metrics_view`.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.http import HttpResponse, HttpResponseNotFound
+from django.utils.module_loading import import_string
+
+from canvas_oauth import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class NoOpBackend(object):
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class InMemoryBackend(object):
+    """Keeps counters and histograms in memory.  Thread-safe."""
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'count': 0, 'sum': 0.0, 'buckets': [0] * len(self.buckets)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+
+    def get_counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_histogram(self, name, **labels):
+        """Returns the count, sum and (non-cumulative) bucket counts of the
+        histogram, or None if nothing was observed."""
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class PrometheusBackend(InMemoryBackend):
+    """An in-memory backend that renders the Prometheus text format."""
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value['buckets'])))
+                                for key, value in self.histograms.items())
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE %s counter" % name)
+            lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE %s histogram" % name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    name, _format_labels(labels + (('le', _format_value(bound)),)), cumulative))
+            lines.append("%s_bucket%s %d" % (name, _format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(histogram['sum'])))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), histogram['count']))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                          .replace('\n', r'\n'))
+                             for key, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_backend = NoOpBackend()
+_backend_path = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the configured backend, instantiated once per process."""
+    global _backend, _backend_path
+    path = settings.CANVAS_OAUTH_METRICS_BACKEND
+    if path != _backend_path:
+        with _backend_lock:
+            if path != _backend_path:
+                _backend = import_string(path)() if path else NoOpBackend()
+                _backend_path = path
+    return _backend
+
+
+def increment(name, value=1, **labels):
+    backend = get_backend()
+    if backend.enabled:
+        backend.increment(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    backend = get_backend()
+    if backend.enabled:
+        backend.observe(name, value, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observes the duration of the block in the named histogram.  The block
+    may add labels to the yielded dict; `result` defaults to 'success', or
+    'error' if the block raises.
+    """
+    backend = get_backend()
+    if not backend.enabled:
+        yield labels
+        return
+    started = time.perf_counter()
+    try:
+        yield labels
+    except BaseException:
+        labels.setdefault('result', 'error')
+        raise
+    finally:
+        labels.setdefault('result', 'success')
+        backend.observe(name, time.perf_counter() - started, **labels)
+
+
+def metrics_view(request):
+    """Exposes the metrics in the Prometheus text format."""
+    backend = get_backend()
+    if not hasattr(backend, 'render'):
+        return HttpResponseNotFound("Metrics are not enabled")
+    return HttpResponse(backend.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
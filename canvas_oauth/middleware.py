@@ -1,25 +1,58 @@
-from canvas_oauth.exceptions import (MissingTokenError, InvalidOAuthTimeoutError, CanvasOAuthError)
-from canvas_oauth.oauth import (handle_missing_token, render_oauth_error)
+from canvas_oauth.exceptions import (MissingTokenError, CanvasUnavailableError, CanvasOAuthError)
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.functional import lazy
+
+from canvas_oauth import metrics
+from canvas_oauth.oauth import (
+    aget_oauth_token, get_canvas_domain, get_oauth_token, handle_missing_token, render_oauth_error)
 
 
 class OAuthMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Evaluated on use, e.g. str(request.canvas_oauth_token); the token is
+        # only looked up and decrypted once per request, but is still refreshed
+        # if it expires while the request is being handled.
+        request.canvas_oauth_token = lazy(lambda: get_oauth_token(request), str)()
         response = self.get_response(request)
         return response
 
+    async def __acall__(self, request):
+        # The lazy token would query the database synchronously when used, which
+        # is not allowed in async code, so async views get a coroutine instead:
+        # `await request.acanvas_oauth_token()`.
+        request.acanvas_oauth_token = lambda: aget_oauth_token(request)
+        response = await self.get_response(request)
+        return response
+
     """On catching a MissingTokenError - as is raised by the get_token function
     if there is no saved token for the user - this begins the oauth dance with
-    canvas to get a new token.  For other CanvasOAuthErrors, an error page with
-    the exception text is rendered."""
+    canvas to get a new token.  If Canvas is unavailable, the token is kept and
+    an error page is rendered with a 503 status.  For other CanvasOAuthErrors,
+    an error page with the exception text is rendered."""
     def process_exception(self, request, exception):
         if isinstance(exception, MissingTokenError):
+            _count_redirect(request, 'missing_token')
             return handle_missing_token(request)
-        if isinstance(exception, InvalidOAuthTimeoutError):
-            request.user.canvas_oauth2_token.delete()
-            return handle_missing_token(request)
+        if isinstance(exception, CanvasUnavailableError):
+            metrics.increment('canvas_oauth_middleware_errors_total', error=type(exception).__name__)
+            return render_oauth_error(str(exception), status=503)
         elif isinstance(exception, CanvasOAuthError):
+            metrics.increment('canvas_oauth_middleware_errors_total', error=type(exception).__name__)
             return render_oauth_error(str(exception))
         return
+
+
+def _count_redirect(request, reason):
+    if metrics.get_backend().enabled:
+        metrics.increment('canvas_oauth_middleware_redirects_total',
+                          reason=reason, domain=get_canvas_domain(request))
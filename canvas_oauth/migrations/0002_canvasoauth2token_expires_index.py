@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-16 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_oauth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='canvasoauth2token',
+            options={'verbose_name': 'Canvas OAuth2 Token', 'verbose_name_plural': 'Canvas OAuth2 Tokens'},
+        ),
+        migrations.AlterField(
+            model_name='canvasoauth2token',
+            name='expires',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:04
+
+import canvas_oauth.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('canvas_oauth', '0002_canvasoauth2token_expires_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='canvasoauth2token',
+            name='domain',
+            # Existing tokens were granted by CANVAS_OAUTH_CANVAS_DOMAIN
+            field=models.CharField(default=canvas_oauth.models.get_default_domain, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='canvasoauth2token',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='canvas_oauth2_tokens', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='canvasoauth2token',
+            constraint=models.UniqueConstraint(fields=('user', 'domain'), name='canvas_oauth_token_user_domain'),
+        ),
+    ]
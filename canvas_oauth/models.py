@@ -5,6 +5,10 @@ from django.conf import settings
 from django.utils import timezone
 
 
+def get_default_domain():
+    return getattr(settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', '')
+
+
 class CanvasOAuth2Token(models.Model):
     """
     A CanvasOAuth2Token instance represents the access token
@@ -15,22 +19,29 @@ class CanvasOAuth2Token(models.Model):
     they expire.
     Fields:
     * :attr:`user` The Django user representing resources' owner
+    * :attr:`domain` The Canvas domain the token was granted by, by default
+        `CANVAS_OAUTH_CANVAS_DOMAIN`; a user has at most one token per domain
     * :attr:`access_token` Access token
     * :attr:`refresh_token` Refresh token
     * :attr:`expires` Date and time of token expiration, in DateTime format
     * :attr:`created_on` When the initial access token was granted,
         in DateTime format
     * :attr:`updated_on` When the token was refreshed (or first created), in
-        DateTime format
+        DateTime format.  Proactive refreshes made by the
+        `refresh_expiring_canvas_tokens` command are not recorded, so this
+        reflects the user's last activity.
     """
-    user = models.OneToOneField(
+    user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
-        related_name='canvas_oauth2_token',
+        related_name='canvas_oauth2_tokens',
+        # Covered by the (user, domain) unique index
+        db_index=False,
     )
+    domain = models.CharField(max_length=255, default=get_default_domain)
     access_token = models.TextField()
     refresh_token = models.TextField()
-    expires = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
@@ -47,8 +58,19 @@ class CanvasOAuth2Token(models.Model):
         return self.expires - timezone.now() <= delta
 
     def __str__(self):
-        return "CanvasOAuth2Token:%s" % self.user
+        return "CanvasOAuth2Token:%s@%s" % (self.user, self.domain)
 
     class Meta:
         verbose_name = "Canvas OAuth2 Token"
         verbose_name_plural = "Canvas OAuth2 Tokens"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'domain'], name='canvas_oauth_token_user_domain'),
+        ]
+
+
+def get_default_token(user):
+    """Returns the user's token for `CANVAS_OAUTH_CANVAS_DOMAIN`, raising
+    `CanvasOAuth2Token.DoesNotExist` if there is none.  Installed as
+    `user.canvas_oauth2_token`, the accessor of the one-to-one relation
+    tokens had before they were stored per domain."""
+    return user.canvas_oauth2_tokens.get(domain=get_default_domain())
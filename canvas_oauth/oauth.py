@@ -1,22 +1,35 @@
 import logging
 
-from cryptography.fernet import Fernet
-
+from asgiref.sync import sync_to_async
 from django.urls import reverse
 from django.http.response import HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect
 from django.template import loader
 from django.template.exceptions import TemplateDoesNotExist
 from django.utils.crypto import get_random_string
+from django.utils.functional import LazyObject, empty
 
-from canvas_oauth import (canvas, settings)
+from canvas_oauth import (canvas, crypto, metrics, settings, singleflight, storage, token_cache, tracing)
 from canvas_oauth.models import CanvasOAuth2Token
 from canvas_oauth.exceptions import (
-    MissingTokenError, InvalidOAuthStateError)
+    CanvasOAuthError, MissingTokenError, InvalidOAuthStateError)
 
 logger = logging.getLogger(__name__)
 
 
+def get_canvas_domain(request):
+    """Returns the Canvas domain for the request: a domain set on the request
+    itself takes precedence over one stored in the session, which takes
+    precedence over the CANVAS_OAUTH_CANVAS_DOMAIN setting.
+    """
+    if hasattr(request, 'canvas_oauth_canvas_domain'):
+        return request.canvas_oauth_canvas_domain
+    elif 'canvas_oauth_canvas_domain' in request.session:
+        return request.session["canvas_oauth_canvas_domain"]
+    return settings.CANVAS_OAUTH_CANVAS_DOMAIN
+
+
+@tracing.traced('canvas_oauth.get_oauth_token')
 def get_oauth_token(request):
     """Retrieve a stored Canvas OAuth2 access token from Canvas for the
     currently logged in user.  If the token has expired (or has exceeded an
@@ -28,29 +41,57 @@ def get_oauth_token(request):
     will be handled by the middleware component of this library with a call to
     handle_missing_token.  If this happens outside of a view, then the user must
     be directed by other means to the Canvas site in order to authorize a token.
+
+    Tokens are kept per Canvas domain, as returned by `get_canvas_domain`.  The
+    token is memoized on the request, so repeated calls within a request only
+    re-check its expiration.
     """
-    try:
-        oauth_token = request.user.canvas_oauth2_token
-        logger.info("Token found for user %s" % request.user.pk)
-    except CanvasOAuth2Token.DoesNotExist:
-        """ If this exception is raised by a view function and not caught,
-        it is probably because the oauth_middleware is not installed, since it
-        is supposed to catch this error."""
-        logger.info("No token found for user %s" % request.user.pk)
-        raise MissingTokenError("No token found for user %s" % request.user.pk)
+    buffer = settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+    domain = get_canvas_domain(request)
+    memo = getattr(request, '_canvas_oauth_token_memo', None)
+    if memo is not None and memo[0].domain == domain:
+        oauth_token, access_token = memo
+        if not oauth_token.expires_within(buffer):
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='memoized')
+            tracing.set_attribute('canvas_oauth.cache_hit', True)
+            return access_token
+    else:
+        tracing.set_attribute('canvas_oauth.cache_hit', False)
+        user_id = request.user.pk
+        token_storage = storage.get_storage()
+        try:
+            if settings.CANVAS_OAUTH_TOKEN_CACHE:
+                oauth_token = token_cache.get_token(
+                    user_id, domain, lambda: token_storage.get(user_id, domain))
+            else:
+                oauth_token = token_storage.get(user_id, domain)
+            logger.info("Token found for user %s" % user_id)
+        except CanvasOAuth2Token.DoesNotExist:
+            """ If this exception is raised by a view function and not caught,
+            it is probably because the oauth_middleware is not installed, since it
+            is supposed to catch this error."""
+            logger.info("No token found for user %s" % user_id)
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='missing')
+            raise MissingTokenError("No token found for user %s" % user_id)
 
     # Check to see if we're within the expiration threshold of the access token
-    if oauth_token.expires_within(settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER):
+    outcome = 'found'
+    if oauth_token.expires_within(buffer):
         logger.info("Refreshing token for user %s" % request.user.pk)
-        oauth_token = refresh_oauth_token(request)
+        oauth_token = refresh_oauth_token(request, oauth_token)
+        outcome = 'refreshed'
+    metrics.increment('canvas_oauth_token_lookups_total', outcome=outcome)
+    if tracing.is_recording():
+        tracing.set_attribute('canvas_oauth.domain', domain)
+        tracing.set_attribute('canvas_oauth.encrypted', crypto.is_encrypted(oauth_token.access_token))
 
-    if 'canvas_oauth_token_key' in request.session:
-        fernet = Fernet(request.session['canvas_oauth_token_key'])
-        return fernet.decrypt(oauth_token.access_token.encode()).decode()
-    else:
-        return oauth_token.access_token
+    access_token = crypto.decrypt(oauth_token.access_token, crypto.get_cipher(request))
+
+    request._canvas_oauth_token_memo = (oauth_token, access_token)
+    return access_token
 
 
+@tracing.traced('canvas_oauth.handle_missing_token')
 def handle_missing_token(request):
     """
     Redirect user to canvas with a request for token.
@@ -61,7 +102,7 @@ def handle_missing_token(request):
 
     # The request state is a recommended security check on the callback, so
     # store in session for later
-    oauth_request_state = get_random_string()
+    oauth_request_state = get_random_string(32)
     request.session["canvas_oauth_request_state"] = oauth_request_state
 
     # The return URI is required to be the same when POSTing to generate
@@ -70,14 +111,11 @@ def handle_missing_token(request):
     oauth_redirect_uri = request.build_absolute_uri(reverse('canvas-oauth-callback'))
     request.session["canvas_oauth_redirect_uri"] = oauth_redirect_uri
 
-    if hasattr(request, 'canvas_oauth_canvas_domain'):
-        domain = request.canvas_oauth_canvas_domain
-    elif 'canvas_oauth_canvas_domain' in request.session:
-        domain = request.session["canvas_oauth_canvas_domain"]
-    else:
-        domain = settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    domain = get_canvas_domain(request)
+    tracing.set_attribute('canvas_oauth.domain', domain)
+    client_id, _ = settings.get_developer_key(domain)
     authorize_url = canvas.get_oauth_login_url(
-        settings.CANVAS_OAUTH_CLIENT_ID,
+        client_id,
         domain=domain,
         redirect_uri=oauth_redirect_uri,
         state=oauth_request_state,
@@ -87,107 +125,262 @@ def handle_missing_token(request):
     return HttpResponseRedirect(authorize_url)
 
 
+@tracing.traced('canvas_oauth.oauth_callback')
 def oauth_callback(request):
-    """ Receives the callback from canvas and saves the token to the database.
+    """ Receives the callback from canvas and saves the token to storage.
         Redirects user to the page they came from at the start of the oauth
         procedure. """
     error = request.GET.get('error')
     if error:
+        metrics.increment('canvas_oauth_callbacks_total', result='denied')
         return render_oauth_error(error)
-    code = request.GET.get('code')
-    state = request.GET.get('state')
+    try:
+        code = _get_callback_code(request)
+
+        # Make the `authorization_code` grant type request to retrieve a
+        grant = _get_callback_grant(request, code)
+        access_token, expires, refresh_token = canvas.get_access_token(**grant)
+    except CanvasOAuthError as e:
+        metrics.increment('canvas_oauth_callbacks_total', result='error', error=type(e).__name__)
+        raise
+
+    cipher = crypto.get_cipher(request)
+    obj = storage.get_storage().put(CanvasOAuth2Token(
+        user_id=request.user.pk,
+        domain=grant['domain'],
+        access_token=crypto.encrypt(access_token, cipher),
+        expires=expires,
+        refresh_token=crypto.encrypt(refresh_token, cipher)))
+    logger.info("CanvasOAuth2Token stored for user %s" % obj.user_id)
+    metrics.increment('canvas_oauth_callbacks_total', result='success')
 
+    initial_uri = request.session['canvas_oauth_initial_uri']
+    logger.info("Redirecting user back to initial uri %s" % initial_uri)
+
+    return redirect(initial_uri)
+
+
+@tracing.traced('canvas_oauth.oauth_callback')
+async def aoauth_callback(request):
+    """ Async version of `oauth_callback`, for projects served over ASGI. """
+    error = request.GET.get('error')
+    if error:
+        metrics.increment('canvas_oauth_callbacks_total', result='denied')
+        return render_oauth_error(error)
+    await _aload_session(request)
+    try:
+        code = _get_callback_code(request)
+
+        grant = _get_callback_grant(request, code)
+        access_token, expires, refresh_token = await canvas.aget_access_token(**grant)
+    except CanvasOAuthError as e:
+        metrics.increment('canvas_oauth_callbacks_total', result='error', error=type(e).__name__)
+        raise
+
+    cipher = crypto.get_cipher(request)
+    user = await _aget_user(request)
+    obj = await storage.get_storage().aput(CanvasOAuth2Token(
+        user_id=user.pk,
+        domain=grant['domain'],
+        access_token=crypto.encrypt(access_token, cipher),
+        expires=expires,
+        refresh_token=crypto.encrypt(refresh_token, cipher)))
+    logger.info("CanvasOAuth2Token stored for user %s" % obj.user_id)
+    metrics.increment('canvas_oauth_callbacks_total', result='success')
+
+    initial_uri = request.session['canvas_oauth_initial_uri']
+    logger.info("Redirecting user back to initial uri %s" % initial_uri)
+
+    return redirect(initial_uri)
+
+
+def _get_callback_code(request):
+    state = request.GET.get('state')
     if state != request.session['canvas_oauth_request_state']:
         logger.warning("OAuth state mismatch for request: %s" % request.get_full_path())
         raise InvalidOAuthStateError("OAuth state mismatch!")
+    return request.GET.get('code')
 
-    if hasattr(request, 'canvas_oauth_canvas_domain'):
-        domain = request.canvas_oauth_canvas_domain
-    elif 'canvas_oauth_canvas_domain' in request.session:
-        domain = request.session["canvas_oauth_canvas_domain"]
-    else:
-        domain = settings.CANVAS_OAUTH_CANVAS_DOMAIN
 
-    # Make the `authorization_code` grant type request to retrieve a
-    access_token, expires, refresh_token = canvas.get_access_token(
+def _get_callback_grant(request, code):
+    domain = get_canvas_domain(request)
+    client_id, client_secret = settings.get_developer_key(domain)
+    return dict(
         domain=domain,
         grant_type='authorization_code',
-        client_id=settings.CANVAS_OAUTH_CLIENT_ID,
-        client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+        client_id=client_id,
+        client_secret=client_secret,
         redirect_uri=request.session["canvas_oauth_redirect_uri"],
         code=code)
 
-    if 'canvas_oauth_token_key' in request.session:
-        fernet = Fernet(request.session['canvas_oauth_token_key'])
-        obj = CanvasOAuth2Token.objects.create(
-            user=request.user,
-            access_token=fernet.encrypt(access_token.encode()).decode(),
-            expires=expires,
-            refresh_token=fernet.encrypt(refresh_token.encode()).decode())
-    else:
-        obj = CanvasOAuth2Token.objects.create(
-            user=request.user,
-            access_token=access_token,
-            expires=expires,
-            refresh_token=refresh_token)
-    logger.info("CanvasOAuth2Token instance created: %s" % obj.pk)
-
-    initial_uri = request.session['canvas_oauth_initial_uri']
-    logger.info("Redirecting user back to initial uri %s" % initial_uri)
-
-    return redirect(initial_uri)
-
 
-def refresh_oauth_token(request):
+@tracing.traced('canvas_oauth.refresh_oauth_token')
+def refresh_oauth_token(request, oauth_token=None):
     """ Makes refresh_token grant request with Canvas to get a fresh
     access token.  Update the oauth token model with the new token
     and new expiration date and return the saved model.
-    """
-    oauth_token = request.user.canvas_oauth2_token
 
-    if 'canvas_oauth_token_key' in request.session:
-        fernet = Fernet(request.session['canvas_oauth_token_key'])
-        refresh_bytes = oauth_token.refresh_token.encode()
-        refresh_token = fernet.decrypt(refresh_bytes).decode()
-    else:
-        refresh_token = oauth_token.refresh_token
+    Refreshes the given token, or else the user's token for the request's
+    Canvas domain.
 
+    If CANVAS_OAUTH_REFRESH_LOCK is set, concurrent refreshes of the same
+    token are coalesced so that only one grant request reaches Canvas.
+    """
+    with metrics.timer('canvas_oauth_refresh_seconds'):
+        request.__dict__.pop('_canvas_oauth_token_memo', None)
+        if oauth_token is None:
+            oauth_token = storage.get_storage().get(request.user.pk, get_canvas_domain(request))
+        if settings.CANVAS_OAUTH_REFRESH_LOCK:
+            return singleflight.refresh(
+                oauth_token, lambda token: _refresh_oauth_token(request, token))
+        return _refresh_oauth_token(request, oauth_token)
 
-    if hasattr(request, 'canvas_oauth_canvas_domain'):
-        domain = request.canvas_oauth_canvas_domain
-    elif 'canvas_oauth_canvas_domain' in request.session:
-        domain = request.session["canvas_oauth_canvas_domain"]
-    else:
-        domain = settings.CANVAS_OAUTH_CANVAS_DOMAIN
+
+def _refresh_oauth_token(request, oauth_token):
+    cipher = crypto.get_cipher(request)
+    refresh_token = crypto.decrypt(oauth_token.refresh_token, cipher)
 
     # Get the new access token and expiration date via
     # a refresh token grant
     access_token, oauth_token.expires, _ = canvas.get_access_token(
+        **_get_refresh_grant(request, oauth_token.domain, refresh_token))
+
+    # Update the model with new token and expiration.  The refresh token is
+    # re-encrypted too, so tokens move to the current encryption key.
+    oauth_token.access_token = crypto.encrypt(access_token, cipher)
+    oauth_token.refresh_token = crypto.encrypt(refresh_token, cipher)
+    storage.get_storage().update(oauth_token)
+
+    return oauth_token
+
+
+def _get_refresh_grant(request, domain, refresh_token):
+    client_id, client_secret = settings.get_developer_key(domain)
+    return dict(
         domain=domain,
         grant_type='refresh_token',
-        client_id=settings.CANVAS_OAUTH_CLIENT_ID,
-        client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+        client_id=client_id,
+        client_secret=client_secret,
         redirect_uri=request.build_absolute_uri(
             reverse('canvas-oauth-callback')),
         refresh_token=refresh_token)
 
-    # Update the model with new token and expiration
-    if 'canvas_oauth_token_key' in request.session:
-        access_token = fernet.encrypt(access_token.encode()).decode()
-    oauth_token.access_token = access_token
-    oauth_token.save()
+
+@tracing.traced('canvas_oauth.get_oauth_token')
+async def aget_oauth_token(request):
+    """Async version of `get_oauth_token`.  The token is looked up through the
+    storage's async methods and refreshed with a non-blocking HTTP client, so async views do
+    not tie up a worker thread while waiting on Canvas.
+    """
+    buffer = settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+    await _aload_session(request)
+    domain = get_canvas_domain(request)
+    memo = getattr(request, '_canvas_oauth_token_memo', None)
+    if memo is not None and memo[0].domain == domain:
+        oauth_token, access_token = memo
+        if not oauth_token.expires_within(buffer):
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='memoized')
+            tracing.set_attribute('canvas_oauth.cache_hit', True)
+            return access_token
+    else:
+        tracing.set_attribute('canvas_oauth.cache_hit', False)
+        user = await _aget_user(request)
+        token_storage = storage.get_storage()
+        try:
+            if settings.CANVAS_OAUTH_TOKEN_CACHE:
+                oauth_token = await token_cache.aget_token(
+                    user.pk, domain, lambda: token_storage.aget(user.pk, domain))
+            else:
+                oauth_token = await token_storage.aget(user.pk, domain)
+            logger.info("Token found for user %s" % user.pk)
+        except CanvasOAuth2Token.DoesNotExist:
+            logger.info("No token found for user %s" % user.pk)
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='missing')
+            raise MissingTokenError("No token found for user %s" % user.pk)
+
+    outcome = 'found'
+    if oauth_token.expires_within(buffer):
+        logger.info("Refreshing token for user %s" % oauth_token.user_id)
+        oauth_token = await arefresh_oauth_token(request, oauth_token)
+        outcome = 'refreshed'
+    metrics.increment('canvas_oauth_token_lookups_total', outcome=outcome)
+
+    if tracing.is_recording():
+        tracing.set_attribute('canvas_oauth.domain', domain)
+        tracing.set_attribute('canvas_oauth.encrypted', crypto.is_encrypted(oauth_token.access_token))
+    access_token = crypto.decrypt(oauth_token.access_token, crypto.get_cipher(request))
+
+    request._canvas_oauth_token_memo = (oauth_token, access_token)
+    return access_token
+
+
+@tracing.traced('canvas_oauth.refresh_oauth_token')
+async def arefresh_oauth_token(request, oauth_token=None):
+    """Async version of `refresh_oauth_token`.  With the 'database' refresh
+    lock, the refresh runs synchronously in a thread, since row locks need a
+    transaction that the async ORM cannot hold.
+    """
+    await _aload_session(request)
+    if settings.CANVAS_OAUTH_REFRESH_LOCK == 'database':
+        return await sync_to_async(refresh_oauth_token)(request, oauth_token)
+
+    with metrics.timer('canvas_oauth_refresh_seconds'):
+        request.__dict__.pop('_canvas_oauth_token_memo', None)
+        if oauth_token is None:
+            user = await _aget_user(request)
+            oauth_token = await storage.get_storage().aget(user.pk, get_canvas_domain(request))
+        if settings.CANVAS_OAUTH_REFRESH_LOCK:
+            return await singleflight.arefresh(
+                oauth_token, lambda token: _arefresh_oauth_token(request, token))
+        return await _arefresh_oauth_token(request, oauth_token)
+
+
+async def _arefresh_oauth_token(request, oauth_token):
+    cipher = crypto.get_cipher(request)
+    refresh_token = crypto.decrypt(oauth_token.refresh_token, cipher)
+
+    access_token, oauth_token.expires, _ = await canvas.aget_access_token(
+        **_get_refresh_grant(request, oauth_token.domain, refresh_token))
+
+    oauth_token.access_token = crypto.encrypt(access_token, cipher)
+    oauth_token.refresh_token = crypto.encrypt(refresh_token, cipher)
+    await storage.get_storage().aupdate(oauth_token)
 
     return oauth_token
 
 
-def render_oauth_error(error_message):
+async def _aget_user(request):
+    """Returns the request's user, loading it without blocking the event
+    loop if the authentication middleware has not done so yet.
+    """
+    if hasattr(request, 'auser'):
+        return await request.auser()
+    user = request.user
+    if isinstance(user, LazyObject) and user._wrapped is empty:
+        # Evaluating the lazy user would query the database synchronously
+        await sync_to_async(lambda: user.pk)()
+    return user
+
+
+async def _aload_session(request):
+    """Loads the session without blocking the event loop, so that it can then
+    be read synchronously.
+    """
+    session = request.session
+    if hasattr(session, 'ahas_key'):
+        await session.ahas_key(crypto.SESSION_KEY)
+    elif not isinstance(session, dict):
+        await sync_to_async(session.keys)()
+
+
+def render_oauth_error(error_message, status=403):
     """ If there is an error in the oauth callback, attempts to render it in a
         template that can be styled; otherwise, if OAUTH_ERROR_TEMPLATE not
-        found, this will return a HttpResponse with status 403 """
+        found, this will return a HttpResponse with status 403 (or `status`) """
     logger.error("OAuth error %s" % error_message)
     try:
         template = loader.render_to_string(settings.CANVAS_OAUTH_ERROR_TEMPLATE,
                                            {"message": error_message})
     except TemplateDoesNotExist:
-        return HttpResponse("Error: %s" % error_message, status=403)
-    return HttpResponse(template, status=403)
+        return HttpResponse("Error: %s" % error_message, status=status)
+    return HttpResponse(template, status=status)
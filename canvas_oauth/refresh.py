@@ -0,0 +1,146 @@
+"""
+Retrieving and refreshing tokens outside of a request, e.g. from management
+commands and batch jobs.
+
+Without a request there is no session key, so only tokens stored as plain
+text or encrypted with the server-side keyring (CANVAS_OAUTH_ENCRYPTION_KEYS)
+can be refreshed here.
+"""
+import logging
+import random
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from canvas_oauth import canvas, crypto, metrics, settings, storage, tracing
+from canvas_oauth.exceptions import MissingTokenError
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_token_grant(oauth_token, cipher=None, domain=None):
+    """Makes a refresh_token grant request for the given token, against its
+    own Canvas domain unless another is given, and updates its access token
+    and expiration in place.  The token is not saved.
+    """
+    refresh_token = crypto.decrypt_stored(oauth_token.refresh_token, cipher)
+    domain = domain or oauth_token.domain
+    client_id, client_secret = settings.get_developer_key(domain)
+
+    access_token, expires, _ = canvas.get_access_token(
+        domain=domain,
+        grant_type='refresh_token',
+        client_id=client_id,
+        client_secret=client_secret,
+        redirect_uri=None,
+        refresh_token=refresh_token)
+
+    oauth_token.access_token = crypto.encrypt(access_token, cipher)
+    oauth_token.refresh_token = crypto.encrypt(refresh_token, cipher)
+    oauth_token.expires = expires
+    return oauth_token
+
+
+def refresh_tokens(tokens, max_workers=8, jitter=0, domain=None):
+    """Refreshes the given tokens concurrently on a pool of at most
+    `max_workers` threads.  Each refresh starts after a random delay of up
+    to `jitter` seconds, so that tokens which expire together are not all
+    refreshed in the same second.  Refreshes are submitted to the pool once
+    their delay is over, so waiting does not hold up a thread.
+
+    Yields `(token, error)` pairs in completion order, where `error` is None
+    if the refresh succeeded.  Tokens are updated in place but not saved.
+    """
+    cipher = crypto.get_cipher()
+    tokens = list(tokens)
+    starts = sorted(random.uniform(0, jitter) for _ in tokens) if jitter else [0] * len(tokens)
+    scheduled = deque(zip(starts, tokens))
+    started = time.monotonic()
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while scheduled or futures:
+            elapsed = time.monotonic() - started
+            while scheduled and scheduled[0][0] <= elapsed:
+                oauth_token = scheduled.popleft()[1]
+                futures[executor.submit(refresh_token_grant, oauth_token, cipher, domain)] = oauth_token
+            # Wake up for the next start, or else the next completed refresh
+            timeout = scheduled[0][0] - elapsed if scheduled else None
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                oauth_token = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning("Unable to refresh %s: %s", oauth_token, e)
+                    yield oauth_token, e
+                else:
+                    yield oauth_token, None
+
+
+def write_tokens(tokens, fields, stored_access_tokens):
+    """Writes the given fields of the tokens back to storage, with a single
+    bulk_update in the database.
+
+    Tokens whose stored access token no longer matches the value in
+    `stored_access_tokens` (keyed by `storage.get_key`) were refreshed by
+    someone else since they were read, and are skipped rather than
+    overwritten.  Returns the tokens that were written.
+    """
+    return storage.get_storage().update_many(tokens, fields, expected=stored_access_tokens)
+
+
+@tracing.traced('canvas_oauth.get_oauth_tokens')
+def get_oauth_tokens(users_or_ids, domain=None, max_workers=8):
+    """Retrieves the access tokens of many users for the given Canvas domain
+    (by default CANVAS_OAUTH_CANVAS_DOMAIN), the bulk counterpart of
+    `get_oauth_token` for batch jobs.
+
+    The tokens are loaded from storage at once.  Those within
+    CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER of expiring are refreshed
+    concurrently on a pool of at most `max_workers` threads and written back
+    together.
+
+    Returns a dict mapping each user id to an `(access_token, error)` pair.
+    `error` is None on success, a MissingTokenError for users without a
+    token, or whatever prevented the token from being refreshed or decrypted.
+    """
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
+    user_ids = list(dict.fromkeys(getattr(user, 'pk', user) for user in users_or_ids))
+    tokens = storage.get_storage().get_many(user_ids, domain)
+
+    results = {}
+    for user_id in user_ids:
+        if user_id not in tokens:
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='missing')
+            results[user_id] = (None, MissingTokenError("No token found for user %s" % user_id))
+
+    buffer = settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+    expiring = [oauth_token for oauth_token in tokens.values() if oauth_token.expires_within(buffer)]
+    stored_access_tokens = {storage.get_key(oauth_token): oauth_token.access_token for oauth_token in expiring}
+    refreshed = []
+    for oauth_token, error in refresh_tokens(expiring, max_workers):
+        if error is None:
+            refreshed.append(oauth_token)
+        else:
+            del tokens[oauth_token.user_id]
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='error')
+            results[oauth_token.user_id] = (None, error)
+    if refreshed:
+        # A token refreshed elsewhere in the meantime is not written back, but
+        # the access token we were given is still valid
+        write_tokens(refreshed, ['access_token', 'refresh_token', 'expires'], stored_access_tokens)
+
+    cipher = crypto.get_cipher()
+    for user_id, oauth_token in tokens.items():
+        try:
+            access_token = crypto.decrypt_stored(oauth_token.access_token, cipher)
+        except Exception as e:
+            logger.warning("Unable to decrypt %s: %s", oauth_token, e)
+            metrics.increment('canvas_oauth_token_lookups_total', outcome='error')
+            results[user_id] = (None, e)
+            continue
+        outcome = 'refreshed' if storage.get_key(oauth_token) in stored_access_tokens else 'found'
+        metrics.increment('canvas_oauth_token_lookups_total', outcome=outcome)
+        results[user_id] = (access_token, None)
+    return {user_id: results[user_id] for user_id in user_ids}
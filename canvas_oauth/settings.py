@@ -1,13 +1,165 @@
 # -*- coding: utf-8 -*-
 """
 canvas_oauth specific settings
+
+Settings are read from the project settings on first access and cached until
+a `setting_changed` signal (e.g. from `override_settings`) clears the cache,
+so importing this module never touches the project settings.
 """
 
 from datetime import timedelta
 
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.conf import settings
 
+# The settings that must be present in the project settings, unless
+# CANVAS_OAUTH_DEVELOPER_KEYS is set
+REQUIRED_SETTINGS = ('CANVAS_OAUTH_CLIENT_ID', 'CANVAS_OAUTH_CLIENT_SECRET')
+
+# Optional settings and their defaults
+DEFAULTS = {
+    # Developer keys for individual Canvas domains, e.g.
+    # {'canvas.example.edu': {'client_id': '...', 'client_secret': '...'}}.
+    # Domains not listed here use CANVAS_OAUTH_CLIENT_ID and
+    # CANVAS_OAUTH_CLIENT_SECRET, which are only required without this setting.
+    'CANVAS_OAUTH_DEVELOPER_KEYS': {},
+
+    'CANVAS_OAUTH_CANVAS_DOMAIN': '',
+
+    # A buffer for refreshing a token when retrieving via `get_token`, expressed
+    # as a timedelta.  Default to having no expiration buffer.
+    'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER': timedelta(),
+
+    'CANVAS_OAUTH_ERROR_TEMPLATE': 'oauth_error.html',
+
+    # A list of Canvas API scopes that the access token will provide access to.
+    #
+    # This is only required if the Canvas API developer key requires scopes
+    # (e.g. enforces scopes). Otherwise, the access token will have access to
+    # all scopes.
+    #
+    # Note that Canvas API scopes may be found beneath their corresponding
+    # endpoints in the "resources" documentation pages.
+    'CANVAS_OAUTH_SCOPES': [],
+
+    # Requests to the Canvas token endpoint go through one pooled, keep-alive
+    # session per Canvas domain.  The pool size is the number of connections kept
+    # open per domain; the timeouts are expressed in seconds.
+    'CANVAS_OAUTH_HTTP_POOL_SIZE': 10,
+
+    'CANVAS_OAUTH_HTTP_CONNECT_TIMEOUT': 5,
+
+    'CANVAS_OAUTH_HTTP_READ_TIMEOUT': 5,
+
+    # Open a connection to Canvas when the app is loaded.  Set to True to warm the
+    # pool for CANVAS_OAUTH_CANVAS_DOMAIN, or to a list of domains.
+    'CANVAS_OAUTH_HTTP_WARM_POOLS': False,
+
+    # Coalesce concurrent refreshes of the same token so that only one
+    # `refresh_token` grant per user reaches Canvas.  Set to 'database' to
+    # serialize refreshes with a row lock on the token, or to 'cache' to use a lock
+    # in the Django cache.  Defaults to no coordination.
+    'CANVAS_OAUTH_REFRESH_LOCK': None,
+
+    # The cache alias holding refresh locks when CANVAS_OAUTH_REFRESH_LOCK is
+    # 'cache'.  It must be shared by every process, e.g. memcached or redis.
+    'CANVAS_OAUTH_REFRESH_LOCK_CACHE_ALIAS': 'default',
+
+    # Seconds a request waits for another request's refresh, with either lock,
+    # before refreshing the token itself.
+    'CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT': 10,
+
+    # Cache tokens in front of the CanvasOAuth2Token table.  The first tier is an
+    # in-process LRU holding up to CANVAS_OAUTH_TOKEN_CACHE_SIZE tokens; the second,
+    # optional tier is the Django cache named by CANVAS_OAUTH_TOKEN_CACHE_ALIAS.
+    # Timeouts are in seconds; cached tokens never outlive their expiration.
+    'CANVAS_OAUTH_TOKEN_CACHE': False,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_ALIAS': None,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_SIZE': 1000,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_TIMEOUT': 300,
+
+    # How long the in-process tier keeps a token, or None for
+    # CANVAS_OAUTH_TOKEN_CACHE_TIMEOUT.  Saving or deleting a token does not clear
+    # the in-process tier of other processes, which may serve the old token
+    # until this timeout.
+    'CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT': None,
+
+    # How long the shared tier remembers that a user has no token
+    'CANVAS_OAUTH_TOKEN_CACHE_MISSING_TIMEOUT': 10,
+
+    # A dotted path to the class that stores tokens, one of DatabaseStorage,
+    # CacheStorage or WriteThroughStorage in canvas_oauth.storage.  The latter
+    # two keep tokens in the Django cache named by
+    # CANVAS_OAUTH_TOKEN_STORAGE_CACHE_ALIAS, which must not evict entries.
+    'CANVAS_OAUTH_TOKEN_STORAGE': 'canvas_oauth.storage.DatabaseStorage',
+
+    'CANVAS_OAUTH_TOKEN_STORAGE_CACHE_ALIAS': 'default',
+
+    # A server-side keyring of Fernet keys used to encrypt stored tokens, so they
+    # can be decrypted outside of the user's session.  The first key encrypts new
+    # tokens; every key is tried when decrypting.  To rotate, prepend a new key,
+    # run the `rotate_canvas_oauth_keys` management command, then drop the old key.
+    'CANVAS_OAUTH_ENCRYPTION_KEYS': [],
+
+    # A dotted path to the metrics backend class, e.g.
+    # 'canvas_oauth.metrics.PrometheusBackend'.  Defaults to no metrics.
+    'CANVAS_OAUTH_METRICS_BACKEND': None,
+
+    # A dotted path to the tracing exporter class, e.g.
+    # 'canvas_oauth.tracing.LoggingExporter'.  Defaults to no tracing.
+    'CANVAS_OAUTH_TRACING_EXPORTER': None,
+
+    # How many times a failed token request is retried.  Timeouts and 5xx
+    # responses are only retried for refresh_token grants, since an authorization
+    # code can only be redeemed once.  Connection errors and 429s are always
+    # retried.
+    'CANVAS_OAUTH_HTTP_RETRIES': 2,
+
+    # The base and maximum delay in seconds between retries.  Delays grow
+    # exponentially from the base, with full jitter.
+    'CANVAS_OAUTH_HTTP_RETRY_BACKOFF': 0.2,
+
+    'CANVAS_OAUTH_HTTP_RETRY_BACKOFF_MAX': 2,
+
+    # The total time in seconds a token request may take, across all attempts
+    'CANVAS_OAUTH_HTTP_DEADLINE': 10,
+
+    # After this many consecutive failed token requests to a domain, requests
+    # fail fast with CanvasUnavailableError for
+    # CANVAS_OAUTH_CIRCUIT_BREAKER_RESET_TIMEOUT seconds.  0 disables the breaker.
+    'CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD': 5,
+
+    'CANVAS_OAUTH_CIRCUIT_BREAKER_RESET_TIMEOUT': 30,
+
+    # The cache alias in which CanvasClient stores GET responses carrying an
+    # ETag or Last-Modified header, to revalidate them with conditional
+    # requests.  Defaults to no caching.  Entries are kept for
+    # CANVAS_OAUTH_API_CACHE_TIMEOUT seconds, and bodies larger than
+    # CANVAS_OAUTH_API_CACHE_MAX_SIZE bytes are not stored.
+    'CANVAS_OAUTH_API_CACHE_ALIAS': None,
+
+    'CANVAS_OAUTH_API_CACHE_TIMEOUT': 3600,
+
+    'CANVAS_OAUTH_API_CACHE_MAX_SIZE': 1024 * 1024,
+
+    # Pace CanvasClient requests to stay within each token's Canvas rate
+    # limit, running at most CANVAS_OAUTH_API_MAX_CONCURRENCY requests per
+    # token at once.  Set CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS to share the
+    # rate limit budget between processes through the Django cache.
+    'CANVAS_OAUTH_API_THROTTLE': False,
+
+    # Also the default concurrency of canvas_oauth.batch
+    'CANVAS_OAUTH_API_MAX_CONCURRENCY': 8,
+
+    'CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS': None,
+}
+
+_cache = {}
+
 
 def get_required_setting(oauth_setting):
     """
@@ -20,42 +172,67 @@ def get_required_setting(oauth_setting):
     return getattr(settings, oauth_setting)
 
 
-# Get required settings from project conf
-CANVAS_OAUTH_CLIENT_ID = get_required_setting('CANVAS_OAUTH_CLIENT_ID')
-CANVAS_OAUTH_CLIENT_SECRET = get_required_setting('CANVAS_OAUTH_CLIENT_SECRET')
-
-# Optional settings
-# -----------------
-CANVAS_OAUTH_CANVAS_DOMAIN = getattr(
-    settings,
-    'CANVAS_OAUTH_CANVAS_DOMAIN',
-    ''
-)
-
-# A buffer for refreshing a token when retrieving via `get_token`, expressed
-# as a timedelta.  Default to having no expiration buffer.
-CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER = getattr(
-    settings,
-    'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER',
-    timedelta(),
-)
-
-CANVAS_OAUTH_ERROR_TEMPLATE = getattr(
-    settings,
-    'CANVAS_OAUTH_ERROR_TEMPLATE',
-    'oauth_error.html'
-)
-
-# A list of Canvas API scopes that the access token will provide access to.
-#
-# This is only required if the Canvas API developer key requires scopes
-# (e.g. enforces scopes). Otherwise, the access token will have access to
-# all scopes.
-#
-# Note that Canvas API scopes may be found beneath their corresponding
-# endpoints in the "resources" documentation pages.
-CANVAS_OAUTH_SCOPES = getattr(
-    settings,
-    'CANVAS_OAUTH_SCOPES',
-    []
-)
+def get_setting(name):
+    """
+    Return the value of the given canvas_oauth setting, reading it from the
+    project settings on first use.
+    """
+    try:
+        return _cache[name]
+    except KeyError:
+        pass
+    if name in REQUIRED_SETTINGS:
+        # Domains with their own developer key do not need the default one
+        if get_setting('CANVAS_OAUTH_DEVELOPER_KEYS'):
+            value = getattr(settings, name, None)
+        else:
+            value = get_required_setting(name)
+    elif name in DEFAULTS:
+        value = getattr(settings, name, DEFAULTS[name])
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    _cache[name] = value
+    # Later lookups of the module attribute no longer go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def clear_cache(**kwargs):
+    """Forget the cached settings, so they are read again on next access."""
+    module_globals = globals()
+    for name, value in list(_cache.items()):
+        # Leave values that were patched onto the module alone
+        if name in module_globals and module_globals[name] is value:
+            del module_globals[name]
+    _cache.clear()
+
+
+def _setting_changed(setting, **kwargs):
+    if setting.startswith('CANVAS_OAUTH_'):
+        clear_cache()
+
+
+setting_changed.connect(_setting_changed, dispatch_uid='canvas_oauth.settings')
+
+
+def __getattr__(name):
+    return get_setting(name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(REQUIRED_SETTINGS) | set(DEFAULTS))
+
+
+def get_developer_key(domain):
+    """
+    Return the (client_id, client_secret) of the developer key to use
+    with the given Canvas domain.
+    """
+    developer_key = get_setting('CANVAS_OAUTH_DEVELOPER_KEYS').get(domain)
+    if developer_key is not None:
+        return developer_key['client_id'], developer_key['client_secret']
+    client_id = get_setting('CANVAS_OAUTH_CLIENT_ID')
+    if client_id is None:
+        raise ImproperlyConfigured(
+            'No developer key in CANVAS_OAUTH_DEVELOPER_KEYS for Canvas domain %s' % domain)
+    return client_id, get_setting('CANVAS_OAUTH_CLIENT_SECRET')
@@ -0,0 +1,201 @@
+"""
+Single-flight coordination of token refreshes.
+
+When many requests for the same user notice an expiring token at once, only
+one of them performs the `refresh_token` grant.  The others wait for it to
+finish and then reuse the token it saved.  Coordination happens through
+either a row lock on the CanvasOAuth2Token table (`'database'`) or a lock in
+the Django cache (`'cache'`), so it holds across threads, processes and nodes.
+Row locks need tokens kept in the database, so with `CacheStorage` only the
+cache lock can be used.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, NotSupportedError, transaction
+
+from canvas_oauth import metrics, settings, storage
+from canvas_oauth.models import CanvasOAuth2Token
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY_PATTERN = "canvas_oauth:refresh-lock:%s:%s"
+
+# How often a waiter checks whether the row or cache lock has been released
+LOCK_POLL_INTERVAL = 0.05
+
+_stats = {'refreshes': 0, 'coalesced': 0, 'lock_timeouts': 0}
+_stats_lock = threading.Lock()
+
+# Threads of one process first queue up on a local lock, so only one of them
+# at a time contends for the shared database or cache lock.
+_local_locks = weakref.WeakValueDictionary()
+_local_locks_lock = threading.Lock()
+
+
+def _incr(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+    metrics.increment('canvas_oauth_refresh_lock_total', result=stat)
+
+
+def get_refresh_stats():
+    """Returns a snapshot of the single-flight counters: refreshes performed,
+    refreshes coalesced into another caller's refresh, and waits that gave up
+    on the lock.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_refresh_stats():
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
+
+
+def _get_local_lock(key):
+    with _local_locks_lock:
+        lock = _local_locks.get(key)
+        if lock is None:
+            lock = _local_locks[key] = threading.Lock()
+        return lock
+
+
+def _was_refreshed(stale_token, current_token):
+    # Every refresh moves the expiration, while re-encrypting the token with
+    # another key (rotate_canvas_oauth_keys) changes its stored value only
+    return current_token.expires != stale_token.expires
+
+
+def refresh(oauth_token, do_refresh):
+    """Refreshes `oauth_token` via `do_refresh`, making sure only one refresh
+    of the token runs at a time.  `do_refresh` is called with a freshly loaded
+    copy of the token and must return the refreshed, saved token.
+
+    If another caller refreshed the token while we were waiting, their token
+    is returned instead and no request is made to Canvas.
+    """
+    mode = settings.CANVAS_OAUTH_REFRESH_LOCK
+    if mode == 'database':
+        acquire = _refresh_with_row_lock
+    elif mode == 'cache':
+        acquire = _refresh_with_cache_lock
+    else:
+        raise ImproperlyConfigured(
+            "CANVAS_OAUTH_REFRESH_LOCK must be one of None, 'database' or 'cache', not %r" % mode)
+
+    with _get_local_lock(storage.get_key(oauth_token)):
+        return acquire(oauth_token, do_refresh)
+
+
+def _lock_row(oauth_token):
+    """Locks and returns the token's row, polling for up to
+    CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT seconds while another transaction holds
+    it.  Returns None if the lock could not be acquired in time."""
+    deadline = time.monotonic() + settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT
+    while True:
+        try:
+            # A savepoint, so that a failed attempt leaves the transaction usable
+            with transaction.atomic():
+                return CanvasOAuth2Token.objects.select_for_update(nowait=True).get(pk=oauth_token.pk)
+        except NotSupportedError:
+            raise
+        except DatabaseError:
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(LOCK_POLL_INTERVAL)
+
+
+def _refresh_with_row_lock(oauth_token, do_refresh):
+    with transaction.atomic():
+        current_token = _lock_row(oauth_token)
+        if current_token is None:
+            # Refresh anyway rather than failing the request
+            logger.warning("Timed out waiting for refresh lock on %s", oauth_token)
+            _incr('lock_timeouts')
+            current_token = CanvasOAuth2Token.objects.get(pk=oauth_token.pk)
+        if _was_refreshed(oauth_token, current_token):
+            logger.info("Reusing token refreshed by another request for %s", current_token)
+            _incr('coalesced')
+            return current_token
+        current_token = do_refresh(current_token)
+    _incr('refreshes')
+    return current_token
+
+
+def _get_lock_ttl():
+    # The lock outlives the slowest possible token request, retries
+    # included, so a crashed holder cannot block refreshes forever.
+    return settings.CANVAS_OAUTH_HTTP_DEADLINE + settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT
+
+
+def _refresh_with_cache_lock(oauth_token, do_refresh):
+    cache = caches[settings.CANVAS_OAUTH_REFRESH_LOCK_CACHE_ALIAS]
+    key = LOCK_KEY_PATTERN % storage.get_key(oauth_token)
+    lock_ttl = _get_lock_ttl()
+
+    acquired = cache.add(key, 1, lock_ttl)
+    if not acquired:
+        deadline = time.monotonic() + settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT
+        while cache.get(key) is not None and time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+        acquired = cache.add(key, 1, lock_ttl)
+        if not acquired:
+            # Refresh anyway rather than failing the request
+            logger.warning("Timed out waiting for refresh lock on %s", key)
+            _incr('lock_timeouts')
+
+    try:
+        current_token = storage.get_storage().get(oauth_token.user_id, oauth_token.domain)
+        if _was_refreshed(oauth_token, current_token):
+            logger.info("Reusing token refreshed by another request for %s", current_token)
+            _incr('coalesced')
+            return current_token
+        current_token = do_refresh(current_token)
+    finally:
+        if acquired:
+            cache.delete(key)
+    _incr('refreshes')
+    return current_token
+
+
+async def arefresh(oauth_token, do_refresh):
+    """Async version of `refresh` for the 'cache' lock, where `do_refresh` is
+    a coroutine function.  Row locks need a transaction, which the async ORM
+    cannot hold, so the 'database' lock is only available through `refresh`.
+    """
+    if settings.CANVAS_OAUTH_REFRESH_LOCK != 'cache':
+        raise ImproperlyConfigured("Async refreshes can only be coordinated with the 'cache' lock")
+
+    cache = caches[settings.CANVAS_OAUTH_REFRESH_LOCK_CACHE_ALIAS]
+    key = LOCK_KEY_PATTERN % storage.get_key(oauth_token)
+    lock_ttl = _get_lock_ttl()
+
+    acquired = await cache.aadd(key, 1, lock_ttl)
+    if not acquired:
+        deadline = time.monotonic() + settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT
+        while await cache.aget(key) is not None and time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        acquired = await cache.aadd(key, 1, lock_ttl)
+        if not acquired:
+            logger.warning("Timed out waiting for refresh lock on %s", key)
+            _incr('lock_timeouts')
+
+    try:
+        current_token = await storage.get_storage().aget(oauth_token.user_id, oauth_token.domain)
+        if _was_refreshed(oauth_token, current_token):
+            logger.info("Reusing token refreshed by another request for %s", current_token)
+            _incr('coalesced')
+            return current_token
+        current_token = await do_refresh(current_token)
+    finally:
+        if acquired:
+            await cache.adelete(key)
+    _incr('refreshes')
+    return current_token
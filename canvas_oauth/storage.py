@@ -0,0 +1,399 @@
+"""
+Pluggable storage for CanvasOAuth2Token.
+
+Tokens are read and written through the backend named by the
+CANVAS_OAUTH_TOKEN_STORAGE setting, a dotted path to a class:
+
+* `DatabaseStorage` keeps tokens in the CanvasOAuth2Token table (the default).
+* `CacheStorage` keeps them in a Django cache only, e.g. redis, for projects
+  that would rather not store tokens in their database.
+* `WriteThroughStorage` keeps the database as the source of truth with a
+  Django cache in front, so that reads rarely reach the database.
+
+Every backend deals in CanvasOAuth2Token instances and identifies a token by
+its user id and Canvas domain.  Tokens read from a cache are not attached to
+a database row and have no `pk` unless one was stored with them.  The
+management commands scan the CanvasOAuth2Token table, and so only see tokens
+kept in the database.
+"""
+import threading
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from canvas_oauth import settings, token_cache
+from canvas_oauth.models import CanvasOAuth2Token
+
+KEY_PATTERN = "canvas_oauth:stored_token:%s:%s"
+
+# The fields `put` writes to an existing token, besides the timestamps
+TOKEN_FIELDS = ('access_token', 'refresh_token', 'expires')
+
+
+def get_key(oauth_token):
+    """Returns the (user id, domain) pair identifying a token in storage."""
+    return (oauth_token.user_id, oauth_token.domain)
+
+
+def _group_by_domain(tokens):
+    domains = {}
+    for oauth_token in tokens:
+        domains.setdefault(oauth_token.domain, []).append(oauth_token.user_id)
+    return domains
+
+
+def _invalidate_cached(tokens):
+    # Writes that do not send post_save must clear the token cache themselves
+    if settings.CANVAS_OAUTH_TOKEN_CACHE:
+        for oauth_token in tokens:
+            token_cache.invalidate(oauth_token.user_id, oauth_token.domain)
+
+
+class BaseTokenStorage(object):
+    """The interface of a storage backend.  `get` raises
+    CanvasOAuth2Token.DoesNotExist when the user has no token for the domain.
+
+    The async methods run the sync ones in a thread unless a backend has a
+    native implementation.
+    """
+
+    def get(self, user_id, domain):
+        raise NotImplementedError
+
+    def put(self, oauth_token):
+        """Stores the token, replacing any token the user already has for
+        its domain, and returns the stored token."""
+        raise NotImplementedError
+
+    def update(self, oauth_token, fields=None):
+        """Writes the given fields (by default all of them) of a token read
+        from this storage back, e.g. after a refresh."""
+        raise NotImplementedError
+
+    def delete(self, user_id, domain):
+        raise NotImplementedError
+
+    def get_many(self, user_ids, domain):
+        """Returns a dict mapping user ids to their token for the domain.
+        Users without a token are left out."""
+        raise NotImplementedError
+
+    def put_many(self, tokens):
+        raise NotImplementedError
+
+    def update_many(self, tokens, fields, expected=None):
+        """Writes the given fields of the tokens back, and returns the
+        tokens that were written.
+
+        `expected` optionally maps the `get_key` of each token to the access
+        token it was read with.  Tokens whose stored access token has changed
+        since were refreshed by someone else, and are skipped rather than
+        overwritten.
+        """
+        raise NotImplementedError
+
+    def delete_many(self, tokens):
+        raise NotImplementedError
+
+    def evict(self, user_id, domain):
+        """Called when a token is saved or deleted in the database, including
+        by the admin, management commands or a deleted user.  Storages that
+        copy tokens out of the database drop their copy here."""
+
+    async def aget(self, user_id, domain):
+        return await sync_to_async(self.get)(user_id, domain)
+
+    async def aput(self, oauth_token):
+        return await sync_to_async(self.put)(oauth_token)
+
+    async def aupdate(self, oauth_token, fields=None):
+        return await sync_to_async(self.update)(oauth_token, fields)
+
+    async def adelete(self, user_id, domain):
+        return await sync_to_async(self.delete)(user_id, domain)
+
+
+class DatabaseStorage(BaseTokenStorage):
+    """Keeps tokens in the CanvasOAuth2Token table."""
+
+    def get(self, user_id, domain):
+        return CanvasOAuth2Token.objects.get(user_id=user_id, domain=domain)
+
+    def put(self, oauth_token):
+        oauth_token, _ = CanvasOAuth2Token.objects.update_or_create(
+            user_id=oauth_token.user_id, domain=oauth_token.domain,
+            defaults={field: getattr(oauth_token, field) for field in TOKEN_FIELDS})
+        return oauth_token
+
+    def update(self, oauth_token, fields=None):
+        if fields is None:
+            oauth_token.save()
+        else:
+            oauth_token.save(update_fields=fields)
+
+    def delete(self, user_id, domain):
+        CanvasOAuth2Token.objects.filter(user_id=user_id, domain=domain).delete()
+
+    def get_many(self, user_ids, domain):
+        return {oauth_token.user_id: oauth_token
+                for oauth_token in CanvasOAuth2Token.objects.filter(domain=domain, user_id__in=user_ids)}
+
+    def put_many(self, tokens):
+        with transaction.atomic():
+            return [self.put(oauth_token) for oauth_token in tokens]
+
+    def update_many(self, tokens, fields, expected=None):
+        # A single bulk_update, with the rows locked while they are compared
+        with transaction.atomic():
+            if expected is None:
+                unchanged = list(tokens)
+            else:
+                current = dict(CanvasOAuth2Token.objects
+                               .select_for_update()
+                               .filter(pk__in=[oauth_token.pk for oauth_token in tokens])
+                               .values_list('pk', 'access_token'))
+                unchanged = [oauth_token for oauth_token in tokens
+                             if current.get(oauth_token.pk) == expected[get_key(oauth_token)]]
+            CanvasOAuth2Token.objects.bulk_update(unchanged, fields)
+
+        # bulk_update does not send post_save
+        _invalidate_cached(unchanged)
+        return unchanged
+
+    def delete_many(self, tokens):
+        with transaction.atomic():
+            for domain, user_ids in _group_by_domain(tokens).items():
+                CanvasOAuth2Token.objects.filter(domain=domain, user_id__in=user_ids).delete()
+
+    async def aget(self, user_id, domain):
+        return await CanvasOAuth2Token.objects.aget(user_id=user_id, domain=domain)
+
+    async def aput(self, oauth_token):
+        oauth_token, _ = await CanvasOAuth2Token.objects.aupdate_or_create(
+            user_id=oauth_token.user_id, domain=oauth_token.domain,
+            defaults={field: getattr(oauth_token, field) for field in TOKEN_FIELDS})
+        return oauth_token
+
+    async def aupdate(self, oauth_token, fields=None):
+        if fields is None:
+            await oauth_token.asave()
+        else:
+            await oauth_token.asave(update_fields=fields)
+
+    async def adelete(self, user_id, domain):
+        await CanvasOAuth2Token.objects.filter(user_id=user_id, domain=domain).adelete()
+
+
+class CacheStorage(BaseTokenStorage):
+    """Keeps tokens in the Django cache named by
+    CANVAS_OAUTH_TOKEN_STORAGE_CACHE_ALIAS, with no timeout.  The cache must
+    be shared by all processes and must not evict entries, or users will
+    have to authorize again.  `update_many` compares and writes without a
+    lock, so it only narrows the window for concurrent refreshes.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias or settings.CANVAS_OAUTH_TOKEN_STORAGE_CACHE_ALIAS]
+
+    def get(self, user_id, domain):
+        values = self.cache.get(KEY_PATTERN % (user_id, domain))
+        if values is None:
+            raise CanvasOAuth2Token.DoesNotExist("No token found for user %s" % user_id)
+        return token_cache._from_values(values)
+
+    def put(self, oauth_token):
+        return self.put_many([oauth_token])[0]
+
+    def update(self, oauth_token, fields=None):
+        if fields is None or 'updated_on' in fields:
+            oauth_token.updated_on = timezone.now()
+        self.store(oauth_token)
+        _invalidate_cached([oauth_token])
+
+    def delete(self, user_id, domain):
+        self.cache.delete(KEY_PATTERN % (user_id, domain))
+        if settings.CANVAS_OAUTH_TOKEN_CACHE:
+            token_cache.invalidate(user_id, domain)
+
+    def get_many(self, user_ids, domain):
+        keys = {KEY_PATTERN % (user_id, domain): user_id for user_id in user_ids}
+        return {keys[key]: token_cache._from_values(values)
+                for key, values in self.cache.get_many(list(keys)).items()}
+
+    def put_many(self, tokens):
+        # Keep when the user first authorized, as the database does
+        created = {}
+        for domain, user_ids in _group_by_domain(tokens).items():
+            for user_id, stored_token in self.get_many(user_ids, domain).items():
+                created[(user_id, domain)] = stored_token.created_on
+        now = timezone.now()
+        for oauth_token in tokens:
+            oauth_token.created_on = created.get(get_key(oauth_token), now)
+            oauth_token.updated_on = now
+        self.store_many(tokens)
+        _invalidate_cached(tokens)
+        return list(tokens)
+
+    def update_many(self, tokens, fields, expected=None):
+        unchanged = list(tokens)
+        if expected is not None:
+            current = {}
+            for domain, user_ids in _group_by_domain(tokens).items():
+                for user_id, stored_token in self.get_many(user_ids, domain).items():
+                    current[(user_id, domain)] = stored_token.access_token
+            unchanged = [oauth_token for oauth_token in tokens
+                         if current.get(get_key(oauth_token)) == expected[get_key(oauth_token)]]
+        if 'updated_on' in fields:
+            now = timezone.now()
+            for oauth_token in unchanged:
+                oauth_token.updated_on = now
+        self.store_many(unchanged)
+        _invalidate_cached(unchanged)
+        return unchanged
+
+    def delete_many(self, tokens):
+        self.cache.delete_many([KEY_PATTERN % get_key(oauth_token) for oauth_token in tokens])
+        _invalidate_cached(tokens)
+
+    def store(self, oauth_token):
+        """Stores the token as it is, e.g. when copying it from another
+        storage."""
+        self.cache.set(KEY_PATTERN % get_key(oauth_token), token_cache._to_values(oauth_token), None)
+
+    def store_many(self, tokens):
+        self.cache.set_many({KEY_PATTERN % get_key(oauth_token): token_cache._to_values(oauth_token)
+                             for oauth_token in tokens}, None)
+
+    async def aget(self, user_id, domain):
+        values = await self.cache.aget(KEY_PATTERN % (user_id, domain))
+        if values is None:
+            raise CanvasOAuth2Token.DoesNotExist("No token found for user %s" % user_id)
+        return token_cache._from_values(values)
+
+    async def astore(self, oauth_token):
+        await self.cache.aset(KEY_PATTERN % get_key(oauth_token), token_cache._to_values(oauth_token), None)
+
+    async def adelete(self, user_id, domain):
+        await self.cache.adelete(KEY_PATTERN % (user_id, domain))
+        if settings.CANVAS_OAUTH_TOKEN_CACHE:
+            token_cache.invalidate(user_id, domain)
+
+
+class WriteThroughStorage(BaseTokenStorage):
+    """Keeps tokens in the database, with a copy in a `CacheStorage` in
+    front.  Reads are served from the cache, and fill it from the database
+    on a miss; writes go to the database first and then to the cache.  A
+    token saved or deleted in the database by other means is dropped from
+    the cache.
+    """
+
+    def __init__(self, cache=None, database=None):
+        self.cache = cache or CacheStorage()
+        self.database = database or DatabaseStorage()
+
+    def get(self, user_id, domain):
+        try:
+            return self.cache.get(user_id, domain)
+        except CanvasOAuth2Token.DoesNotExist:
+            pass
+        oauth_token = self.database.get(user_id, domain)
+        self.cache.store(oauth_token)
+        return oauth_token
+
+    def put(self, oauth_token):
+        oauth_token = self.database.put(oauth_token)
+        self.cache.store(oauth_token)
+        return oauth_token
+
+    def update(self, oauth_token, fields=None):
+        self.database.update(oauth_token, fields)
+        self.cache.store(oauth_token)
+
+    def delete(self, user_id, domain):
+        self.database.delete(user_id, domain)
+        self.cache.delete(user_id, domain)
+
+    def get_many(self, user_ids, domain):
+        tokens = self.cache.get_many(user_ids, domain)
+        missing = [user_id for user_id in user_ids if user_id not in tokens]
+        if missing:
+            loaded = self.database.get_many(missing, domain)
+            self.cache.store_many(loaded.values())
+            tokens.update(loaded)
+        return tokens
+
+    def put_many(self, tokens):
+        tokens = self.database.put_many(tokens)
+        self.cache.store_many(tokens)
+        return tokens
+
+    def update_many(self, tokens, fields, expected=None):
+        written = self.database.update_many(tokens, fields, expected)
+        # Bulk writes may come from tokens loaded with only some of their
+        # fields, so the cached copies are dropped rather than replaced
+        self.cache.delete_many(written)
+        return written
+
+    def delete_many(self, tokens):
+        self.database.delete_many(tokens)
+        self.cache.delete_many(tokens)
+
+    def evict(self, user_id, domain):
+        self.cache.delete(user_id, domain)
+
+    async def aget(self, user_id, domain):
+        try:
+            return await self.cache.aget(user_id, domain)
+        except CanvasOAuth2Token.DoesNotExist:
+            pass
+        oauth_token = await self.database.aget(user_id, domain)
+        await self.cache.astore(oauth_token)
+        return oauth_token
+
+    async def aput(self, oauth_token):
+        oauth_token = await self.database.aput(oauth_token)
+        await self.cache.astore(oauth_token)
+        return oauth_token
+
+    async def aupdate(self, oauth_token, fields=None):
+        await self.database.aupdate(oauth_token, fields)
+        await self.cache.astore(oauth_token)
+
+    async def adelete(self, user_id, domain):
+        await self.database.adelete(user_id, domain)
+        await self.cache.adelete(user_id, domain)
+
+
+_storage = None
+_storage_path = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Returns the configured storage, instantiated once per process."""
+    global _storage, _storage_path
+    path = settings.CANVAS_OAUTH_TOKEN_STORAGE
+    if path != _storage_path:
+        with _storage_lock:
+            if path != _storage_path:
+                _storage = import_string(path)()
+                _storage_path = path
+    return _storage
+
+
+def evict_token(sender, instance, **kwargs):
+    get_storage().evict(instance.user_id, instance.domain)
+
+
+post_save.connect(evict_token, sender=CanvasOAuth2Token,
+                  dispatch_uid='canvas_oauth_evict_saved_token')
+post_delete.connect(evict_token, sender=CanvasOAuth2Token,
+                    dispatch_uid='canvas_oauth_evict_deleted_token')
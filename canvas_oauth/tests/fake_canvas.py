@@ -0,0 +1,288 @@
+"""
+A fake Canvas OAuth2 provider for tests and load tests, running as a
+threaded HTTP server on localhost.
+
+It implements the authorization (`/login/oauth2/auth`) and token
+(`/login/oauth2/token`) endpoints closely enough for the whole OAuth dance,
+issues tokens with a realistic `expires_in`, and can inject latency, errors,
+429 responses and timeouts into the token endpoint.
+
+    with FakeCanvas(latency=uniform(0.01, 0.05), error_rate=0.01) as fake:
+        with fake.patch_urls():
+            canvas.get_access_token(..., domain=fake.domain)
+
+It can also be run standalone:
+
+    python -m canvas_oauth.tests.fake_canvas --port 8765 --latency-ms 20 --error-rate 0.01
+"""
+import argparse
+import json
+import math
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+def fixed(seconds):
+    """A latency distribution that always returns `seconds`."""
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """A latency distribution uniform between `low` and `high` seconds."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """A long-tailed latency distribution with the given median, in seconds."""
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class FakeCanvas(object):
+    """
+    :param latency: A distribution (see `fixed`, `uniform` and `lognormal`)
+        of the delay added to every token request.
+    :param error_rate: The fraction of token requests answered with a 500.
+    :param rate_limit_rate: The fraction answered with a 429.
+    :param timeout_rate: The fraction that stall for `timeout_delay` seconds
+        before the connection is closed without a response.
+    :param expires_in: The lifetime of issued access tokens, in seconds.
+    :param client_id: If set, the client id and secret that are accepted.
+    :param strict: Whether only codes and refresh tokens issued by this fake
+        are accepted.  Turn off to load test against existing tokens.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, error_rate=0.0,
+                 rate_limit_rate=0.0, timeout_rate=0.0, timeout_delay=30.0,
+                 expires_in=3600, client_id=None, client_secret=None, strict=True, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.expires_in = expires_in
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.strict = strict
+
+        self.stats = Counter()
+        self._codes = {}
+        self._refresh_tokens = set()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def domain(self):
+        """The host and port to use as the Canvas domain."""
+        host, port = self.server.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @contextmanager
+    def patch_urls(self):
+        """Points the library at plain HTTP, since the fake does not serve TLS."""
+        from canvas_oauth import canvas
+
+        with patch.object(canvas, 'AUTHORIZE_URL_PATTERN', 'http://%s/login/oauth2/auth'), \
+                patch.object(canvas, 'ACCESS_TOKEN_URL_PATTERN', 'http://%s/login/oauth2/token'):
+            yield
+
+    def create_refresh_token(self):
+        """Issues a refresh token, e.g. for a token created directly in the
+        database by a test."""
+        refresh_token = '1~refresh-' + secrets.token_urlsafe(24)
+        with self._lock:
+            self._refresh_tokens.add(refresh_token)
+        return refresh_token
+
+    def _random_fraction(self):
+        with self._lock:
+            return self._random.random()
+
+    def _get_latency(self):
+        if self.latency is None:
+            return 0
+        with self._lock:
+            return self.latency(self._random)
+
+    def _create_code(self, redirect_uri):
+        code = secrets.token_urlsafe(16)
+        with self._lock:
+            self._codes[code] = redirect_uri
+        return code
+
+    def _redeem_code(self, code, redirect_uri):
+        with self._lock:
+            expected_redirect_uri = self._codes.pop(code, None)
+        if not self.strict:
+            return bool(code)
+        return expected_redirect_uri is not None and expected_redirect_uri == redirect_uri
+
+    def _has_refresh_token(self, refresh_token):
+        if not self.strict:
+            return bool(refresh_token)
+        with self._lock:
+            return refresh_token in self._refresh_tokens
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
+def _make_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/login/oauth2/auth':
+                return self.send_json(404, {'errors': [{'message': 'Not found'}]})
+
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            fake._count('authorize')
+            if 'redirect_uri' not in params or params.get('response_type') != 'code':
+                return self.send_json(400, {'error': 'invalid_request'})
+            if fake.client_id is not None and params.get('client_id') != str(fake.client_id):
+                return self.send_json(401, {'error': 'invalid_client'})
+
+            # The user grants access straight away
+            query = {'code': fake._create_code(params['redirect_uri'])}
+            if 'state' in params:
+                query['state'] = params['state']
+            separator = '&' if '?' in params['redirect_uri'] else '?'
+            self.send_response(302)
+            self.send_header('Location', params['redirect_uri'] + separator + urlencode(query))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+            if urlparse(self.path).path != '/login/oauth2/token':
+                return self.send_json(404, {'errors': [{'message': 'Not found'}]})
+
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+            time.sleep(fake._get_latency())
+
+            fraction = fake._random_fraction()
+            if fraction < fake.timeout_rate:
+                fake._count('timeout')
+                time.sleep(fake.timeout_delay)
+                self.close_connection = True
+                return
+            fraction -= fake.timeout_rate
+            if fraction < fake.rate_limit_rate:
+                fake._count('429')
+                return self.send_json(429, {'errors': [{'message': 'Rate Limit Exceeded'}]},
+                                      {'Retry-After': '1'})
+            fraction -= fake.rate_limit_rate
+            if fraction < fake.error_rate:
+                fake._count('500')
+                return self.send_json(500, {'errors': [{'message': 'Internal server error'}]})
+
+            if fake.client_id is not None and (params.get('client_id') != str(fake.client_id) or
+                                               params.get('client_secret') != fake.client_secret):
+                fake._count('invalid_client')
+                return self.send_json(401, {'error': 'invalid_client'})
+
+            grant_type = params.get('grant_type')
+            response = {
+                'access_token': '1~access-' + secrets.token_urlsafe(24),
+                'token_type': 'Bearer',
+                'expires_in': fake.expires_in,
+                'user': {'id': 1, 'name': 'Fake User'},
+            }
+            if grant_type == 'authorization_code':
+                if not fake._redeem_code(params.get('code'), params.get('redirect_uri')):
+                    fake._count('invalid_grant')
+                    return self.send_json(400, {'error': 'invalid_grant'})
+                response['refresh_token'] = fake.create_refresh_token()
+            elif grant_type == 'refresh_token':
+                if not fake._has_refresh_token(params.get('refresh_token')):
+                    fake._count('invalid_grant')
+                    return self.send_json(400, {'error': 'invalid_grant'})
+            else:
+                return self.send_json(400, {'error': 'unsupported_grant_type'})
+
+            fake._count(grant_type)
+            self.send_json(200, response)
+
+        def send_json(self, status, data, headers=None):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Canvas OAuth2 provider.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help="Median latency added to token requests.")
+    parser.add_argument('--latency-sigma', type=float, default=0,
+                        help="Spread of a lognormal latency distribution; 0 for fixed latency.")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-delay', type=float, default=30.0)
+    parser.add_argument('--expires-in', type=int, default=3600)
+    parser.add_argument('--lenient', action='store_true',
+                        help="Accept any code or refresh token, e.g. ones already in a database.")
+    args = parser.parse_args()
+
+    latency = None
+    if args.latency_ms:
+        seconds = args.latency_ms / 1000
+        latency = lognormal(seconds, args.latency_sigma) if args.latency_sigma else fixed(seconds)
+    fake = FakeCanvas(host=args.host, port=args.port, latency=latency, error_rate=args.error_rate,
+                      rate_limit_rate=args.rate_limit_rate, timeout_rate=args.timeout_rate,
+                      timeout_delay=args.timeout_delay, expires_in=args.expires_in,
+                      strict=not args.lenient)
+    print("Fake Canvas listening on http://%s" % fake.domain)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.server.server_close()
+        print(dict(fake.stats))
+
+
+if __name__ == '__main__':
+    main()
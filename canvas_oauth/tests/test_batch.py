@@ -0,0 +1,238 @@
+import asyncio
+from datetime import timedelta
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from canvas_oauth.batch import abatch, batch, parse_spec
+from canvas_oauth.tests.utils import TokenTestMixin
+
+
+def invalid_token_response():
+    return httpx.Response(401, headers={'WWW-Authenticate': 'Bearer realm="canvas-lms"'})
+
+
+class BatchTestMixin(TokenTestMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.requests_made = []
+
+        patcher = patch('canvas_oauth.batch.canvas.get_async_client')
+        self.get_async_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_handler(self, handler):
+        async def record(request):
+            self.requests_made.append(request)
+            return await handler(request)
+
+        self.get_async_client.return_value = httpx.AsyncClient(transport=httpx.MockTransport(record))
+
+
+class TestBatch(BatchTestMixin, TestCase):
+
+    def test_parse_spec(self):
+        self.assertEqual(('GET', 'courses', None, {}), parse_spec('courses'))
+        self.assertEqual(('POST', 'courses/1/enrollments', 5, {'json': {'enrollment': {}}}),
+                         parse_spec({'method': 'post', 'path': 'courses/1/enrollments', 'timeout': 5,
+                                     'json': {'enrollment': {}}}))
+
+    def test_results_in_completion_order(self):
+        async def handler(request):
+            course_id = int(request.url.path.rsplit('/', 1)[1])
+            await asyncio.sleep(0.01 * (3 - course_id))
+            return httpx.Response(200, json={'id': course_id})
+
+        self.set_handler(handler)
+        results = list(batch(self.request, ['courses/1', 'courses/2', 'courses/3'], concurrency=3))
+        self.assertEqual([2, 1, 0], [result.index for result in results])
+        self.assertEqual([{'id': 3}, {'id': 2}, {'id': 1}], [result.response.json() for result in results])
+        self.assertEqual('https://%s/api/v1/courses/1' % settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+                         str(self.requests_made[0].url))
+        self.assertEqual('Bearer access-token', self.requests_made[0].headers['Authorization'])
+
+    def test_bounds_concurrency(self):
+        in_flight = []
+        peak = []
+
+        async def handler(request):
+            in_flight.append(request)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(request)
+            return httpx.Response(200)
+
+        self.set_handler(handler)
+        results = list(batch(self.request, ('courses/%s' % i for i in range(20)), concurrency=4))
+        self.assertEqual(20, len(results))
+        self.assertEqual(4, max(peak))
+
+    def test_spec_options(self):
+        async def handler(request):
+            return httpx.Response(201)
+
+        self.set_handler(handler)
+        spec = {'method': 'POST', 'path': 'courses/1/enrollments', 'params': {'notify': 'false'},
+                'json': {'enrollment': {'user_id': 1}}}
+        [result] = batch(self.request, [spec])
+        self.assertIs(spec, result.spec)
+        self.assertEqual(201, result.response.status_code)
+        self.assertEqual('POST', self.requests_made[0].method)
+        self.assertEqual(b'notify=false', self.requests_made[0].url.query)
+        self.assertEqual(b'{"enrollment":{"user_id":1}}', self.requests_made[0].content)
+
+    def test_timeout_is_per_request(self):
+        async def handler(request):
+            if request.url.path.endswith('/slow'):
+                await asyncio.sleep(1)
+            return httpx.Response(200)
+
+        self.set_handler(handler)
+        results = {result.spec: result for result in batch(self.request, ['slow', 'fast'], timeout=0.05)}
+        self.assertIsInstance(results['slow'].error, asyncio.TimeoutError)
+        self.assertIsNone(results['slow'].response)
+        self.assertEqual(200, results['fast'].response.status_code)
+
+    def test_no_token_for_other_hosts(self):
+        async def handler(request):
+            return invalid_token_response()
+
+        self.set_handler(handler)
+        with patch('canvas_oauth.batch.oauth.arefresh_oauth_token') as mock_refresh:
+            [result] = batch(self.request, ['https://other/api/v1/courses'])
+        self.assertEqual(401, result.response.status_code)
+        self.assertNotIn('Authorization', self.requests_made[0].headers)
+        self.assertFalse(mock_refresh.called)
+
+    def test_errors_do_not_stop_batch(self):
+        async def handler(request):
+            if request.url.path.endswith('/down'):
+                raise httpx.ConnectError("refused", request=request)
+            return httpx.Response(404)
+
+        self.set_handler(handler)
+        results = {result.spec: result for result in batch(self.request, ['down', 'missing'])}
+        self.assertIsInstance(results['down'].error, httpx.ConnectError)
+        self.assertEqual(404, results['missing'].response.status_code)
+
+    def test_refreshes_rejected_token_once(self):
+        async def handler(request):
+            if request.headers['Authorization'] == 'Bearer access-token':
+                return invalid_token_response()
+            return httpx.Response(200)
+
+        async def refresh(request, oauth_token):
+            oauth_token.access_token = 'new-access-token'
+            return oauth_token
+
+        self.set_handler(handler)
+        with patch('canvas_oauth.batch.oauth.arefresh_oauth_token', AsyncMock(side_effect=refresh)) as mock_refresh:
+            results = list(batch(self.request, ['courses/%s' % i for i in range(10)], concurrency=5))
+        mock_refresh.assert_called_once()
+        self.assertEqual([200] * 10, [result.response.status_code for result in results])
+        self.assertEqual('new-access-token', self.request._canvas_oauth_token_memo[1])
+
+    async def test_refresh_does_not_load_lazy_user(self):
+        async def handler(request):
+            if request.headers['Authorization'] == 'Bearer access-token':
+                return invalid_token_response()
+            return httpx.Response(200)
+
+        async def refresh(request, oauth_token):
+            oauth_token.access_token = 'new-access-token'
+            return oauth_token
+
+        async def auser():
+            return self.user
+
+        def load_user():
+            raise AssertionError("request.user was loaded")
+
+        # As set up by AuthenticationMiddleware on Django 5+
+        self.request.user = SimpleLazyObject(load_user)
+        self.request.auser = auser
+        self.set_handler(handler)
+        with patch('canvas_oauth.batch.oauth.arefresh_oauth_token', AsyncMock(side_effect=refresh)):
+            results = [result async for result in abatch(self.request, ['courses/1'])]
+        self.assertEqual(200, results[0].response.status_code)
+
+    def test_does_not_refresh_twice(self):
+        async def handler(request):
+            return invalid_token_response()
+
+        async def refresh(request, oauth_token):
+            oauth_token.access_token = 'new-access-token'
+            return oauth_token
+
+        self.set_handler(handler)
+        with patch('canvas_oauth.batch.oauth.arefresh_oauth_token', AsyncMock(side_effect=refresh)) as mock_refresh:
+            results = list(batch(self.request, ['courses/1', 'courses/2']))
+        mock_refresh.assert_called_once()
+        self.assertEqual([401, 401], [result.response.status_code for result in results])
+
+    def test_refreshes_expiring_token(self):
+        async def handler(request):
+            # The token expires while the first request is in flight
+            self.oauth_token.expires = timezone.now()
+            return httpx.Response(200)
+
+        async def refresh(request, oauth_token):
+            oauth_token.access_token = 'new-access-token'
+            oauth_token.expires = timezone.now() + timedelta(hours=1)
+            return oauth_token
+
+        self.set_handler(handler)
+        self.request._canvas_oauth_token_memo = (self.oauth_token, 'access-token')
+        with patch('canvas_oauth.batch.oauth.arefresh_oauth_token', AsyncMock(side_effect=refresh)) as mock_refresh:
+            list(batch(self.request, ['courses/1', 'courses/2'], concurrency=1))
+        mock_refresh.assert_called_once()
+        self.assertEqual('Bearer access-token', self.requests_made[0].headers['Authorization'])
+        self.assertEqual('Bearer new-access-token', self.requests_made[1].headers['Authorization'])
+
+    def test_stops_when_closed(self):
+        async def handler(request):
+            return httpx.Response(200)
+
+        self.set_handler(handler)
+        results = batch(self.request, ('courses/%s' % i for i in range(1000)), concurrency=2)
+        next(results)
+        results.close()
+        # Only the requests already started or waiting to hand back a result
+        self.assertLess(len(self.requests_made), 10)
+
+    async def test_abatch(self):
+        async def handler(request):
+            return httpx.Response(200, json={'path': request.url.path})
+
+        self.set_handler(handler)
+        paths = [result.response.json()['path'] async for result in abatch(self.request, ['courses', 'users/self'])]
+        self.assertEqual({'/api/v1/courses', '/api/v1/users/self'}, set(paths))
+
+
+# The async ORM saves the refreshed token from another thread, so it needs
+# to see committed rows
+class TestSyncBatchRefresh(BatchTestMixin, TransactionTestCase):
+
+    def test_refreshes_token(self):
+        async def handler(request):
+            if request.headers['Authorization'] == 'Bearer access-token':
+                return invalid_token_response()
+            return httpx.Response(200)
+
+        self.set_handler(handler)
+        expires = timezone.now() + timedelta(hours=2)
+        # The memo left by get_oauth_token is refreshed on the batch's event loop
+        with patch('canvas_oauth.oauth.canvas.aget_access_token',
+                   AsyncMock(return_value=('new-access-token', expires, None))) as mock_aget_access_token:
+            results = list(batch(self.request, ['courses/1', 'courses/2']))
+        mock_aget_access_token.assert_called_once()
+        self.assertEqual('refresh-token', mock_aget_access_token.call_args[1]['refresh_token'])
+        self.assertEqual([200, 200], [result.response.status_code for result in results])
+        self.oauth_token.refresh_from_db()
+        self.assertEqual('new-access-token', self.oauth_token.access_token)
+        self.assertEqual(expires, self.oauth_token.expires)
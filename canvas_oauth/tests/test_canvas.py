@@ -1,15 +1,23 @@
+import time
 from datetime import timedelta
 from operator import itemgetter
 from urllib.parse import urlencode
 from uuid import uuid4
+from threading import Thread
 from unittest.mock import patch
 
+import httpx
+import requests
 from django.conf import settings
 from django.test import TestCase
 from django.utils import timezone
+from urllib3.exceptions import ProtocolError
 
-from canvas_oauth.exceptions import InvalidOAuthReturnError
+from canvas_oauth import breaker, canvas
+from canvas_oauth.exceptions import (
+    CanvasUnavailableError, InvalidOAuthReturnError, InvalidOAuthTimeoutError)
 from canvas_oauth.canvas import get_oauth_login_url, get_access_token
+from canvas_oauth.tests.utils import make_response
 
 
 class TestGetOauthLoginUrl(TestCase):
@@ -81,8 +89,9 @@ class TestGetAccessToken(TestCase):
         return 'https://%s/login/oauth2/token' % settings.CANVAS_OAUTH_CANVAS_DOMAIN
 
     @patch('canvas_oauth.canvas.timezone.now')
-    @patch('canvas_oauth.canvas.requests.post')
-    def test_authorization_code(self, mock_post, mock_timezone_now):
+    @patch('canvas_oauth.canvas.get_session')
+    def test_authorization_code(self, mock_get_session, mock_timezone_now):
+        mock_post = mock_get_session.return_value.post
         access_token = "29EcPu2JpbOOlss5Lo3BzP5OK4"
         refresh_token = "Io9aGV7HT6UzKawzEkf1aevGm"
         seconds_to_expire = 3600
@@ -111,11 +120,12 @@ class TestGetAccessToken(TestCase):
         expected_tuple = (access_token, expires, refresh_token)
 
         self.assertEqual(expected_tuple, actual_tuple)
-        mock_post.assert_called_with(self.get_token_url(), params)
+        mock_post.assert_called_with(self.get_token_url(), params, timeout=(5, 5))
 
     @patch('canvas_oauth.canvas.timezone.now')
-    @patch('canvas_oauth.canvas.requests.post')
-    def test_refresh_token(self, mock_post, mock_timezone_now):
+    @patch('canvas_oauth.canvas.get_session')
+    def test_refresh_token(self, mock_get_session, mock_timezone_now):
+        mock_post = mock_get_session.return_value.post
         access_token = "29EcPu2JpbOOlss5Lo3BzP5OK4"
         refresh_token = "Io9aGV7HT6UzKawzEkf1aevGm"
         seconds_to_expire = 3600
@@ -144,10 +154,11 @@ class TestGetAccessToken(TestCase):
         expected_tuple = (access_token, expires, refresh_token)
 
         self.assertEqual(expected_tuple, actual_tuple)
-        mock_post.assert_called_with(self.get_token_url(), params)
+        mock_post.assert_called_with(self.get_token_url(), params, timeout=(5, 5))
 
-    @patch('canvas_oauth.canvas.requests.post')
-    def test_authorization_code_error(self, mock_post):
+    @patch('canvas_oauth.canvas.get_session')
+    def test_authorization_code_error(self, mock_get_session):
+        mock_post = mock_get_session.return_value.post
         mock_post.return_value.status_code = 403  # Forbidden
 
         params = dict(
@@ -160,4 +171,302 @@ class TestGetAccessToken(TestCase):
         with self.assertRaises(InvalidOAuthReturnError):
             get_access_token(**params)
 
-        mock_post.assert_called_with(self.get_token_url(), params)
+        mock_post.assert_called_with(self.get_token_url(), params, timeout=(5, 5))
+
+
+class TestPooledSessions(TestCase):
+
+    def setUp(self):
+        canvas._reset_sessions()
+
+    def tearDown(self):
+        canvas._reset_sessions()
+
+    def test_session_is_reused_per_domain(self):
+        session = canvas.get_session('canvas.localhost')
+        self.assertIs(session, canvas.get_session('canvas.localhost'))
+        self.assertIsNot(session, canvas.get_session('canvas-beta.localhost'))
+
+    def test_session_defaults_to_configured_domain(self):
+        self.assertIs(canvas.get_session(), canvas.get_session(settings.CANVAS_OAUTH_CANVAS_DOMAIN))
+
+    def test_session_is_shared_across_threads(self):
+        sessions = []
+        threads = [Thread(target=lambda: sessions.append(canvas.get_session('canvas.localhost')))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(set(map(id, sessions))))
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_POOL_SIZE', 3)
+    def test_pool_stats(self):
+        canvas.get_session('canvas.localhost')
+        stats = canvas.get_pool_stats()
+        self.assertEqual({
+            'canvas.localhost': {
+                'pool_size': 3,
+                'connections_opened': 0,
+                'requests': 0,
+                'reused': 0,
+            }
+        }, stats)
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT', 30)
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_CONNECT_TIMEOUT', 2)
+    def test_timeout_is_configurable(self):
+        self.assertEqual((2, 30), canvas.get_timeout())
+
+    def test_warm_sessions(self):
+        with patch.object(canvas.get_session('canvas.localhost'), 'head') as mock_head:
+            canvas.warm_sessions(['canvas.localhost'])
+        mock_head.assert_called_with('https://canvas.localhost/', timeout=(5, 5))
+
+
+def token_response(status_code=200, headers=None):
+    return make_response(status_code, headers, json={'access_token': 'access-token', 'expires_in': 3600},
+                         text='error')
+
+
+@patch('canvas_oauth.canvas.time.sleep')
+@patch('canvas_oauth.canvas.get_session')
+class TestRetries(TestCase):
+
+    def setUp(self):
+        breaker.reset_breakers()
+        self.addCleanup(breaker.reset_breakers)
+
+    def refresh(self):
+        return get_access_token('refresh_token', 'id', 'secret', None, refresh_token='token')
+
+    def authorize(self):
+        return get_access_token('authorization_code', 'id', 'secret', '/oauth/oauth-callback', code='code')
+
+    def test_refresh_retries_server_errors_and_timeouts(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.side_effect = [token_response(503), requests.ReadTimeout(), token_response()]
+        self.assertEqual('access-token', self.refresh()[0])
+        self.assertEqual(3, mock_post.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+
+    def test_retries_are_bounded(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = token_response(502)
+        with self.assertRaises(CanvasUnavailableError):
+            self.refresh()
+        self.assertEqual(3, mock_post.call_count)
+
+    def test_client_errors_are_not_retried(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = token_response(400)
+        with self.assertRaises(InvalidOAuthReturnError):
+            self.refresh()
+        self.assertEqual(1, mock_post.call_count)
+
+    def test_authorization_code_is_only_retried_before_reaching_canvas(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.side_effect = [requests.ConnectTimeout(), requests.ReadTimeout()]
+        with self.assertRaises(InvalidOAuthTimeoutError):
+            self.authorize()
+        self.assertEqual(2, mock_post.call_count)
+
+    def test_authorization_code_is_not_retried_after_dropped_connection(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.side_effect = requests.ConnectionError(ProtocolError('Connection aborted.'))
+        with self.assertRaises(CanvasUnavailableError):
+            self.authorize()
+        self.assertEqual(1, mock_post.call_count)
+
+    def test_refresh_retries_dropped_connection(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.side_effect = [requests.ConnectionError(ProtocolError('Connection aborted.')), token_response()]
+        self.assertEqual('access-token', self.refresh()[0])
+        self.assertEqual(2, mock_post.call_count)
+
+    def test_retry_after(self, mock_get_session, mock_sleep):
+        mock_get_session.return_value.post.side_effect = [
+            token_response(429, {'Retry-After': '1'}), token_response()]
+        self.refresh()
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 1)
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_DEADLINE', 0.1)
+    def test_deadline(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = token_response(429, {'Retry-After': '1'})
+        with self.assertRaises(CanvasUnavailableError):
+            self.refresh()
+        self.assertEqual(1, mock_post.call_count)
+        self.assertLessEqual(mock_post.call_args[1]['timeout'][1], 0.1)
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_RETRY_BACKOFF', 0)
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_DEADLINE', 0.1)
+    def test_deadline_passed_while_sleeping(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.side_effect = [token_response(503), token_response()]
+
+        def oversleep(delay):
+            start = time.monotonic()
+            while time.monotonic() - start < 0.15:
+                pass
+
+        mock_sleep.side_effect = oversleep
+        with self.assertRaises(CanvasUnavailableError) as cm:
+            self.refresh()
+        self.assertIn("deadline", str(cm.exception))
+        self.assertEqual(1, mock_post.call_count)
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_RETRIES', 0)
+    def test_breaker_fails_fast(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = token_response(500)
+        for _ in range(5):
+            with self.assertRaises(CanvasUnavailableError):
+                self.refresh()
+        with self.assertRaises(CanvasUnavailableError) as cm:
+            self.refresh()
+        self.assertIn("unavailable", str(cm.exception))
+        self.assertEqual(5, mock_post.call_count)
+        self.assertEqual({'state': 'open', 'failures': 5},
+                         breaker.get_breaker_stats()[settings.CANVAS_OAUTH_CANVAS_DOMAIN])
+
+
+class TestCircuitBreaker(TestCase):
+
+    @patch('canvas_oauth.breaker.settings.CANVAS_OAUTH_CIRCUIT_BREAKER_RESET_TIMEOUT', 0)
+    @patch('canvas_oauth.breaker.settings.CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD', 2)
+    def test_half_open(self):
+        circuit = breaker.CircuitBreaker('canvas.localhost')
+        circuit.record_failure()
+        self.assertEqual('closed', circuit.state)
+        circuit.record_failure()
+        self.assertEqual('open', circuit.state)
+        # One trial request is let through
+        self.assertTrue(circuit.allow())
+        self.assertEqual('half_open', circuit.state)
+        circuit.record_failure()
+        self.assertEqual('open', circuit.state)
+        self.assertTrue(circuit.allow())
+        circuit.record_success()
+        self.assertEqual('closed', circuit.state)
+        self.assertEqual(0, circuit.failures)
+
+    @patch('canvas_oauth.breaker.settings.CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD', 2)
+    def test_stays_open_until_reset_timeout(self):
+        circuit = breaker.CircuitBreaker('canvas.localhost')
+        circuit.record_failure()
+        circuit.record_failure()
+        self.assertFalse(circuit.allow())
+
+    @patch('canvas_oauth.breaker.settings.CANVAS_OAUTH_CIRCUIT_BREAKER_THRESHOLD', 0)
+    def test_disabled(self):
+        circuit = breaker.CircuitBreaker('canvas.localhost')
+        for _ in range(10):
+            circuit.record_failure()
+        self.assertTrue(circuit.allow())
+
+
+class TestAsyncGetAccessToken(TestCase):
+
+    def get_client(self, handler):
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_refresh_token(self, mock_get_async_client):
+        requests_made = []
+
+        def handler(request):
+            requests_made.append(request)
+            return httpx.Response(200, json={"access_token": "access-token", "expires_in": 3600})
+
+        mock_get_async_client.return_value = self.get_client(handler)
+        access_token, expires, refresh_token = await canvas.aget_access_token(
+            grant_type='refresh_token',
+            refresh_token="zMaP0572EUof7iA83n6rmElC",
+            client_id=settings.CANVAS_OAUTH_CLIENT_ID,
+            client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+            redirect_uri=None)
+
+        self.assertEqual("access-token", access_token)
+        self.assertIsNone(refresh_token)
+        self.assertAlmostEqual(timezone.now() + timedelta(hours=1), expires, delta=timedelta(seconds=5))
+        self.assertEqual('https://canvas.localhost/login/oauth2/token', str(requests_made[0].url))
+        # None values are left out of the form rather than sent empty
+        self.assertEqual(
+            b'grant_type=refresh_token&client_id=101&client_secret=fake-secret&refresh_token=zMaP0572EUof7iA83n6rmElC',
+            requests_made[0].content)
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_error(self, mock_get_async_client):
+        mock_get_async_client.return_value = self.get_client(lambda request: httpx.Response(403))
+        with self.assertRaises(InvalidOAuthReturnError):
+            await canvas.aget_access_token(
+                grant_type='authorization_code', code="D5xNoAMwrwSNI5P16zKeXxjT",
+                client_id=settings.CANVAS_OAUTH_CLIENT_ID, client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+                redirect_uri='/oauth/oauth-callback')
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_timeout(self, mock_get_async_client):
+        def handler(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        mock_get_async_client.return_value = self.get_client(handler)
+        with self.assertRaises(InvalidOAuthTimeoutError):
+            await canvas.aget_access_token(
+                grant_type='authorization_code', code="D5xNoAMwrwSNI5P16zKeXxjT",
+                client_id=settings.CANVAS_OAUTH_CLIENT_ID, client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+                redirect_uri='/oauth/oauth-callback')
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_dropped_connection(self, mock_get_async_client):
+        def handler(request):
+            raise httpx.RemoteProtocolError("Server disconnected", request=request)
+
+        mock_get_async_client.return_value = self.get_client(handler)
+        breaker.reset_breakers()
+        with self.assertRaises(CanvasUnavailableError) as cm:
+            await canvas.aget_access_token(
+                grant_type='authorization_code', code="D5xNoAMwrwSNI5P16zKeXxjT",
+                client_id=settings.CANVAS_OAUTH_CLIENT_ID, client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+                redirect_uri='/oauth/oauth-callback')
+        self.assertNotIsInstance(cm.exception, InvalidOAuthTimeoutError)
+
+    async def test_client_keeps_no_cookies(self):
+        def handler(request):
+            return httpx.Response(200, headers={'Set-Cookie': 'canvas_session=user-a; Path=/'},
+                                  text=request.headers.get('Cookie', ''))
+
+        transport = httpx.MockTransport(handler)
+        real_client = httpx.AsyncClient
+        with patch('httpx.AsyncClient', lambda **kwargs: real_client(transport=transport, **kwargs)):
+            client = canvas.get_async_client('canvas-cookies.localhost')
+        await client.get('https://canvas-cookies.localhost/api/v1/courses')
+        # Another user's request through the same client
+        r = await client.get('https://canvas-cookies.localhost/api/v1/courses')
+        self.assertEqual('', r.text)
+        await canvas.aclose_async_clients()
+
+    async def test_client_is_reused_per_domain(self):
+        client = canvas.get_async_client('canvas.localhost')
+        self.assertIs(client, canvas.get_async_client('canvas.localhost'))
+        self.assertIsNot(client, canvas.get_async_client('canvas-beta.localhost'))
+
+    async def test_close_async_clients(self):
+        client = canvas.get_async_client('canvas.localhost')
+        await canvas.aclose_async_clients()
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(client, canvas.get_async_client('canvas.localhost'))
+
+    @patch('canvas_oauth.canvas.asyncio.sleep')
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_retries(self, mock_get_async_client, mock_sleep):
+        responses = [httpx.Response(503),
+                     httpx.Response(200, json={"access_token": "access-token", "expires_in": 3600})]
+        mock_get_async_client.return_value = self.get_client(lambda request: responses.pop(0))
+        breaker.reset_breakers()
+        access_token, _, _ = await canvas.aget_access_token(
+            grant_type='refresh_token', refresh_token="zMaP0572EUof7iA83n6rmElC",
+            client_id=settings.CANVAS_OAUTH_CLIENT_ID, client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+            redirect_uri=None)
+        self.assertEqual("access-token", access_token)
+        self.assertEqual(1, mock_sleep.call_count)
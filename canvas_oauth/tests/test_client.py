@@ -0,0 +1,338 @@
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from canvas_oauth import canvas, throttle, tracing
+from canvas_oauth.client import CanvasClient
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.tests.utils import (
+    TokenTestMixin, create_token, make_real_response, make_request, make_response)
+
+INVALID_TOKEN_RESPONSE = make_response(401, {'WWW-Authenticate': 'Bearer realm="canvas-lms"'})
+
+
+class ClientTestMixin(TokenTestMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.client = CanvasClient(self.request)
+
+        patcher = patch('canvas_oauth.client.canvas.get_session')
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def get_authorization(self, call):
+        return call[1]['headers']['Authorization']
+
+
+class TestCanvasClient(ClientTestMixin, TestCase):
+
+    def test_get(self):
+        self.session.request.return_value = make_response(json=[{'id': 1}])
+        r = self.client.get('courses', params={'per_page': 100})
+        self.assertEqual([{'id': 1}], r.json())
+        self.session.request.assert_called_once_with(
+            'GET', 'https://%s/api/v1/courses' % settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+            params={'per_page': 100}, headers={'Authorization': 'Bearer access-token'},
+            timeout=(5, 5))
+
+    def test_urls(self):
+        domain = settings.CANVAS_OAUTH_CANVAS_DOMAIN
+        self.assertEqual('https://%s/api/v1/courses/1' % domain, self.client.get_url('courses/1'))
+        self.assertEqual('https://%s/api/graphql' % domain, self.client.get_url('/api/graphql'))
+        self.assertEqual('https://other/api/v1/courses?page=2',
+                         self.client.get_url('https://other/api/v1/courses?page=2'))
+        self.request.canvas_oauth_canvas_domain = 'canvas-beta.localhost'
+        self.assertEqual('https://canvas-beta.localhost/api/v1/courses/1', self.client.get_url('courses/1'))
+
+    def test_no_token_for_other_hosts(self):
+        self.session.request.return_value = INVALID_TOKEN_RESPONSE
+        for url in ('https://other/api/v1/courses', 'http://%s/api/v1/courses' % settings.CANVAS_OAUTH_CANVAS_DOMAIN):
+            self.client.get(url)
+            self.assertNotIn('Authorization', self.session.request.call_args[1]['headers'])
+        # Nor is the token refreshed when another host rejects the request
+        self.assertEqual(2, self.session.request.call_count)
+
+    def test_keeps_headers(self):
+        self.session.request.return_value = make_response()
+        self.client.post('courses/1/enrollments', json={'enrollment': {}}, headers={'Accept': 'application/json'})
+        self.assertEqual({'Accept': 'application/json', 'Authorization': 'Bearer access-token'},
+                         self.session.request.call_args[1]['headers'])
+
+    def test_token_looked_up_once(self):
+        self.session.request.return_value = make_response()
+        self.client.get('courses')
+        with self.assertNumQueries(0):
+            self.client.get('courses')
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refreshes_and_replays_on_invalid_token(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        self.session.request.side_effect = [INVALID_TOKEN_RESPONSE, make_response(json={'id': 1})]
+
+        r = self.client.get('courses/1')
+
+        self.assertEqual({'id': 1}, r.json())
+        self.assertEqual(1, mock_get_access_token.call_count)
+        first, second = self.session.request.call_args_list
+        self.assertEqual('Bearer access-token', self.get_authorization(first))
+        self.assertEqual('Bearer new-access-token', self.get_authorization(second))
+        self.assertEqual('new-access-token', CanvasOAuth2Token.objects.get().access_token)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_replays_only_once(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        self.session.request.return_value = INVALID_TOKEN_RESPONSE
+        r = self.client.get('courses/1')
+        self.assertEqual(401, r.status_code)
+        self.assertEqual(2, self.session.request.call_count)
+        self.assertEqual(1, mock_get_access_token.call_count)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_unauthorized_without_invalid_token_is_returned(self, mock_get_access_token):
+        self.session.request.return_value = make_response(401)
+        r = self.client.get('courses/1')
+        self.assertEqual(401, r.status_code)
+        self.assertEqual(1, self.session.request.call_count)
+        self.assertFalse(mock_get_access_token.called)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_reuses_token_refreshed_by_another_call(self, mock_get_access_token):
+        self.session.request.return_value = make_response()
+        self.client.get('courses')
+        self.request._canvas_oauth_token_memo = (self.request._canvas_oauth_token_memo[0], 'new-access-token')
+        self.assertEqual('new-access-token', self.client._refresh('access-token'))
+        self.assertFalse(mock_get_access_token.called)
+
+
+class TestPaginate(ClientTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.base_url = 'https://%s/api/v1/courses/1/users' % settings.CANVAS_OAUTH_CANVAS_DOMAIN
+        self.requested = []
+
+    def serve_pages(self, count, numbered=True, include_last=True):
+        def page_url(page):
+            if numbered:
+                return '%s?include%%5B%%5D=email&page=%d&per_page=2' % (self.base_url, page)
+            return '%s?page=bookmark:%d&per_page=2' % (self.base_url, page)
+
+        def request(method, url, **kwargs):
+            self.requested.append(url)
+            page = 1 if url == self.base_url else int(url.split('page=')[1].split('&')[0].split(':')[-1])
+            links = {}
+            if page < count:
+                links['next'] = {'url': page_url(page + 1)}
+            if include_last:
+                links['last'] = {'url': page_url(count)}
+            r = make_response(json=[page * 10 + 1, page * 10 + 2])
+            r.links = links
+            return r
+        self.session.request.side_effect = request
+
+    def test_follows_next_links(self):
+        self.serve_pages(3)
+        items = list(self.client.paginate('courses/1/users', params={'per_page': 2}))
+        self.assertEqual([11, 12, 21, 22, 31, 32], items)
+        self.assertEqual(3, len(self.requested))
+
+    def test_yields_items_as_pages_arrive(self):
+        self.serve_pages(3)
+        items = self.client.paginate('courses/1/users')
+        self.assertEqual(11, next(items))
+        self.assertEqual(1, len(self.requested))
+
+    def test_prefetches_numbered_pages(self):
+        self.serve_pages(5)
+        items = list(self.client.paginate('courses/1/users', prefetch=2))
+        self.assertEqual([11, 12, 21, 22, 31, 32, 41, 42, 51, 52], items)
+        self.assertEqual(5, len(self.requested))
+        self.assertIn('%s?include%%5B%%5D=email&page=4&per_page=2' % self.base_url, self.requested)
+
+    @patch('canvas_oauth.tracing.settings.CANVAS_OAUTH_TRACING_EXPORTER', 'canvas_oauth.tracing.InMemoryExporter')
+    def test_prefetch_threads_share_token_and_trace(self):
+        self.serve_pages(4)
+        threads = []
+
+        def record_thread(request):
+            threads.append(threading.current_thread())
+            return get_oauth_token(request)
+
+        with patch('canvas_oauth.client.oauth.get_oauth_token', side_effect=record_thread):
+            with tracing.span('sync') as span:
+                list(self.client.paginate('courses/1/users', prefetch=2))
+        self.assertEqual({threading.current_thread()}, set(threads))
+        for call in self.session.request.call_args_list:
+            self.assertEqual('Bearer access-token', self.get_authorization(call))
+            self.assertIn(span.trace_id, call[1]['headers']['traceparent'])
+
+    def test_prefetch_falls_back_to_next_links(self):
+        self.serve_pages(3, numbered=False)
+        self.assertEqual([11, 12, 21, 22, 31, 32], list(self.client.paginate('courses/1/users', prefetch=4)))
+        self.serve_pages(3, include_last=False)
+        self.assertEqual([11, 12, 21, 22, 31, 32], list(self.client.paginate('courses/1/users', prefetch=4)))
+
+    def test_prefetch_is_bounded(self):
+        self.serve_pages(20)
+        items = self.client.paginate('courses/1/users', prefetch=3)
+        self.assertEqual([11, 12, 21, 22], [next(items) for _ in range(4)])
+        items.close()
+        # The first page, then at most three pages in flight
+        self.assertLessEqual(len(self.requested), 1 + 1 + 3)
+
+    def test_key(self):
+        r = make_response(json={'enrollment_terms': [{'id': 1}]})
+        r.links = {}
+        self.session.request.return_value = r
+        self.assertEqual([{'id': 1}], list(self.client.paginate('accounts/1/terms', key='enrollment_terms')))
+
+
+@override_settings(CANVAS_OAUTH_API_CACHE_ALIAS='default')
+class TestAPICache(ClientTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_revalidates_with_etag(self):
+        self.session.request.side_effect = [
+            make_real_response(headers={'ETag': '"v1"', 'Content-Type': 'application/json'}, body=b'{"id": 1}'),
+            make_real_response(304, headers={'ETag': '"v1"'}),
+        ]
+        self.assertEqual({'id': 1}, self.client.get('courses/1').json())
+
+        r = self.client.get('courses/1')
+
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({'id': 1}, r.json())
+        self.assertTrue(r.from_cache)
+        self.assertEqual('application/json', r.headers['Content-Type'])
+        self.assertEqual('"v1"', self.session.request.call_args[1]['headers']['If-None-Match'])
+
+    def test_last_modified(self):
+        last_modified = 'Wed, 21 Oct 2026 07:28:00 GMT'
+        self.session.request.side_effect = [
+            make_real_response(headers={'Last-Modified': last_modified}, body=b'[]'),
+            make_real_response(304),
+        ]
+        self.client.get('courses/1')
+        self.assertEqual([], self.client.get('courses/1').json())
+        self.assertEqual(last_modified, self.session.request.call_args[1]['headers']['If-Modified-Since'])
+
+    def test_changed_resource_is_replaced(self):
+        self.session.request.side_effect = [
+            make_real_response(headers={'ETag': '"v1"'}, body=b'1'),
+            make_real_response(headers={'ETag': '"v2"'}, body=b'2'),
+            make_real_response(304),
+        ]
+        self.client.get('courses/1')
+        self.assertEqual(2, self.client.get('courses/1').json())
+        self.assertEqual(2, self.client.get('courses/1').json())
+        self.assertEqual('"v2"', self.session.request.call_args[1]['headers']['If-None-Match'])
+
+    def test_keyed_by_user_and_params(self):
+        self.session.request.return_value = make_real_response(headers={'ETag': '"v1"'}, body=b'1')
+        self.client.get('courses/1')
+        self.client.get('courses/1', params={'include[]': 'term'})
+        self.assertNotIn('If-None-Match', self.session.request.call_args[1]['headers'])
+
+        other_user = User.objects.create_user(username='other')
+        create_token(other_user, 'other-access-token')
+        CanvasClient(make_request(other_user)).get('courses/1')
+        self.assertNotIn('If-None-Match', self.session.request.call_args[1]['headers'])
+
+    def test_unstorable_responses(self):
+        self.session.request.side_effect = [
+            make_real_response(body=b'1'),
+            make_real_response(headers={'ETag': '"v1"', 'Cache-Control': 'no-store'}, body=b'1'),
+            make_real_response(headers={'ETag': '"v1"'}, body=b'1' * 11),
+            make_real_response(body=b'1'),
+        ]
+        with override_settings(CANVAS_OAUTH_API_CACHE_MAX_SIZE=10):
+            for _ in range(4):
+                self.client.get('courses/1')
+        self.assertNotIn('If-None-Match', self.session.request.call_args[1]['headers'])
+
+    def test_only_gets_are_cached(self):
+        self.session.request.return_value = make_real_response(headers={'ETag': '"v1"'}, body=b'1')
+        self.client.post('courses/1', data={'name': 'x'})
+        self.client.get('courses/1')
+        self.assertNotIn('If-None-Match', self.session.request.call_args[1]['headers'])
+
+
+@override_settings(CANVAS_OAUTH_API_THROTTLE=True)
+class TestThrottledClient(ClientTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        throttle.reset_throttles()
+        self.addCleanup(throttle.reset_throttles)
+
+    def test_records_budget(self):
+        r = make_response(json=[])
+        r.headers = {'X-Rate-Limit-Remaining': '600.0', 'X-Request-Cost': '1.5'}
+        self.session.request.return_value = r
+        self.client.get('courses')
+        stats = throttle.get_throttle_stats()
+        self.assertEqual(1, len(stats))
+        self.assertAlmostEqual(600, list(stats.values())[0]['remaining'], delta=1)
+
+    @patch('canvas_oauth.throttle.REFILL_RATE', 10000.0)
+    def test_retries_throttled_requests(self):
+        throttled = make_response(403)
+        throttled.text = '403 Forbidden (Rate Limit Exceeded)'
+        self.session.request.side_effect = [throttled, make_response(json={'id': 1})]
+        self.assertEqual({'id': 1}, self.client.get('courses/1').json())
+        self.assertEqual(2, self.session.request.call_count)
+
+    @override_settings(CANVAS_OAUTH_HTTP_RETRIES=1)
+    @patch('canvas_oauth.throttle.REFILL_RATE', 10000.0)
+    def test_gives_up_after_retries(self):
+        throttled = make_response(429)
+        self.session.request.return_value = throttled
+        self.assertEqual(429, self.client.get('courses/1').status_code)
+        self.assertEqual(2, self.session.request.call_count)
+
+
+class CookieHandler(BaseHTTPRequestHandler):
+    """Sets a session cookie and answers with the cookies it was sent."""
+
+    def do_GET(self):
+        body = (self.headers.get('Cookie') or '').encode()
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'canvas_session=user-a; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSharedSession(SimpleTestCase):
+
+    def setUp(self):
+        canvas._reset_sessions()
+        self.addCleanup(canvas._reset_sessions)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), CookieHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.domain = '127.0.0.1:%s' % server.server_address[1]
+
+    def test_cookies_are_not_shared_between_calls(self):
+        url = 'http://%s/api/v1/courses' % self.domain
+        session = canvas.get_session(self.domain)
+        self.assertIn('canvas_session', session.get(url, timeout=5).headers['Set-Cookie'])
+        # Another user's request over the same session
+        self.assertEqual(b'', session.get(url, timeout=5).content)
+        self.assertEqual(0, len(session.cookies))
@@ -0,0 +1,225 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from canvas_oauth.exceptions import InvalidOAuthReturnError
+from canvas_oauth.models import CanvasOAuth2Token
+
+OLD_KEY = Fernet.generate_key()
+NEW_KEY = Fernet.generate_key()
+
+
+def create_tokens(count, access_token=lambda i: 'access-token-%d' % i,
+                  refresh_token=lambda i: 'refresh-token-%d' % i, expires_in=3600):
+    tokens = []
+    for i in range(count):
+        user = User.objects.create_user(username='user%d' % i)
+        tokens.append(CanvasOAuth2Token.objects.create(
+            user=user,
+            access_token=access_token(i),
+            refresh_token=refresh_token(i),
+            expires=timezone.now() + timedelta(seconds=expires_in)))
+    return tokens
+
+
+def encrypt(key, value):
+    return Fernet(key).encrypt(value.encode()).decode()
+
+
+def decrypt(key, value):
+    return Fernet(key).decrypt(value.encode()).decode()
+
+
+@patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [NEW_KEY, OLD_KEY])
+class TestRotateCanvasOAuthKeys(TestCase):
+
+    def rotate(self, *args):
+        out = StringIO()
+        call_command('rotate_canvas_oauth_keys', *args, stdout=out)
+        return out.getvalue()
+
+    def test_rotates_to_primary_key(self):
+        create_tokens(5, access_token=lambda i: encrypt(OLD_KEY, 'access-token-%d' % i),
+                      refresh_token=lambda i: encrypt(OLD_KEY, 'refresh-token-%d' % i))
+
+        output = self.rotate('--batch-size', '2', '--chunk-size', '3')
+
+        for i, oauth_token in enumerate(CanvasOAuth2Token.objects.order_by('pk')):
+            self.assertEqual('access-token-%d' % i, decrypt(NEW_KEY, oauth_token.access_token))
+            self.assertEqual('refresh-token-%d' % i, decrypt(NEW_KEY, oauth_token.refresh_token))
+        self.assertIn("Rotated 5 tokens and skipped 0", output)
+        self.assertIn("rows/sec", output)
+
+    def test_resumes_after_id(self):
+        tokens = create_tokens(3, access_token=lambda i: encrypt(OLD_KEY, 'access-token'),
+                               refresh_token=lambda i: encrypt(OLD_KEY, 'refresh-token'))
+
+        self.rotate('--start-after', str(tokens[0].pk))
+
+        first, second, third = CanvasOAuth2Token.objects.order_by('pk')
+        self.assertEqual('access-token', decrypt(OLD_KEY, first.access_token))
+        self.assertEqual('access-token', decrypt(NEW_KEY, second.access_token))
+        self.assertEqual('access-token', decrypt(NEW_KEY, third.access_token))
+
+    def test_plain_text_tokens(self):
+        create_tokens(1)
+
+        output = self.rotate()
+        self.assertEqual('access-token-0', CanvasOAuth2Token.objects.get().access_token)
+        self.assertIn("skipped 1", output)
+
+        self.rotate('--encrypt-plaintext')
+        self.assertEqual('access-token-0', decrypt(NEW_KEY, CanvasOAuth2Token.objects.get().access_token))
+
+    def test_requires_keyring(self):
+        with patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', []):
+            with self.assertRaises(CommandError):
+                self.rotate()
+
+
+@patch('canvas_oauth.refresh.canvas.get_access_token')
+class TestRefreshExpiringCanvasTokens(TestCase):
+
+    def refresh(self, *args):
+        out = StringIO()
+        call_command('refresh_expiring_canvas_tokens', '--jitter', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def test_refreshes_expiring_tokens(self, mock_get_access_token):
+        expires = timezone.now() + timedelta(hours=1)
+        mock_get_access_token.return_value = ('new-access-token', expires, None)
+        expiring = create_tokens(3, expires_in=60)
+        not_expiring = CanvasOAuth2Token.objects.create(
+            user=User.objects.create_user(username='other'),
+            access_token='access-token',
+            refresh_token='refresh-token',
+            expires=timezone.now() + timedelta(hours=2))
+
+        output = self.refresh('--window', '300', '--batch-size', '2')
+
+        self.assertEqual(3, mock_get_access_token.call_count)
+        mock_get_access_token.assert_any_call(
+            domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+            grant_type='refresh_token',
+            client_id=settings.CANVAS_OAUTH_CLIENT_ID,
+            client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+            redirect_uri=None,
+            refresh_token='refresh-token-0')
+        for oauth_token in expiring:
+            oauth_token.refresh_from_db()
+            self.assertEqual('new-access-token', oauth_token.access_token)
+            self.assertEqual(expires, oauth_token.expires)
+        not_expiring.refresh_from_db()
+        self.assertEqual('access-token', not_expiring.access_token)
+        self.assertIn("Refreshed 3 tokens, 0 failed, 0 skipped", output)
+
+    def test_refreshes_expired_tokens(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        create_tokens(1, expires_in=-3600)
+        output = self.refresh()
+        self.assertEqual('new-access-token', CanvasOAuth2Token.objects.get().access_token)
+        self.assertIn("Refreshed 1 tokens", output)
+
+    def test_skips_inactive_tokens(self, mock_get_access_token):
+        create_tokens(1, expires_in=60)
+        CanvasOAuth2Token.objects.update(updated_on=timezone.now() - timedelta(days=2))
+        self.refresh('--active-within', '24')
+        self.assertFalse(mock_get_access_token.called)
+
+    def test_reports_failures(self, mock_get_access_token):
+        mock_get_access_token.side_effect = InvalidOAuthReturnError("invalid_grant")
+        create_tokens(2, expires_in=60)
+        output = self.refresh()
+        self.assertEqual('access-token-0', CanvasOAuth2Token.objects.order_by('pk').first().access_token)
+        self.assertIn("Refreshed 0 tokens, 2 failed, 0 skipped", output)
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [NEW_KEY])
+    def test_encrypted_tokens(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        create_tokens(1, expires_in=60, access_token=lambda i: encrypt(NEW_KEY, 'access-token'),
+                      refresh_token=lambda i: encrypt(NEW_KEY, 'refresh-token'))
+        self.refresh()
+        self.assertEqual('refresh-token', mock_get_access_token.call_args[1]['refresh_token'])
+        self.assertEqual('new-access-token', decrypt(NEW_KEY, CanvasOAuth2Token.objects.get().access_token))
+
+    def test_session_encrypted_tokens_are_not_refreshed(self, mock_get_access_token):
+        session_key = Fernet.generate_key()
+        create_tokens(1, expires_in=60, refresh_token=lambda i: encrypt(session_key, 'refresh-token'))
+        output = self.refresh()
+        self.assertFalse(mock_get_access_token.called)
+        self.assertIn("1 failed", output)
+
+    @patch('canvas_oauth.management.commands.refresh_expiring_canvas_tokens.time.sleep')
+    def test_daemon(self, mock_sleep, mock_get_access_token):
+        mock_sleep.side_effect = [None, KeyboardInterrupt]
+        output = self.refresh('--daemon', '--interval', '30')
+        mock_sleep.assert_called_with(30)
+        self.assertEqual(2, output.count("Refreshed 0 tokens"))
+
+
+class TestPurgeCanvasOAuthTokens(TestCase):
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command('purge_canvas_oauth_tokens', '--sleep', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def setUp(self):
+        tokens = create_tokens(7)
+        self.stale_pks = [oauth_token.pk for oauth_token in tokens[::2]]
+        CanvasOAuth2Token.objects.filter(pk__in=self.stale_pks).update(
+            updated_on=timezone.now() - timedelta(days=200))
+
+    def test_deletes_stale_tokens(self):
+        output = self.purge('--days', '180', '--batch-size', '2')
+        self.assertEqual(3, CanvasOAuth2Token.objects.count())
+        self.assertFalse(CanvasOAuth2Token.objects.filter(pk__in=self.stale_pks).exists())
+        self.assertIn("Deleted 4 tokens", output)
+        self.assertIn("rows/sec", output)
+
+    def test_dry_run(self):
+        output = self.purge('--days', '180', '--dry-run')
+        self.assertEqual(7, CanvasOAuth2Token.objects.count())
+        self.assertIn("4 tokens not refreshed since", output)
+
+    def test_keeps_recent_tokens(self):
+        self.purge('--days', '365')
+        self.assertEqual(7, CanvasOAuth2Token.objects.count())
+
+    @patch('canvas_oauth.management.commands.purge_canvas_oauth_tokens.time.sleep')
+    def test_sleeps_between_batches(self, mock_sleep):
+        self.purge('--days', '180', '--batch-size', '3', '--sleep', '0.25')
+        mock_sleep.assert_called_once_with(0.25)
+
+    @patch('canvas_oauth.management.commands.purge_canvas_oauth_tokens.time.sleep')
+    def test_sleeps_after_empty_batch(self, mock_sleep):
+        def refresh_next_token(seconds):
+            # the second stale token is refreshed before its batch deletes it
+            if mock_sleep.call_count == 1:
+                CanvasOAuth2Token.objects.filter(pk=self.stale_pks[1]).update(updated_on=timezone.now())
+        mock_sleep.side_effect = refresh_next_token
+
+        output = self.purge('--days', '180', '--batch-size', '1', '--sleep', '0.25')
+
+        self.assertIn("Deleted 3 tokens (", output)
+        self.assertEqual(3, mock_sleep.call_count)
+
+    @patch('canvas_oauth.management.commands.purge_canvas_oauth_tokens.time.sleep')
+    def test_skips_gaps_in_keys(self, mock_sleep):
+        CanvasOAuth2Token.objects.filter(pk__in=self.stale_pks[:-1]).delete()
+        CanvasOAuth2Token.objects.filter(pk=self.stale_pks[-1]).update(id=10 ** 9)
+        output = self.purge('--days', '180', '--batch-size', '2', '--sleep', '0.25')
+        self.assertIn("Deleted 1 tokens (", output)
+        self.assertFalse(mock_sleep.called)
+
+    def test_empty_table(self):
+        CanvasOAuth2Token.objects.all().delete()
+        self.assertIn("Deleted 0 tokens", self.purge())
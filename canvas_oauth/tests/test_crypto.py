@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+from unittest.mock import patch
+
+from canvas_oauth import crypto
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.refresh import get_oauth_tokens
+from canvas_oauth.tests.utils import create_token, make_request
+
+OLD_KEY = Fernet.generate_key()
+NEW_KEY = Fernet.generate_key()
+SESSION_KEY = Fernet.generate_key()
+
+
+def get_request(session):
+    request = RequestFactory().get('/index')
+    request.session = session
+    return request
+
+
+class TestGetCipher(TestCase):
+
+    def test_plain_text(self):
+        cipher = crypto.get_cipher(get_request({}))
+        self.assertIsNone(cipher)
+        self.assertEqual('access-token', crypto.encrypt('access-token', cipher))
+        self.assertEqual('access-token', crypto.decrypt('access-token', cipher))
+
+    def test_session_key(self):
+        cipher = crypto.get_cipher(get_request({'canvas_oauth_token_key': SESSION_KEY}))
+        encrypted = crypto.encrypt('access-token', cipher)
+        self.assertEqual('access-token', Fernet(SESSION_KEY).decrypt(encrypted.encode()).decode())
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [NEW_KEY, OLD_KEY])
+    def test_keyring(self):
+        encrypted = Fernet(OLD_KEY).encrypt(b'access-token').decode()
+        cipher = crypto.get_cipher()
+        self.assertEqual('access-token', crypto.decrypt(encrypted, cipher))
+        encrypted = crypto.encrypt('access-token', cipher)
+        self.assertEqual('access-token', Fernet(NEW_KEY).decrypt(encrypted.encode()).decode())
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [NEW_KEY])
+    def test_keyring_reads_plain_text(self):
+        self.assertEqual('1~access-token', crypto.decrypt('1~access-token', crypto.get_cipher()))
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [NEW_KEY])
+    def test_keyring_takes_precedence_over_session_key(self):
+        encrypted = Fernet(SESSION_KEY).encrypt(b'access-token').decode()
+        cipher = crypto.get_cipher(get_request({'canvas_oauth_token_key': SESSION_KEY}))
+        self.assertEqual('access-token', crypto.decrypt(encrypted, cipher))
+        encrypted = crypto.encrypt('access-token', cipher)
+        self.assertEqual('access-token', Fernet(NEW_KEY).decrypt(encrypted.encode()).decode())
+        with self.assertRaises(InvalidToken):
+            Fernet(SESSION_KEY).decrypt(encrypted.encode())
+
+    def test_keyring_is_built_once(self):
+        keys = [NEW_KEY]
+        with patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', keys):
+            fernets = crypto._get_fernets()
+            self.assertIs(fernets, crypto._get_fernets())
+        with patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [OLD_KEY]):
+            self.assertIsNot(fernets, crypto._get_fernets())
+
+    def test_decrypt_stored(self):
+        self.assertEqual('access-token', crypto.decrypt_stored('access-token', None))
+        with self.assertRaisesMessage(InvalidToken, "session key"):
+            crypto.decrypt_stored(Fernet(SESSION_KEY).encrypt(b'access-token').decode(), None)
+
+    def test_is_encrypted(self):
+        self.assertTrue(crypto.is_encrypted(Fernet(NEW_KEY).encrypt(b'access-token').decode()))
+        self.assertFalse(crypto.is_encrypted('1~access-token'))
+
+
+# Tokens stored before the keyring was configured, which
+# rotate_canvas_oauth_keys --encrypt-plaintext has not reached yet
+@override_settings(CANVAS_OAUTH_ENCRYPTION_KEYS=[NEW_KEY])
+class TestPlainTextTokens(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jsmith')
+
+    def test_get_oauth_token(self):
+        create_token(self.user)
+        self.assertEqual('access-token', get_oauth_token(make_request(self.user)))
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_encrypted_on_refresh(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        create_token(self.user, expires_in=-60)
+        self.assertEqual('new-access-token', get_oauth_token(make_request(self.user)))
+        self.assertEqual('refresh-token', mock_get_access_token.call_args[1]['refresh_token'])
+        oauth_token = CanvasOAuth2Token.objects.get()
+        self.assertEqual('new-access-token', Fernet(NEW_KEY).decrypt(oauth_token.access_token.encode()).decode())
+
+    @patch('canvas_oauth.refresh.canvas.get_access_token')
+    def test_get_oauth_tokens(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        other_user = User.objects.create_user(username='asmith')
+        create_token(self.user)
+        create_token(other_user, expires_in=-60)
+        self.assertEqual({self.user.pk: ('access-token', None), other_user.pk: ('new-access-token', None)},
+                         get_oauth_tokens([self.user, other_user]))
@@ -0,0 +1,159 @@
+import io
+import os
+import tempfile
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from canvas_oauth.download import download
+from canvas_oauth.exceptions import CanvasDownloadError
+from canvas_oauth.tests.utils import TokenTestMixin, make_real_response
+
+CONTENT = b'0123456789'
+FILE_URL = 'https://%s/files/1/download' % settings.CANVAS_OAUTH_CANVAS_DOMAIN
+SIGNED_URL = 'https://storage.localhost/files/1?signature=abc'
+
+
+def storage_response(status_code=200, body=b'', headers=None, fail_after=None):
+    return make_real_response(status_code, headers, body, url=SIGNED_URL, fail_after=fail_after)
+
+
+def redirect():
+    return storage_response(302, headers={'Location': SIGNED_URL})
+
+
+class TestDownload(TokenTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.canvas_session = MagicMock()
+        self.canvas_session.request.side_effect = lambda *args, **kwargs: redirect()
+        self.storage_session = MagicMock()
+        sessions = {settings.CANVAS_OAUTH_CANVAS_DOMAIN: self.canvas_session,
+                    'storage.localhost': self.storage_session}
+        patcher = patch('canvas_oauth.canvas.get_session', side_effect=lambda domain=None: sessions[domain])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('canvas_oauth.download.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_storage_headers(self, index=0):
+        return self.storage_session.get.call_args_list[index][1]['headers']
+
+    def test_follows_redirect_without_token(self):
+        self.storage_session.get.return_value = storage_response(body=CONTENT, headers={'Content-Length': '10'})
+        sink = io.BytesIO()
+        stats = download(self.request, '/files/1/download', sink)
+
+        self.assertEqual(CONTENT, sink.getvalue())
+        self.assertEqual(10, stats.bytes)
+        self.assertEqual(10, stats.total)
+        self.assertEqual(1, stats.attempts)
+        self.assertEqual(FILE_URL, self.canvas_session.request.call_args[0][1])
+        self.assertEqual('Bearer access-token', self.canvas_session.request.call_args[1]['headers']['Authorization'])
+        self.assertFalse(self.canvas_session.request.call_args[1]['allow_redirects'])
+        self.assertEqual(SIGNED_URL, self.storage_session.get.call_args[0][0])
+        self.assertNotIn('Authorization', self.get_storage_headers())
+        self.assertEqual('identity', self.get_storage_headers()['Accept-Encoding'])
+
+    def test_writes_chunks(self):
+        self.storage_session.get.return_value = storage_response(body=CONTENT)
+        sizes = []
+        download(self.request, FILE_URL, io.BytesIO(), chunk_size=4,
+                 progress=lambda stats: sizes.append(stats.position))
+        self.assertEqual([4, 8, 10], sizes)
+
+    def test_resumes_with_range(self):
+        self.storage_session.get.side_effect = [
+            storage_response(body=CONTENT, headers={'Content-Length': '10', 'ETag': '"v1"'}, fail_after=4),
+            storage_response(206, body=CONTENT[4:], headers={'Content-Range': 'bytes 4-9/10'}),
+        ]
+        sink = io.BytesIO()
+        stats = download(self.request, FILE_URL, sink, chunk_size=2)
+
+        self.assertEqual(CONTENT, sink.getvalue())
+        self.assertEqual(2, stats.attempts)
+        self.assertEqual(10, stats.bytes)
+        self.assertEqual('bytes=4-', self.get_storage_headers(1)['Range'])
+        self.assertEqual('"v1"', self.get_storage_headers(1)['If-Range'])
+        # Each attempt goes through Canvas for a fresh signed URL
+        self.assertEqual(2, self.canvas_session.request.call_count)
+        self.sleep.assert_called_once()
+
+    def test_restarts_when_range_ignored(self):
+        self.storage_session.get.side_effect = [
+            storage_response(body=CONTENT, fail_after=4),
+            storage_response(body=CONTENT),
+        ]
+        sink = io.BytesIO(b'header')
+        sink.seek(0, os.SEEK_END)
+        download(self.request, FILE_URL, sink)
+        self.assertEqual(b'header' + CONTENT, sink.getvalue())
+
+    def test_cannot_restart_unseekable_sink(self):
+        self.storage_session.get.side_effect = [
+            storage_response(body=CONTENT, fail_after=4),
+            storage_response(body=CONTENT),
+        ]
+        sink = MagicMock(spec=['write', 'seekable'])
+        sink.seekable.return_value = False
+        with self.assertRaises(CanvasDownloadError):
+            download(self.request, FILE_URL, sink)
+
+    def test_resumes_existing_file(self):
+        self.storage_session.get.return_value = storage_response(
+            206, body=CONTENT[4:], headers={'Content-Range': 'bytes 4-9/10'})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.zip')
+            with open(path, 'wb') as f:
+                f.write(CONTENT[:4])
+            stats = download(self.request, FILE_URL, path)
+            with open(path, 'rb') as f:
+                self.assertEqual(CONTENT, f.read())
+        self.assertEqual('bytes=4-', self.get_storage_headers()['Range'])
+        self.assertEqual(6, stats.bytes)
+
+    def test_existing_file_complete(self):
+        self.storage_session.get.return_value = storage_response(416, headers={'Content-Range': 'bytes */10'})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.zip')
+            with open(path, 'wb') as f:
+                f.write(CONTENT)
+            stats = download(self.request, FILE_URL, path)
+            with open(path, 'rb') as f:
+                self.assertEqual(CONTENT, f.read())
+        self.assertEqual(0, stats.bytes)
+        self.assertEqual(10, stats.total)
+
+    @override_settings(CANVAS_OAUTH_HTTP_RETRIES=1)
+    def test_gives_up(self):
+        self.storage_session.get.side_effect = lambda *args, **kwargs: storage_response(body=CONTENT, fail_after=4)
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            download(self.request, FILE_URL, io.BytesIO())
+        self.assertEqual(2, self.storage_session.get.call_count)
+
+    def test_http_error_not_retried(self):
+        self.storage_session.get.return_value = storage_response(404)
+        with self.assertRaises(requests.HTTPError):
+            download(self.request, FILE_URL, io.BytesIO())
+        self.assertEqual(1, self.storage_session.get.call_count)
+
+    def test_server_error_retried(self):
+        self.storage_session.get.side_effect = [storage_response(503), storage_response(body=CONTENT)]
+        sink = io.BytesIO()
+        download(self.request, FILE_URL, sink)
+        self.assertEqual(CONTENT, sink.getvalue())
+
+    def test_token_kept_on_canvas_redirects(self):
+        self.canvas_session.request.side_effect = [
+            storage_response(302, headers={'Location': '/files/1/download?verifier=x'}),
+            redirect(),
+        ]
+        self.storage_session.get.return_value = storage_response(body=CONTENT)
+        download(self.request, '/courses/1/files/1/download', io.BytesIO())
+        second = self.canvas_session.request.call_args_list[1]
+        self.assertEqual(FILE_URL + '?verifier=x', second[0][1])
+        self.assertEqual('Bearer access-token', second[1]['headers']['Authorization'])
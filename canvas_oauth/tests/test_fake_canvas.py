@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import canvas
+from canvas_oauth.exceptions import (
+    CanvasUnavailableError, InvalidOAuthReturnError, InvalidOAuthTimeoutError)
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token, handle_missing_token, oauth_callback
+from canvas_oauth.tests.fake_canvas import FakeCanvas, fixed
+
+
+class FakeCanvasTestCase(TestCase):
+    fake_options = {}
+
+    def setUp(self):
+        canvas._reset_sessions()
+        self.fake = FakeCanvas(client_id=settings.CANVAS_OAUTH_CLIENT_ID,
+                               client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+                               seed=1, **self.fake_options).start()
+        patch_urls = self.fake.patch_urls()
+        patch_urls.__enter__()
+        self.addCleanup(patch_urls.__exit__, None, None, None)
+        self.addCleanup(self.fake.stop)
+        self.addCleanup(canvas._reset_sessions)
+
+    def refresh(self, refresh_token=None):
+        return canvas.get_access_token(
+            grant_type='refresh_token',
+            client_id=settings.CANVAS_OAUTH_CLIENT_ID,
+            client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+            redirect_uri=None,
+            refresh_token=refresh_token or self.fake.create_refresh_token(),
+            domain=self.fake.domain)
+
+
+class TestFakeCanvas(FakeCanvasTestCase):
+
+    def test_authorization_code_grant(self):
+        response = requests.get('http://%s/login/oauth2/auth' % self.fake.domain, params={
+            'client_id': settings.CANVAS_OAUTH_CLIENT_ID,
+            'response_type': 'code',
+            'redirect_uri': 'http://app.localhost/oauth/oauth-callback',
+            'state': 'RandomState100',
+        }, allow_redirects=False)
+        self.assertEqual(302, response.status_code)
+        params = parse_qs(urlparse(response.headers['Location']).query)
+        self.assertEqual(['RandomState100'], params['state'])
+
+        grant = dict(
+            grant_type='authorization_code',
+            client_id=settings.CANVAS_OAUTH_CLIENT_ID,
+            client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+            redirect_uri='http://app.localhost/oauth/oauth-callback',
+            code=params['code'][0],
+            domain=self.fake.domain)
+        access_token, expires, refresh_token = canvas.get_access_token(**grant)
+        self.assertTrue(access_token)
+        self.assertAlmostEqual(timezone.now() + timedelta(hours=1), expires, delta=timedelta(seconds=5))
+
+        # codes can only be used once
+        with self.assertRaises(InvalidOAuthReturnError):
+            canvas.get_access_token(**grant)
+
+        new_access_token, _, no_refresh_token = self.refresh(refresh_token)
+        self.assertNotEqual(access_token, new_access_token)
+        self.assertIsNone(no_refresh_token)
+
+    def test_unknown_refresh_token(self):
+        with self.assertRaises(InvalidOAuthReturnError):
+            self.refresh('1~unknown')
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.refresh()
+        stats = canvas.get_pool_stats()[self.fake.domain]
+        self.assertEqual(1, stats['connections_opened'])
+        self.assertEqual(4, stats['reused'])
+
+    def test_concurrent_refreshes(self):
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda _: self.refresh(), range(50)))
+        self.assertEqual(50, len({access_token for access_token, _, _ in results}))
+        self.assertEqual(50, self.fake.stats['refresh_token'])
+        self.assertLessEqual(canvas.get_pool_stats()[self.fake.domain]['connections_opened'], 10)
+
+    def test_full_dance(self):
+        user = User.objects.create_user(username='jsmith')
+        session = {'canvas_oauth_canvas_domain': self.fake.domain}
+        request = RequestFactory().get('/courses')
+        request.user = user
+        request.session = session
+
+        response = handle_missing_token(request)
+        # The fake grants access straight away and redirects to the callback
+        callback = urlparse(requests.get(response['Location'], allow_redirects=False).headers['Location'])
+        request = RequestFactory().get('%s?%s' % (callback.path, callback.query))
+        request.user = user
+        request.session = session
+        response = oauth_callback(request)
+
+        self.assertEqual('/courses', response['Location'])
+        self.assertEqual(1, self.fake.stats['authorization_code'])
+
+        request = RequestFactory().get('/courses')
+        request.user = User.objects.get(pk=user.pk)
+        request.session = session
+        with patch('canvas_oauth.oauth.settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER', timedelta(hours=2)):
+            access_token = get_oauth_token(request)
+        self.assertEqual(access_token, CanvasOAuth2Token.objects.get(user=user).access_token)
+        self.assertEqual(1, self.fake.stats['refresh_token'])
+
+
+class TestFakeCanvasFaults(FakeCanvasTestCase):
+
+    def test_errors(self):
+        self.fake.error_rate = 1.0
+        with self.assertRaises(CanvasUnavailableError):
+            self.refresh()
+        self.assertEqual(3, self.fake.stats['500'])
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_RETRY_BACKOFF_MAX', 0.5)
+    def test_rate_limiting(self):
+        self.fake.rate_limit_rate = 1.0
+        with self.assertRaises(CanvasUnavailableError) as cm:
+            self.refresh()
+        self.assertIn("Rate Limit Exceeded", str(cm.exception))
+        # Retry-After asks for longer than we back off for
+        self.assertEqual(1, self.fake.stats['429'])
+
+    def test_recovers_from_errors(self):
+        self.fake.error_rate = 0.2
+        for _ in range(10):
+            self.refresh()
+        self.assertGreater(self.fake.stats['500'], 0)
+
+    @patch('canvas_oauth.canvas.settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT', 0.2)
+    def test_timeouts(self):
+        self.fake.timeout_rate = 1.0
+        self.fake.timeout_delay = 1.0
+        with self.assertRaises(InvalidOAuthTimeoutError):
+            self.refresh()
+
+    def test_latency(self):
+        self.fake.latency = fixed(0.1)
+        started = timezone.now()
+        self.refresh()
+        self.assertGreaterEqual(timezone.now() - started, timedelta(seconds=0.1))
@@ -0,0 +1,175 @@
+import asyncio
+import json
+from unittest.mock import patch
+
+import httpx
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+
+from canvas_oauth.exceptions import CanvasGraphQLError
+from canvas_oauth.graphql import (
+    GraphQLClient, get_batch_document, get_graphql_client, parse_document, split_response)
+from canvas_oauth.tests.utils import TokenTestMixin, make_response
+
+COURSE_QUERY = 'query Course($id: ID!) { course(id: $id) { name } }'
+
+
+class TestDocuments(SimpleTestCase):
+
+    def test_mergeable(self):
+        self.assertTrue(parse_document(COURSE_QUERY).mergeable)
+        self.assertTrue(parse_document('{ allCourses { name } }').mergeable)
+        self.assertTrue(parse_document('query { course(id: "1") { ...Fields } } '
+                                       'fragment Fields on Course { name }').mergeable)
+        self.assertFalse(parse_document('mutation { updateCourse }').mergeable)
+        self.assertFalse(parse_document('query A { a } query B { b }').mergeable)
+        self.assertFalse(parse_document('{ ...Fields } fragment Fields on Query { a }').mergeable)
+        self.assertFalse(parse_document('{ course(id: "1") { name }').mergeable)
+
+    def test_merges_documents(self):
+        document = get_batch_document((
+            COURSE_QUERY,
+            '# Aliased\n{ c: course(id: "2") { ...Fields } } fragment Fields on Course { name, _id }',
+            '{ legacyNode(_id: "1", type: User) @include(if: true) { ... on User { name } } }',
+        ))
+        self.assertEqual(
+            'query ($ q0_id : ID !) { q0_course: course ( id : $ q0_id ) { name } '
+            'q1_c: course ( id : "2" ) { ... q1_Fields } '
+            'q2_legacyNode: legacyNode ( _id : "1" type : User ) @ include ( if : true ) { ... on User { name } } } '
+            'fragment q1_Fields on Course { name _id }',
+            document)
+
+    def test_keeps_strings(self):
+        document = get_batch_document(('{ a(s: "x, $y { }") }', '{ b(s: """q "quoted" $x""") }'))
+        self.assertEqual('query { q0_a: a ( s : "x, $y { }" ) q1_b: b ( s : """q "quoted" $x""" ) }', document)
+
+    def test_documents_are_cached(self):
+        parse_document.cache_clear()
+        parse_document(COURSE_QUERY)
+        parse_document(COURSE_QUERY)
+        self.assertEqual(1, parse_document.cache_info().hits)
+
+    def test_split_response(self):
+        body = {
+            'data': {'q0_course': {'name': 'A'}, 'q1_c': None},
+            'errors': [{'message': 'Not found', 'path': ['q1_c', 'name']}, {'message': 'Slow down'}],
+        }
+        [(data0, errors0), (data1, errors1)] = split_response(body, 2)
+        self.assertEqual({'course': {'name': 'A'}}, data0)
+        self.assertEqual([{'message': 'Slow down'}], errors0)
+        self.assertEqual({'c': None}, data1)
+        self.assertEqual([{'message': 'Not found', 'path': ['c', 'name']}, {'message': 'Slow down'}], errors1)
+
+
+class GraphQLTestMixin(TokenTestMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.graphql = GraphQLClient(self.request)
+
+
+class TestGraphQLClient(GraphQLTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('canvas_oauth.client.canvas.get_session')
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def get_payload(self, index=0):
+        return self.session.request.call_args_list[index][1]['json']
+
+    def test_batches_queries(self):
+        self.session.request.return_value = make_response(json={'data': {
+            'q0_course': {'name': 'A'}, 'q1_course': {'name': 'B'}, 'q2_course': {'name': 'C'}}})
+        results = [self.graphql.query(COURSE_QUERY, {'id': course_id}) for course_id in '123']
+        self.assertEqual({'course': {'name': 'B'}}, results[1].data)
+        self.assertEqual({'course': {'name': 'A'}}, results[0].data)
+        self.assertEqual({'course': {'name': 'C'}}, results[2].data)
+
+        self.session.request.assert_called_once()
+        self.assertEqual('https://%s/api/graphql' % settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+                         self.session.request.call_args[0][1])
+        payload = self.get_payload()
+        self.assertEqual({'q0_id': '1', 'q1_id': '2', 'q2_id': '3'}, payload['variables'])
+        self.assertIn('q2_course: course ( id : $ q2_id )', payload['query'])
+
+    def test_single_query_sent_as_is(self):
+        self.session.request.return_value = make_response(json={'data': {'course': {'name': 'A'}}})
+        self.assertEqual({'course': {'name': 'A'}}, self.graphql.execute(COURSE_QUERY, {'id': '1'}))
+        self.assertEqual({'query': COURSE_QUERY, 'variables': {'id': '1'}}, self.get_payload())
+
+    def test_errors(self):
+        self.session.request.return_value = make_response(json={
+            'data': {'q0_course': {'name': 'A'}, 'q1_course': None},
+            'errors': [{'message': 'not found', 'path': ['q1_course']}]})
+        found = self.graphql.query(COURSE_QUERY, {'id': '1'})
+        missing = self.graphql.query(COURSE_QUERY, {'id': '2'})
+        self.assertEqual({'course': {'name': 'A'}}, found.data)
+        with self.assertRaises(CanvasGraphQLError) as context:
+            missing.data
+        self.assertEqual([{'message': 'not found', 'path': ['course']}], context.exception.errors)
+        self.assertEqual({'course': None}, context.exception.data)
+
+    def test_failed_batch_sent_separately(self):
+        self.session.request.side_effect = [
+            make_response(json={'errors': [{'message': 'Field does not exist'}]}),
+            make_response(json={'data': {'course': {'name': 'A'}}}),
+            make_response(json={'errors': [{'message': 'Field does not exist'}]}),
+        ]
+        valid = self.graphql.query(COURSE_QUERY, {'id': '1'})
+        invalid = self.graphql.query('{ nope }')
+        self.assertEqual({'course': {'name': 'A'}}, valid.data)
+        self.assertEqual([{'message': 'Field does not exist'}], invalid.errors)
+        self.assertEqual(3, self.session.request.call_count)
+
+    def test_http_error(self):
+        r = make_response()
+        r.raise_for_status.side_effect = Exception("502 Server Error")
+        self.session.request.return_value = r
+        result = self.graphql.query(COURSE_QUERY, {'id': '1'})
+        with self.assertRaisesMessage(Exception, "502 Server Error"):
+            result.data
+
+    def test_mutations_sent_alone(self):
+        self.session.request.side_effect = [
+            make_response(json={'data': {'updateCourse': {}}}),
+            make_response(json={'data': {'course': {}}}),
+        ]
+        mutation = self.graphql.query('mutation { updateCourse }')
+        query = self.graphql.query(COURSE_QUERY, {'id': '1'})
+        self.assertEqual({'course': {}}, query.data)
+        self.assertEqual({'updateCourse': {}}, mutation.data)
+        self.assertEqual('mutation { updateCourse }', self.get_payload(0)['query'])
+        self.assertEqual(COURSE_QUERY, self.get_payload(1)['query'])
+
+    def test_max_batch_size(self):
+        self.session.request.side_effect = lambda *args, **kwargs: make_response(json={'data': {}})
+        graphql = GraphQLClient(self.request, max_batch_size=2)
+        for course_id in range(5):
+            graphql.query(COURSE_QUERY, {'id': course_id})
+        graphql.flush()
+        self.assertEqual(3, self.session.request.call_count)
+
+    def test_client_per_request(self):
+        self.assertIs(get_graphql_client(self.request), get_graphql_client(self.request))
+        self.assertIsNot(get_graphql_client(self.request), get_graphql_client(RequestFactory().get('/index')))
+
+
+class TestAsyncGraphQLClient(GraphQLTestMixin, TestCase):
+
+    async def test_batches_queries_in_the_same_tick(self):
+        payloads = []
+
+        def handler(request):
+            payloads.append(json.loads(request.content))
+            return httpx.Response(200, json={'data': {'q0_course': {'name': 'A'}, 'q1_course': {'name': 'B'}}})
+
+        with patch('canvas_oauth.batch.canvas.get_async_client') as mock_get_async_client:
+            mock_get_async_client.return_value = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            results = await asyncio.gather(self.graphql.aexecute(COURSE_QUERY, {'id': '1'}),
+                                           self.graphql.aexecute(COURSE_QUERY, {'id': '2'}))
+        self.assertEqual([{'course': {'name': 'A'}}, {'course': {'name': 'B'}}], results)
+        self.assertEqual(1, len(payloads))
+        self.assertEqual({'q0_id': '1', 'q1_id': '2'}, payloads[0]['variables'])
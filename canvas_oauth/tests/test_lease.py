@@ -0,0 +1,105 @@
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from canvas_oauth.exceptions import InvalidOAuthReturnError, MissingTokenError
+from canvas_oauth.lease import canvas_token_lease
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.tests.utils import TokenTestMixin
+
+KEY = Fernet.generate_key()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class LeaseTestMixin(TokenTestMixin):
+
+    def expire_in(self, seconds):
+        CanvasOAuth2Token.objects.update(expires=timezone.now() + timedelta(seconds=seconds))
+
+
+@patch('canvas_oauth.refresh.canvas.get_access_token')
+class TestCanvasTokenLease(LeaseTestMixin, TestCase):
+
+    def test_lease(self, mock_get_access_token):
+        with canvas_token_lease(self.user) as lease:
+            self.assertEqual('access-token', lease.token)
+            self.assertIsNotNone(lease._timer)
+        self.assertFalse(mock_get_access_token.called)
+        self.assertIsNone(lease._timer)
+
+    def test_missing_token(self, mock_get_access_token):
+        with self.assertRaises(MissingTokenError):
+            with canvas_token_lease(self.user, domain='canvas-beta.localhost'):
+                pass
+
+    def test_refreshes_expiring_token_up_front(self, mock_get_access_token):
+        expires = timezone.now() + timedelta(hours=1)
+        mock_get_access_token.return_value = ('new-access-token', expires, None)
+        self.expire_in(30)
+        with canvas_token_lease(self.user.pk) as lease:
+            self.assertEqual('new-access-token', lease.token)
+            self.assertEqual(expires, lease.expires)
+        self.assertEqual('new-access-token', CanvasOAuth2Token.objects.get().access_token)
+
+    def test_session_encrypted_tokens(self, mock_get_access_token):
+        CanvasOAuth2Token.objects.update(access_token=Fernet(KEY).encrypt(b'access-token').decode())
+        with self.assertRaisesMessage(InvalidToken, "session key"):
+            with canvas_token_lease(self.user):
+                pass
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [KEY])
+    def test_plain_text_tokens_with_keyring(self, mock_get_access_token):
+        with canvas_token_lease(self.user) as lease:
+            self.assertEqual('access-token', lease.token)
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [KEY])
+    def test_encrypted_tokens(self, mock_get_access_token):
+        CanvasOAuth2Token.objects.update(access_token=Fernet(KEY).encrypt(b'access-token').decode())
+        with canvas_token_lease(self.user) as lease:
+            self.assertEqual('access-token', lease.token)
+
+
+# The background refresh saves from another thread, so it needs to see
+# committed rows
+@patch('canvas_oauth.lease.MIN_REFRESH_AHEAD', timedelta(0))
+@patch('canvas_oauth.refresh.canvas.get_access_token')
+class TestBackgroundRefresh(LeaseTestMixin, TransactionTestCase):
+
+    def test_refreshes_before_expiry(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        self.expire_in(0.2)
+        with canvas_token_lease(self.user) as lease:
+            self.assertEqual('access-token', lease.token)
+            self.assertTrue(wait_for(lambda: lease.token == 'new-access-token'))
+            self.assertIsNone(lease.error)
+        self.assertEqual(1, mock_get_access_token.call_count)
+        self.assertEqual('new-access-token', CanvasOAuth2Token.objects.get().access_token)
+
+    @patch('canvas_oauth.lease.RETRY_INTERVAL', 0.05)
+    def test_retries_failed_refresh(self, mock_get_access_token):
+        mock_get_access_token.side_effect = [
+            InvalidOAuthReturnError("unavailable"),
+            ('new-access-token', timezone.now() + timedelta(hours=1), None),
+        ]
+        self.expire_in(0.2)
+        with canvas_token_lease(self.user) as lease:
+            self.assertTrue(wait_for(lambda: lease.token == 'new-access-token'))
+            self.assertIsNone(lease.error)
+        self.assertEqual(2, mock_get_access_token.call_count)
+
+    def test_close_stops_refreshing(self, mock_get_access_token):
+        self.expire_in(0.2)
+        with canvas_token_lease(self.user):
+            pass
+        time.sleep(0.4)
+        self.assertFalse(mock_get_access_token.called)
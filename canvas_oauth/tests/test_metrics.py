@@ -0,0 +1,136 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import metrics
+from canvas_oauth.canvas import get_access_token
+from canvas_oauth.exceptions import (
+    InvalidOAuthReturnError, InvalidOAuthTimeoutError, MissingTokenError)
+from canvas_oauth.middleware import OAuthMiddleware
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.tests.utils import create_token, make_request
+
+BACKEND = 'canvas_oauth.metrics.PrometheusBackend'
+
+
+class TestBackends(TestCase):
+
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics.get_backend().enabled)
+        with metrics.timer('duration') as labels:
+            labels['status'] = 200
+        metrics.increment('count')
+
+    def test_counters_and_histograms(self):
+        backend = metrics.InMemoryBackend(buckets=(0.1, 1))
+        backend.increment('lookups', outcome='found')
+        backend.increment('lookups', 2, outcome='found')
+        backend.observe('duration', 0.05)
+        backend.observe('duration', 5)
+        self.assertEqual(3, backend.get_counter('lookups', outcome='found'))
+        self.assertEqual(0, backend.get_counter('lookups', outcome='missing'))
+        self.assertEqual({'count': 2, 'sum': 5.05, 'buckets': [1, 0]},
+                         backend.get_histogram('duration'))
+
+    def test_prometheus_text_format(self):
+        backend = metrics.PrometheusBackend(buckets=(0.1, 1))
+        backend.increment('lookups_total', outcome='fo"und')
+        backend.observe('duration_seconds', 0.5, result='success')
+        self.assertEqual(
+            '# TYPE lookups_total counter\n'
+            'lookups_total{outcome="fo\\"und"} 1\n'
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{result="success",le="0.1"} 0\n'
+            'duration_seconds_bucket{result="success",le="1"} 1\n'
+            'duration_seconds_bucket{result="success",le="+Inf"} 1\n'
+            'duration_seconds_sum{result="success"} 0.5\n'
+            'duration_seconds_count{result="success"} 1\n',
+            backend.render())
+
+    @patch('canvas_oauth.metrics.settings.CANVAS_OAUTH_METRICS_BACKEND', BACKEND)
+    def test_timer_labels_errors(self):
+        with self.assertRaises(ValueError):
+            with metrics.timer('duration'):
+                raise ValueError
+        histogram = metrics.get_backend().get_histogram('duration', result='error')
+        self.assertEqual(1, histogram['count'])
+
+    @patch('canvas_oauth.metrics.settings.CANVAS_OAUTH_METRICS_BACKEND', BACKEND)
+    def test_view(self):
+        metrics.get_backend().increment('lookups_total')
+        response = metrics.metrics_view(RequestFactory().get('/metrics'))
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'lookups_total 1', response.content)
+
+    def test_view_when_disabled(self):
+        response = metrics.metrics_view(RequestFactory().get('/metrics'))
+        self.assertEqual(404, response.status_code)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        patcher = patch('canvas_oauth.metrics.settings.CANVAS_OAUTH_METRICS_BACKEND', BACKEND)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = metrics.get_backend()
+        self.backend.reset()
+        self.user = User.objects.create_user(username='jsmith')
+        self.request = make_request(self.user, '/')
+
+    def test_token_lookup_outcomes(self):
+        with self.assertRaises(MissingTokenError):
+            get_oauth_token(self.request)
+        create_token(self.user)
+        self.user.refresh_from_db()
+        get_oauth_token(self.request)
+        get_oauth_token(self.request)
+        for outcome in ('missing', 'found', 'memoized'):
+            self.assertEqual(1, self.backend.get_counter(
+                'canvas_oauth_token_lookups_total', outcome=outcome))
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refresh_duration(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-token', timezone.now() + timedelta(hours=1), None)
+        create_token(self.user, expires_in=0)
+        self.assertEqual('new-token', get_oauth_token(self.request))
+        self.assertEqual(1, self.backend.get_counter(
+            'canvas_oauth_token_lookups_total', outcome='refreshed'))
+        histogram = self.backend.get_histogram('canvas_oauth_refresh_seconds', result='success')
+        self.assertEqual(1, histogram['count'])
+
+    @patch('canvas_oauth.canvas.get_session')
+    def test_token_request_latency_by_status(self, mock_get_session):
+        mock_get_session.return_value.post.return_value = MagicMock(status_code=400, text='bad')
+        with self.assertRaises(InvalidOAuthReturnError):
+            get_access_token('refresh_token', 'id', 'secret', None,
+                             refresh_token='token', domain='canvas.example.edu')
+        mock_get_session.return_value.post.side_effect = requests.Timeout
+        with self.assertRaises(InvalidOAuthTimeoutError):
+            get_access_token('refresh_token', 'id', 'secret', None,
+                             refresh_token='token', domain='canvas.example.edu')
+        for status in (400, 'timeout'):
+            histogram = self.backend.get_histogram(
+                'canvas_oauth_token_request_seconds', domain='canvas.example.edu',
+                grant_type='refresh_token', status=status, result='error')
+            self.assertEqual(1, histogram['count'])
+
+    @patch('canvas_oauth.middleware.handle_missing_token')
+    def test_middleware_redirects(self, mock_handle_missing_token):
+        self.request.canvas_oauth_canvas_domain = 'canvas.example.edu'
+        OAuthMiddleware(MagicMock()).process_exception(self.request, MissingTokenError())
+        self.assertEqual(1, self.backend.get_counter(
+            'canvas_oauth_middleware_redirects_total',
+            reason='missing_token', domain='canvas.example.edu'))
+
+    @patch('canvas_oauth.oauth.render_oauth_error')
+    def test_callback_results(self, mock_render_oauth_error):
+        from canvas_oauth.oauth import oauth_callback
+        request = RequestFactory().get('/oauth/oauth-callback', {'error': 'access_denied'})
+        oauth_callback(request)
+        self.assertEqual(1, self.backend.get_counter('canvas_oauth_callbacks_total', result='denied'))
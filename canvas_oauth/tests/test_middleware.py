@@ -1,16 +1,27 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.http import HttpResponse
-from unittest.mock import patch
+from django.utils import timezone
+from unittest.mock import MagicMock, patch
+
+from asgiref.sync import iscoroutinefunction
 
 from canvas_oauth.middleware import OAuthMiddleware
-from canvas_oauth.exceptions import MissingTokenError, CanvasOAuthError
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.exceptions import MissingTokenError, CanvasOAuthError, InvalidOAuthTimeoutError
 
 
 def dummy_response(request):
     return HttpResponse("Dummy")
 
 
+async def async_dummy_response(request):
+    return HttpResponse("Dummy")
+
+
 class TestOAuthMiddleware(TestCase):
 
     def test_without_triggering_oauth_flow(self):
@@ -21,6 +32,16 @@ class TestOAuthMiddleware(TestCase):
         self.assertEqual(expected_response.status_code, response.status_code)
         self.assertEqual(expected_response.content, response.content)
 
+    @patch('canvas_oauth.middleware.get_oauth_token')
+    def test_lazy_canvas_oauth_token(self, mock_get_oauth_token):
+        mock_get_oauth_token.return_value = "access-token-123"
+        request = RequestFactory().get('/index')
+        middleware = OAuthMiddleware(dummy_response)
+        middleware(request)
+        self.assertFalse(mock_get_oauth_token.called)
+        self.assertEqual("access-token-123", str(request.canvas_oauth_token))
+        mock_get_oauth_token.assert_called_with(request)
+
     @patch('canvas_oauth.middleware.handle_missing_token')
     def test_missing_token_error(self, mock_handle_missing_token):
         request = RequestFactory().get('/index')
@@ -36,3 +57,39 @@ class TestOAuthMiddleware(TestCase):
         middleware = OAuthMiddleware(dummy_response)
         middleware.process_exception(request, exception)
         mock_render_oauth_error.assert_called_with(str(exception))
+
+    @patch('canvas_oauth.middleware.handle_missing_token')
+    def test_canvas_unavailable_keeps_token(self, mock_handle_missing_token):
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        middleware = OAuthMiddleware(dummy_response)
+        response = middleware.process_exception(request, InvalidOAuthTimeoutError("timed out"))
+        self.assertEqual(503, response.status_code)
+        self.assertFalse(request.user.canvas_oauth2_token.delete.called)
+        self.assertFalse(mock_handle_missing_token.called)
+
+    def test_sync_middleware(self):
+        self.assertFalse(iscoroutinefunction(OAuthMiddleware(dummy_response)))
+
+    async def test_async_middleware(self):
+        request = RequestFactory().get('/index')
+        middleware = OAuthMiddleware(async_dummy_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = await middleware(request)
+        self.assertEqual(b"Dummy", response.content)
+        self.assertFalse(hasattr(request, 'canvas_oauth_token'))
+
+    async def test_async_view_token(self):
+        user = await User.objects.acreate(username='jsmith')
+        await CanvasOAuth2Token.objects.acreate(user=user, access_token='access-token-123',
+                                                refresh_token='refresh-token',
+                                                expires=timezone.now() + timedelta(hours=1))
+
+        async def view(request):
+            return HttpResponse(await request.acanvas_oauth_token())
+
+        request = RequestFactory().get('/index')
+        request.user = user
+        request.session = {}
+        response = await OAuthMiddleware(view)(request)
+        self.assertEqual(b"access-token-123", response.content)
@@ -1,4 +1,5 @@
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.test import TestCase
 from django.utils import timezone
 import datetime
@@ -41,6 +42,26 @@ class TestCanvasOAuth2Token(TestCase):
         self.assertEqual(access_token, oauth2token.access_token)
         self.assertEqual(refresh_token, oauth2token.refresh_token)
         self.assertEqual(expires, oauth2token.expires)
+        self.assertEqual('canvas.localhost', oauth2token.domain)
+
+    def test_one_token_per_user_and_domain(self):
+        expires = timezone.now() + datetime.timedelta(seconds=3600)
+        for domain in ('canvas.localhost', 'canvas-beta.localhost'):
+            CanvasOAuth2Token.objects.create(user=self.user, domain=domain, access_token=randomstr(64),
+                                             refresh_token=randomstr(64), expires=expires)
+        self.assertEqual(2, self.user.canvas_oauth2_tokens.count())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CanvasOAuth2Token.objects.create(user=self.user, domain='canvas.localhost', access_token=randomstr(64),
+                                             refresh_token=randomstr(64), expires=expires)
+
+    def test_default_domain_accessor(self):
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.user.canvas_oauth2_token
+        expires = timezone.now() + datetime.timedelta(seconds=3600)
+        for domain in ('canvas-beta.localhost', 'canvas.localhost'):
+            CanvasOAuth2Token.objects.create(user=self.user, domain=domain, access_token=domain,
+                                             refresh_token=randomstr(64), expires=expires)
+        self.assertEqual('canvas.localhost', self.user.canvas_oauth2_token.access_token)
 
     def test_token_expires_within_time_period(self):
         expires_in_seconds = 15
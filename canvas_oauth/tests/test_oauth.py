@@ -1,21 +1,26 @@
 import logging
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.utils import timezone
 from django.urls import reverse
 from django.http import HttpResponseRedirect
 from datetime import datetime, timedelta
-from unittest.mock import MagicMock, PropertyMock, patch
+from unittest.mock import MagicMock, patch
 
 from canvas_oauth import settings
 from canvas_oauth.models import CanvasOAuth2Token
 from canvas_oauth.exceptions import InvalidOAuthStateError, MissingTokenError
 from canvas_oauth.canvas import get_oauth_login_url
 from canvas_oauth.oauth import (
+    aget_oauth_token,
+    aoauth_callback,
     get_oauth_token,
     handle_missing_token,
     oauth_callback,
     refresh_oauth_token)
+from canvas_oauth.tests.utils import create_token, make_request
 
 
 logging.disable(logging.CRITICAL)  # disable logging for anything less than critical
@@ -23,10 +28,11 @@ logging.disable(logging.CRITICAL)  # disable logging for anything less than crit
 
 class StubCanvasOAuth2Token(object):
     # TODO: figure out better way to stub this
-    def __init__(self, access_token, refresh_token, expires):
+    def __init__(self, access_token, refresh_token, expires, domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN):
         self.access_token = access_token
         self.refresh_token = refresh_token
         self.expires = expires
+        self.domain = domain
 
         # internal to stub
         self._save_called = False
@@ -52,8 +58,9 @@ class StubCanvasOAuth2Token(object):
 
 class TestRefreshOauthToken(TestCase):
 
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects.get')
     @patch('canvas_oauth.oauth.canvas.get_access_token')
-    def test_refresh_oauth_token(self, mock_get_access_token):
+    def test_refresh_oauth_token(self, mock_get_access_token, mock_get):
         refresh_token = "refresh-token"
         old_access_token = "old-access-token"
         old_expires = timezone.now() + timedelta(seconds=100)
@@ -63,17 +70,14 @@ class TestRefreshOauthToken(TestCase):
         # mock the get_access_token() function
         mock_get_access_token.return_value = (new_access_token, new_expires, refresh_token)
 
-        # mock the user and related CanvasOAuth2Token model
+        # mock the user's CanvasOAuth2Token
         stub_canvas_oauth2_token = StubCanvasOAuth2Token(old_access_token, refresh_token, old_expires)
-        mock_user = MagicMock()
-
-        # Because of the way mock attributes are stored you can’t directly attach a PropertyMock to a mock object.
-        # Instead you can attach it to the mock type object
-        type(mock_user).canvas_oauth2_token = PropertyMock(return_value=stub_canvas_oauth2_token)
+        mock_get.return_value = stub_canvas_oauth2_token
 
         # initialize request object
         request = RequestFactory().get('/index')
-        request.user = mock_user
+        request.user = MagicMock()
+        request.session = {}
 
         # run tests
         actual_oauth_token = refresh_oauth_token(request)
@@ -83,6 +87,7 @@ class TestRefreshOauthToken(TestCase):
         self.assertEqual(new_expires, actual_oauth_token.expires)
 
         mock_get_access_token.assert_called_with(
+            domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
             grant_type='refresh_token',
             client_id=settings.CANVAS_OAUTH_CLIENT_ID,
             client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
@@ -90,6 +95,43 @@ class TestRefreshOauthToken(TestCase):
             refresh_token=refresh_token)
 
         self.assertTrue(stub_canvas_oauth2_token.stub_save_called())
+        mock_get.assert_called_with(user_id=request.user.pk, domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refresh_oauth_token_uses_domain_developer_key(self, mock_get_access_token):
+        mock_get_access_token.return_value = ("new-access-token", timezone.now(), None)
+        stub_canvas_oauth2_token = StubCanvasOAuth2Token(
+            "access-token", "refresh-token", timezone.now(), domain='canvas-beta.localhost')
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        request.session = {}
+        developer_keys = {'canvas-beta.localhost': {'client_id': '202', 'client_secret': 'beta-secret'}}
+
+        with override_settings(CANVAS_OAUTH_DEVELOPER_KEYS=developer_keys):
+            refresh_oauth_token(request, stub_canvas_oauth2_token)
+
+        mock_get_access_token.assert_called_with(
+            domain='canvas-beta.localhost',
+            grant_type='refresh_token',
+            client_id='202',
+            client_secret='beta-secret',
+            redirect_uri=request.build_absolute_uri(reverse('canvas-oauth-callback')),
+            refresh_token="refresh-token")
+
+    @patch('canvas_oauth.oauth.settings.CANVAS_OAUTH_REFRESH_LOCK', 'cache')
+    @patch('canvas_oauth.oauth.singleflight.refresh')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects.get')
+    def test_refresh_oauth_token_single_flight(self, mock_get, mock_refresh):
+        stub_canvas_oauth2_token = StubCanvasOAuth2Token("access-token", "refresh-token", timezone.now())
+        mock_get.return_value = stub_canvas_oauth2_token
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        request.session = {}
+
+        actual_oauth_token = refresh_oauth_token(request)
+
+        self.assertEqual(mock_refresh.return_value, actual_oauth_token)
+        self.assertIs(stub_canvas_oauth2_token, mock_refresh.call_args[0][0])
 
 
 class TestOauthCallback(TestCase):
@@ -114,9 +156,9 @@ class TestOauthCallback(TestCase):
             oauth_callback(request)
         self.assertEqual("OAuth state mismatch!", str(cm.exception))
 
-    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects.create')
+    @patch('canvas_oauth.oauth.storage.get_storage')
     @patch('canvas_oauth.oauth.canvas.get_access_token')
-    def test_oauth_callback_succes(self, mock_get_access_token, mock_create):
+    def test_oauth_callback_succes(self, mock_get_access_token, mock_get_storage):
         refresh_token = "refresh-token-111"
         access_token = "access-token-222"
         expires = timezone.now() + timedelta(seconds=100)
@@ -145,17 +187,19 @@ class TestOauthCallback(TestCase):
         self.assertEqual(expected_response['Location'], actual_response['Location'])
 
         mock_get_access_token.assert_called_with(
+            domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
             grant_type='authorization_code',
             client_id=settings.CANVAS_OAUTH_CLIENT_ID,
             client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
             redirect_uri=request.session["canvas_oauth_redirect_uri"],
             code=query_params['code'])
 
-        mock_create.assert_called_with(
-            user=request.user,
-            access_token=access_token,
-            expires=expires,
-            refresh_token=refresh_token)
+        stored_token = mock_get_storage.return_value.put.call_args[0][0]
+        self.assertEqual(request.user.pk, stored_token.user_id)
+        self.assertEqual(settings.CANVAS_OAUTH_CANVAS_DOMAIN, stored_token.domain)
+        self.assertEqual(access_token, stored_token.access_token)
+        self.assertEqual(expires, stored_token.expires)
+        self.assertEqual(refresh_token, stored_token.refresh_token)
 
 
 class TestHandleMissingToken(TestCase):
@@ -199,6 +243,11 @@ class TestHandleMissingToken(TestCase):
 
 class TestGetOauthToken(TestCase):
 
+    def setUp(self):
+        patcher = patch('canvas_oauth.oauth.CanvasOAuth2Token.objects.get')
+        self.mock_get = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def get_mock_request_with_token(self, expired=False, **kwargs):
         access_token = kwargs.get("access_token", "access-token-123")
         refresh_token = kwargs.get("refresh_token", "refresh-token-abc")
@@ -207,13 +256,11 @@ class TestGetOauthToken(TestCase):
         stub_canvas_oauth2_token = StubCanvasOAuth2Token(access_token, refresh_token, expires)
         stub_canvas_oauth2_token.stub_expires_within_return_value(expired)
 
-        mock_user = MagicMock()
-        # Because of the way mock attributes are stored you can’t directly attach a PropertyMock to a mock object.
-        # Instead you can attach it to the mock type object
-        type(mock_user).canvas_oauth2_token = PropertyMock(return_value=stub_canvas_oauth2_token)
+        self.mock_get.return_value = stub_canvas_oauth2_token
 
         request = RequestFactory().get('/index')
-        request.user = mock_user
+        request.user = MagicMock()
+        request.session = {}
 
         return request
 
@@ -229,21 +276,116 @@ class TestGetOauthToken(TestCase):
     def test_expired_access_token(self, mock_refresh_oauth_token):
         request = self.get_mock_request_with_token(expired=True)
         get_oauth_token(request)
-        mock_refresh_oauth_token.assert_called_with(request)
+        stub_canvas_oauth2_token = self.mock_get.return_value
+        mock_refresh_oauth_token.assert_called_with(request, stub_canvas_oauth2_token)
 
-        stub_canvas_oauth2_token = request.user.canvas_oauth2_token
         expires_buffer = settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
         self.assertTrue(stub_canvas_oauth2_token.stub_expires_within_called_with(expires_buffer))
 
-    def test_missing_token_error(self):
-        mock_user = MagicMock()
+    def test_access_token_is_memoized_per_request(self):
+        request = self.get_mock_request_with_token(expired=False, access_token="access-token-123")
+        self.assertEqual("access-token-123", get_oauth_token(request))
+        self.assertEqual("access-token-123", get_oauth_token(request))
+        self.assertEqual(1, self.mock_get.call_count)
+        self.mock_get.assert_called_with(user_id=request.user.pk, domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN)
+
+    def test_memoized_access_token_is_per_domain(self):
+        request = self.get_mock_request_with_token(expired=False, access_token="access-token-123")
+        get_oauth_token(request)
+        request.session['canvas_oauth_canvas_domain'] = 'canvas-beta.localhost'
+        self.mock_get.return_value = StubCanvasOAuth2Token(
+            "access-token-456", "refresh-token-abc", timezone.now() + timedelta(seconds=100),
+            domain='canvas-beta.localhost')
+        self.assertEqual("access-token-456", get_oauth_token(request))
+        self.mock_get.assert_called_with(user_id=request.user.pk, domain='canvas-beta.localhost')
+
+    @patch('canvas_oauth.oauth.refresh_oauth_token')
+    def test_memoized_access_token_is_refreshed(self, mock_refresh_oauth_token):
+        request = self.get_mock_request_with_token(expired=False, access_token="access-token-123")
+        get_oauth_token(request)
 
-        # Because of the way mock attributes are stored you can’t directly attach a PropertyMock to a mock object.
-        # Instead you can attach it to the mock type object
-        type(mock_user).canvas_oauth2_token = PropertyMock(side_effect=CanvasOAuth2Token.DoesNotExist())
+        # the token crosses the expiration buffer during the request
+        stub_canvas_oauth2_token = self.mock_get.return_value
+        stub_canvas_oauth2_token.stub_expires_within_return_value(True)
+        mock_refresh_oauth_token.return_value = StubCanvasOAuth2Token(
+            "access-token-456", "refresh-token-abc", timezone.now() + timedelta(seconds=100))
+
+        self.assertEqual("access-token-456", get_oauth_token(request))
+        mock_refresh_oauth_token.assert_called_with(request, stub_canvas_oauth2_token)
+        self.assertEqual("access-token-456", get_oauth_token(request))
+        self.assertEqual(1, mock_refresh_oauth_token.call_count)
+
+    def test_missing_token_error(self):
+        self.mock_get.side_effect = CanvasOAuth2Token.DoesNotExist()
 
         request = RequestFactory().get('/index')
-        request.user = mock_user
+        request.user = MagicMock()
+        request.session = {}
 
         with self.assertRaises(MissingTokenError):
             get_oauth_token(request)
+
+
+class TestAsyncOauth(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jsmith')
+        self.request = make_request(self.user)
+
+    def create_token(self, expires_in=100):
+        return create_token(self.user, "access-token-123", "refresh-token-abc", expires_in)
+
+    @patch('canvas_oauth.oauth.canvas.aget_access_token')
+    async def test_unexpired_access_token(self, mock_aget_access_token):
+        await sync_to_async(self.create_token)()
+        self.assertEqual("access-token-123", await aget_oauth_token(self.request))
+        self.assertFalse(mock_aget_access_token.called)
+
+    @patch('canvas_oauth.oauth.canvas.aget_access_token')
+    async def test_expired_access_token(self, mock_aget_access_token):
+        new_expires = timezone.now() + timedelta(hours=1)
+        mock_aget_access_token.return_value = ("access-token-456", new_expires, None)
+        await sync_to_async(self.create_token)(expires_in=-10)
+
+        self.assertEqual("access-token-456", await aget_oauth_token(self.request))
+
+        mock_aget_access_token.assert_called_with(
+            domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+            grant_type='refresh_token',
+            client_id=settings.CANVAS_OAUTH_CLIENT_ID,
+            client_secret=settings.CANVAS_OAUTH_CLIENT_SECRET,
+            redirect_uri=self.request.build_absolute_uri(reverse('canvas-oauth-callback')),
+            refresh_token="refresh-token-abc")
+        oauth_token = await CanvasOAuth2Token.objects.aget(user=self.user)
+        self.assertEqual("access-token-456", oauth_token.access_token)
+        self.assertEqual(new_expires, oauth_token.expires)
+
+    async def test_missing_token_error(self):
+        with self.assertRaises(MissingTokenError):
+            await aget_oauth_token(self.request)
+
+    @patch('canvas_oauth.oauth.canvas.aget_access_token')
+    async def test_oauth_callback_success(self, mock_aget_access_token):
+        expires = timezone.now() + timedelta(hours=1)
+        mock_aget_access_token.return_value = ("access-token-222", expires, "refresh-token-111")
+        request = RequestFactory().get('/index', data={"code": "red-green-blue", "state": "RandomState100"})
+        request.user = self.user
+        request.session = {
+            'canvas_oauth_redirect_uri': request.build_absolute_uri(reverse('canvas-oauth-callback')),
+            'canvas_oauth_request_state': 'RandomState100',
+            'canvas_oauth_initial_uri': '/endpoint-requires-token'
+        }
+
+        response = await aoauth_callback(request)
+
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('/endpoint-requires-token', response['Location'])
+        oauth_token = await CanvasOAuth2Token.objects.aget(user=self.user)
+        self.assertEqual("access-token-222", oauth_token.access_token)
+        self.assertEqual("refresh-token-111", oauth_token.refresh_token)
+
+    async def test_oauth_callback_state_mismatch(self):
+        request = RequestFactory().get('/index', data={"code": "blue", "state": "RandomState100XYZ"})
+        request.session = {'canvas_oauth_request_state': 'RandomState100'}
+        with self.assertRaises(InvalidOAuthStateError):
+            await aoauth_callback(request)
@@ -0,0 +1,107 @@
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from canvas_oauth.exceptions import InvalidOAuthReturnError, MissingTokenError
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.refresh import get_oauth_tokens, refresh_tokens
+from canvas_oauth.tests.utils import create_token
+
+KEY = Fernet.generate_key()
+
+
+def create_user(username, **kwargs):
+    user = User.objects.create_user(username=username)
+    create_token(user, **kwargs)
+    return user
+
+
+@patch('canvas_oauth.refresh.canvas.get_access_token')
+class TestGetOAuthTokens(TestCase):
+
+    def setUp(self):
+        self.expires = timezone.now() + timedelta(hours=1)
+
+    def test_returns_tokens_in_one_query(self, mock_get_access_token):
+        users = [create_user('user%d' % i, access_token='access-token-%d' % i) for i in range(3)]
+        with self.assertNumQueries(1):
+            tokens = get_oauth_tokens(users)
+        self.assertEqual({user.pk: ('access-token-%d' % i, None) for i, user in enumerate(users)}, tokens)
+        self.assertFalse(mock_get_access_token.called)
+
+    def test_accepts_user_ids(self, mock_get_access_token):
+        user = create_user('user')
+        self.assertEqual({user.pk: ('access-token', None)}, get_oauth_tokens([user.pk, user]))
+
+    def test_missing_tokens(self, mock_get_access_token):
+        user = create_user('user')
+        tokens = get_oauth_tokens([user.pk, 999])
+        self.assertEqual(('access-token', None), tokens[user.pk])
+        access_token, error = tokens[999]
+        self.assertIsNone(access_token)
+        self.assertIsInstance(error, MissingTokenError)
+
+    def test_tokens_are_per_domain(self, mock_get_access_token):
+        user = create_user('user', domain='canvas-beta.localhost')
+        self.assertIsInstance(get_oauth_tokens([user])[user.pk][1], MissingTokenError)
+        self.assertEqual(('access-token', None), get_oauth_tokens([user], domain='canvas-beta.localhost')[user.pk])
+
+    def test_refreshes_expiring_tokens(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', self.expires, None)
+        fresh = create_user('fresh')
+        expiring = [create_user('expiring%d' % i, expires_in=-60) for i in range(2)]
+
+        tokens = get_oauth_tokens([fresh] + expiring)
+
+        self.assertEqual(2, mock_get_access_token.call_count)
+        self.assertEqual(('access-token', None), tokens[fresh.pk])
+        for user in expiring:
+            self.assertEqual(('new-access-token', None), tokens[user.pk])
+            oauth_token = CanvasOAuth2Token.objects.get(user=user)
+            self.assertEqual('new-access-token', oauth_token.access_token)
+            self.assertEqual(self.expires, oauth_token.expires)
+
+    def test_refresh_errors(self, mock_get_access_token):
+        mock_get_access_token.side_effect = InvalidOAuthReturnError("invalid_grant")
+        fresh = create_user('fresh')
+        expiring = create_user('expiring', expires_in=-60)
+
+        tokens = get_oauth_tokens([fresh, expiring])
+
+        self.assertEqual(('access-token', None), tokens[fresh.pk])
+        self.assertIsInstance(tokens[expiring.pk][1], InvalidOAuthReturnError)
+        self.assertEqual('access-token', CanvasOAuth2Token.objects.get(user=expiring).access_token)
+
+    @patch('canvas_oauth.crypto.settings.CANVAS_OAUTH_ENCRYPTION_KEYS', [KEY])
+    def test_encrypted_tokens(self, mock_get_access_token):
+        user = create_user('user', access_token=Fernet(KEY).encrypt(b'access-token').decode())
+        self.assertEqual({user.pk: ('access-token', None)}, get_oauth_tokens([user]))
+
+    def test_session_encrypted_tokens(self, mock_get_access_token):
+        user = create_user('user', access_token=Fernet(KEY).encrypt(b'access-token').decode())
+        error = get_oauth_tokens([user])[user.pk][1]
+        self.assertIsInstance(error, InvalidToken)
+        self.assertIn("session key", str(error))
+
+
+@patch('canvas_oauth.refresh.canvas.get_access_token')
+class TestRefreshTokens(TestCase):
+
+    @patch('canvas_oauth.refresh.random.uniform', side_effect=[0.1, 0])
+    def test_staggers_refreshes(self, mock_uniform, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        tokens = [CanvasOAuth2Token(user_id=i, access_token='access-token', refresh_token='refresh-token-%d' % i)
+                  for i in range(2)]
+
+        started = time.monotonic()
+        results = [(oauth_token.refresh_token, error) for oauth_token, error in
+                   refresh_tokens(tokens, max_workers=1, jitter=1)]
+
+        # Tokens are refreshed in order, the last one after the longest delay
+        self.assertEqual([('refresh-token-0', None), ('refresh-token-1', None)], results)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
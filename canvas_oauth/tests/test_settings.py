@@ -1,36 +1,55 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from contextlib import contextmanager
-import importlib
 import datetime
+import importlib
+import subprocess
+import sys
 
+from canvas_oauth import settings as canvas_oauth_settings
 
-CANVAS_OAUTH_SETTINGS_MODULE_NAME = "canvas_oauth.settings"
+
+REQUIRED_SETTINGS = ('CANVAS_OAUTH_CLIENT_ID', 'CANVAS_OAUTH_CLIENT_SECRET', 'CANVAS_OAUTH_CANVAS_DOMAIN')
+
+
+@contextmanager
+def without_oauth_settings():
+    saved = {name: getattr(settings, name) for name in REQUIRED_SETTINGS if hasattr(settings, name)}
+    for name in saved:
+        delattr(settings, name)
+    canvas_oauth_settings.clear_cache()
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(settings, name, value)
+        canvas_oauth_settings.clear_cache()
 
 
 @contextmanager
 def required_oauth_settings(oauth_settings={}):
-    settings.CANVAS_OAUTH_CLIENT_ID = oauth_settings.get('CANVAS_OAUTH_CLIENT_ID', '10000000000012')
-    settings.CANVAS_OAUTH_CLIENT_SECRET = oauth_settings.get('CANVAS_OAUTH_CLIENT_SECRET', 'yKZc1bJpdykVBUT4')
-    settings.CANVAS_OAUTH_CANVAS_DOMAIN = oauth_settings.get('CANVAS_OAUTH_CANVAS_DOMAIN', 'canvas.localhost')
-    yield
-    delattr(settings, 'CANVAS_OAUTH_CLIENT_ID')
-    delattr(settings, 'CANVAS_OAUTH_CLIENT_SECRET')
-    delattr(settings, 'CANVAS_OAUTH_CANVAS_DOMAIN')
+    with without_oauth_settings():
+        with override_settings(
+                CANVAS_OAUTH_CLIENT_ID=oauth_settings.get('CANVAS_OAUTH_CLIENT_ID', '10000000000012'),
+                CANVAS_OAUTH_CLIENT_SECRET=oauth_settings.get('CANVAS_OAUTH_CLIENT_SECRET', 'yKZc1bJpdykVBUT4'),
+                CANVAS_OAUTH_CANVAS_DOMAIN=oauth_settings.get('CANVAS_OAUTH_CANVAS_DOMAIN', 'canvas.localhost')):
+            yield
 
 
 class TestCanvasOauthSettings(TestCase):
 
     def test_required_settings_raises_exception(self):
-        with self.assertRaises(ImproperlyConfigured):
-            canvas_oauth_settings = importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME)
-            canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
+        with without_oauth_settings():
+            with self.assertRaises(ImproperlyConfigured):
+                canvas_oauth_settings.CANVAS_OAUTH_CLIENT_ID
+
+    def test_import_does_not_read_settings(self):
+        with without_oauth_settings():
+            importlib.reload(canvas_oauth_settings)
 
     def test_settings_are_present(self):
         with required_oauth_settings():
-            canvas_oauth_settings = importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME)
-            canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_CLIENT_ID'))
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_CLIENT_SECRET'))
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_CANVAS_DOMAIN'))
@@ -38,23 +57,52 @@ class TestCanvasOauthSettings(TestCase):
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_ERROR_TEMPLATE'))
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_SCOPES'))
 
+    def test_unknown_setting_raises_attribute_error(self):
+        self.assertFalse(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_NO_SUCH_SETTING'))
+
     def test_optional_oauth_token_expiration_buffer_default_value(self):
         with required_oauth_settings():
-            canvas_oauth_settings = importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME)
-            canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER'))
             self.assertEqual(datetime.timedelta(0), canvas_oauth_settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER)
 
     def test_optional_oauth_error_template_default_value(self):
         with required_oauth_settings():
-            canvas_oauth_settings = importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME)
-            canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_ERROR_TEMPLATE'))
             self.assertEqual('oauth_error.html', canvas_oauth_settings.CANVAS_OAUTH_ERROR_TEMPLATE)
 
     def test_optional_oauth_scopes_default_value(self):
         with required_oauth_settings():
-            canvas_oauth_settings = importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME)
-            canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_SCOPES'))
             self.assertEqual([], canvas_oauth_settings.CANVAS_OAUTH_SCOPES)
+
+    def test_override_settings(self):
+        self.assertEqual(5, canvas_oauth_settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT)
+        with override_settings(CANVAS_OAUTH_HTTP_READ_TIMEOUT=30):
+            self.assertEqual(30, canvas_oauth_settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT)
+        self.assertEqual(5, canvas_oauth_settings.CANVAS_OAUTH_HTTP_READ_TIMEOUT)
+
+    def test_developer_keys_replace_required_settings(self):
+        developer_keys = {'canvas.localhost': {'client_id': '101', 'client_secret': 'fake-secret'}}
+        with without_oauth_settings(), override_settings(CANVAS_OAUTH_DEVELOPER_KEYS=developer_keys):
+            self.assertEqual(('101', 'fake-secret'), canvas_oauth_settings.get_developer_key('canvas.localhost'))
+            with self.assertRaises(ImproperlyConfigured):
+                canvas_oauth_settings.get_developer_key('canvas-beta.localhost')
+
+    def test_developer_keys_fall_back_to_client_id(self):
+        developer_keys = {'canvas-beta.localhost': {'client_id': '202', 'client_secret': 'b'}}
+        with required_oauth_settings(), override_settings(CANVAS_OAUTH_DEVELOPER_KEYS=developer_keys):
+            self.assertEqual(('202', 'b'), canvas_oauth_settings.get_developer_key('canvas-beta.localhost'))
+            self.assertEqual(('10000000000012', 'yKZc1bJpdykVBUT4'),
+                             canvas_oauth_settings.get_developer_key('canvas.localhost'))
+
+
+class TestLazyImports(TestCase):
+
+    def test_importing_oauth_does_not_import_http_or_crypto_libraries(self):
+        code = (
+            "import sys, django; django.setup(); import canvas_oauth.oauth, canvas_oauth.middleware; "
+            "print(','.join(m for m in ('requests', 'cryptography', 'httpx') if m in sys.modules))"
+        )
+        # A fresh interpreter, since the test runner has imported them already
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(b'', output.strip())
@@ -0,0 +1,153 @@
+from datetime import timedelta
+from threading import Thread
+from unittest.mock import MagicMock, patch
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from canvas_oauth import singleflight
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.tests.utils import create_token
+
+
+def refreshed_with(access_token):
+    def do_refresh(oauth_token):
+        oauth_token.access_token = access_token
+        oauth_token.expires = timezone.now() + timedelta(hours=1)
+        oauth_token.save()
+        return oauth_token
+    return do_refresh
+
+
+class SingleFlightTestMixin(object):
+
+    def setUp(self):
+        singleflight.reset_refresh_stats()
+        cache.clear()
+        self.user = User.objects.create_user(username='jsmith')
+        self.oauth_token = create_token(self.user, 'old-access-token', expires_in=0)
+
+
+@patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_REFRESH_LOCK', 'database')
+class TestRowLockRefresh(SingleFlightTestMixin, TestCase):
+
+    def test_refresh(self):
+        actual_oauth_token = singleflight.refresh(self.oauth_token, refreshed_with('new-access-token'))
+        self.assertEqual('new-access-token', actual_oauth_token.access_token)
+        self.assertEqual('new-access-token', CanvasOAuth2Token.objects.get().access_token)
+        self.assertEqual({'refreshes': 1, 'coalesced': 0, 'lock_timeouts': 0}, singleflight.get_refresh_stats())
+
+    def test_reuses_concurrent_refresh(self):
+        # another request refreshed the token after we read it
+        CanvasOAuth2Token.objects.filter(pk=self.oauth_token.pk).update(
+            access_token='winner-access-token', expires=timezone.now() + timedelta(hours=1))
+        do_refresh = MagicMock()
+
+        actual_oauth_token = singleflight.refresh(self.oauth_token, do_refresh)
+
+        self.assertFalse(do_refresh.called)
+        self.assertEqual('winner-access-token', actual_oauth_token.access_token)
+        self.assertEqual({'refreshes': 0, 'coalesced': 1, 'lock_timeouts': 0}, singleflight.get_refresh_stats())
+
+    def test_refreshes_rotated_token(self):
+        # Re-encrypted with another key since we read it, but not refreshed
+        CanvasOAuth2Token.objects.filter(pk=self.oauth_token.pk).update(access_token='rotated-access-token')
+        actual_oauth_token = singleflight.refresh(self.oauth_token, refreshed_with('new-access-token'))
+        self.assertEqual('new-access-token', actual_oauth_token.access_token)
+        self.assertEqual(1, singleflight.get_refresh_stats()['refreshes'])
+
+    def test_waits_for_row_lock(self):
+        locked_queryset = MagicMock()
+        locked_queryset.get.side_effect = OperationalError("could not obtain lock")
+        select_for_update = CanvasOAuth2Token.objects.select_for_update
+        with patch.object(CanvasOAuth2Token.objects, 'select_for_update',
+                          side_effect=[locked_queryset, select_for_update(nowait=True)]) as mock_select:
+            actual_oauth_token = singleflight.refresh(self.oauth_token, refreshed_with('new-access-token'))
+
+        mock_select.assert_called_with(nowait=True)
+        self.assertEqual(2, mock_select.call_count)
+        self.assertEqual('new-access-token', actual_oauth_token.access_token)
+        self.assertEqual({'refreshes': 1, 'coalesced': 0, 'lock_timeouts': 0}, singleflight.get_refresh_stats())
+
+    @patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT', 0.1)
+    def test_refreshes_after_lock_timeout(self):
+        locked_queryset = MagicMock()
+        locked_queryset.get.side_effect = OperationalError("could not obtain lock")
+        with patch.object(CanvasOAuth2Token.objects, 'select_for_update', return_value=locked_queryset):
+            start = time.monotonic()
+            actual_oauth_token = singleflight.refresh(self.oauth_token, refreshed_with('new-access-token'))
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual('new-access-token', actual_oauth_token.access_token)
+        self.assertEqual({'refreshes': 1, 'coalesced': 0, 'lock_timeouts': 1}, singleflight.get_refresh_stats())
+
+
+@patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_REFRESH_LOCK', 'cache')
+class TestCacheLockRefresh(SingleFlightTestMixin, TestCase):
+
+    def test_refresh_releases_lock(self):
+        actual_oauth_token = singleflight.refresh(self.oauth_token, refreshed_with('new-access-token'))
+        self.assertEqual('new-access-token', actual_oauth_token.access_token)
+        self.assertIsNone(cache.get(singleflight.LOCK_KEY_PATTERN % (self.user.pk, self.oauth_token.domain)))
+
+    def test_reuses_concurrent_refresh(self):
+        CanvasOAuth2Token.objects.filter(pk=self.oauth_token.pk).update(
+            access_token='winner-access-token', expires=timezone.now() + timedelta(hours=1))
+        do_refresh = MagicMock()
+
+        actual_oauth_token = singleflight.refresh(self.oauth_token, do_refresh)
+
+        self.assertFalse(do_refresh.called)
+        self.assertEqual('winner-access-token', actual_oauth_token.access_token)
+        self.assertEqual(1, singleflight.get_refresh_stats()['coalesced'])
+
+    @patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_HTTP_DEADLINE', 30)
+    def test_lock_outlives_retries(self):
+        # The whole token request, retries included, and the wait for the lock
+        self.assertEqual(40, singleflight._get_lock_ttl())
+
+    @patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT', 0.1)
+    def test_refreshes_after_lock_timeout(self):
+        lock_key = singleflight.LOCK_KEY_PATTERN % (self.user.pk, self.oauth_token.domain)
+        cache.add(lock_key, 1)
+
+        actual_oauth_token = singleflight.refresh(self.oauth_token, refreshed_with('new-access-token'))
+
+        self.assertEqual('new-access-token', actual_oauth_token.access_token)
+        self.assertEqual({'refreshes': 1, 'coalesced': 0, 'lock_timeouts': 1}, singleflight.get_refresh_stats())
+        # the lock belongs to someone else and must not be released by us
+        self.assertEqual(1, cache.get(lock_key))
+
+
+@patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_REFRESH_LOCK', 'cache')
+class TestConcurrentRefresh(SingleFlightTestMixin, TransactionTestCase):
+
+    def test_one_refresh_per_stampede(self):
+        def do_refresh(oauth_token):
+            time.sleep(0.05)
+            return refreshed_with('new-access-token')(oauth_token)
+
+        results = []
+        stale_tokens = [CanvasOAuth2Token.objects.get() for _ in range(10)]
+        threads = [Thread(target=lambda t=t: results.append(singleflight.refresh(t, do_refresh)))
+                   for t in stale_tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['new-access-token'] * 10, [t.access_token for t in results])
+        self.assertEqual({'refreshes': 1, 'coalesced': 9, 'lock_timeouts': 0}, singleflight.get_refresh_stats())
+
+
+class TestRefreshLockSetting(SingleFlightTestMixin, TestCase):
+
+    @patch('canvas_oauth.singleflight.settings.CANVAS_OAUTH_REFRESH_LOCK', 'redis')
+    def test_unknown_lock(self):
+        with self.assertRaises(ImproperlyConfigured):
+            singleflight.refresh(self.oauth_token, MagicMock())
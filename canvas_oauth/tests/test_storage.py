@@ -0,0 +1,191 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from canvas_oauth import storage
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token, refresh_oauth_token
+from canvas_oauth.refresh import get_oauth_tokens
+from canvas_oauth.tests.utils import create_token, make_request
+
+DOMAIN = settings.CANVAS_OAUTH_CANVAS_DOMAIN
+
+
+def make_token(user, access_token='access-token', expires_in=3600):
+    return CanvasOAuth2Token(
+        user_id=user.pk,
+        domain=DOMAIN,
+        access_token=access_token,
+        refresh_token='refresh-token',
+        expires=timezone.now() + timedelta(seconds=expires_in))
+
+
+class StorageTestMixin(object):
+    """Behaviour shared by every storage backend."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='jsmith')
+        self.other_user = User.objects.create_user(username='asmith')
+
+    def test_get_missing(self):
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.storage.get(self.user.pk, DOMAIN)
+
+    def test_put_replaces_token(self):
+        first = self.storage.put(make_token(self.user, 'first'))
+        self.storage.put(make_token(self.user, 'second'))
+        oauth_token = self.storage.get(self.user.pk, DOMAIN)
+        self.assertEqual('second', oauth_token.access_token)
+        self.assertEqual(first.created_on, oauth_token.created_on)
+        self.assertGreaterEqual(oauth_token.updated_on, first.updated_on)
+
+    def test_update(self):
+        self.storage.put(make_token(self.user))
+        oauth_token = self.storage.get(self.user.pk, DOMAIN)
+        oauth_token.access_token = 'new-access-token'
+        self.storage.update(oauth_token)
+        self.assertEqual('new-access-token', self.storage.get(self.user.pk, DOMAIN).access_token)
+
+    def test_delete(self):
+        self.storage.put(make_token(self.user))
+        self.storage.delete(self.user.pk, DOMAIN)
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.storage.get(self.user.pk, DOMAIN)
+
+    def test_bulk_operations(self):
+        self.storage.put_many([make_token(self.user, 'a'), make_token(self.other_user, 'b')])
+        tokens = self.storage.get_many([self.user.pk, self.other_user.pk, 0], DOMAIN)
+        self.assertEqual({self.user.pk: 'a', self.other_user.pk: 'b'},
+                         {user_id: oauth_token.access_token for user_id, oauth_token in tokens.items()})
+
+        self.storage.delete_many([tokens[self.other_user.pk]])
+        self.assertEqual([self.user.pk], list(self.storage.get_many([self.user.pk, self.other_user.pk], DOMAIN)))
+
+    def test_update_many_skips_changed_tokens(self):
+        self.storage.put_many([make_token(self.user, 'a'), make_token(self.other_user, 'b')])
+        tokens = self.storage.get_many([self.user.pk, self.other_user.pk], DOMAIN)
+        expected = {storage.get_key(oauth_token): oauth_token.access_token for oauth_token in tokens.values()}
+
+        # Refreshed by someone else in the meantime
+        concurrent_token = self.storage.get(self.other_user.pk, DOMAIN)
+        concurrent_token.access_token = 'refreshed-elsewhere'
+        self.storage.update(concurrent_token)
+
+        for oauth_token in tokens.values():
+            oauth_token.access_token = 'refreshed'
+        written = self.storage.update_many(list(tokens.values()), ['access_token'], expected)
+        self.assertEqual([self.user.pk], [oauth_token.user_id for oauth_token in written])
+        self.assertEqual('refreshed', self.storage.get(self.user.pk, DOMAIN).access_token)
+        self.assertEqual('refreshed-elsewhere', self.storage.get(self.other_user.pk, DOMAIN).access_token)
+
+    async def test_async(self):
+        oauth_token = await self.storage.aput(make_token(self.user))
+        oauth_token.access_token = 'new-access-token'
+        await self.storage.aupdate(oauth_token)
+        self.assertEqual('new-access-token', (await self.storage.aget(self.user.pk, DOMAIN)).access_token)
+        await self.storage.adelete(self.user.pk, DOMAIN)
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            await self.storage.aget(self.user.pk, DOMAIN)
+
+
+class TestDatabaseStorage(StorageTestMixin, TestCase):
+    storage = storage.DatabaseStorage()
+
+    def test_put_keeps_one_row(self):
+        self.storage.put(make_token(self.user))
+        self.storage.put(make_token(self.user))
+        self.assertEqual(1, CanvasOAuth2Token.objects.filter(user=self.user).count())
+
+
+class TestCacheStorage(StorageTestMixin, TestCase):
+    storage = storage.CacheStorage()
+
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            self.storage.put(make_token(self.user))
+            oauth_token = self.storage.get(self.user.pk, DOMAIN)
+        self.assertEqual('access-token', oauth_token.access_token)
+        self.assertFalse(CanvasOAuth2Token.objects.exists())
+
+    def test_update_many_leaves_updated_on(self):
+        self.storage.put(make_token(self.user))
+        oauth_token = self.storage.get(self.user.pk, DOMAIN)
+        updated_on = oauth_token.updated_on
+        oauth_token.access_token = 'refreshed'
+        self.storage.update_many([oauth_token], ['access_token'])
+        self.assertEqual(updated_on, self.storage.get(self.user.pk, DOMAIN).updated_on)
+
+
+class TestWriteThroughStorage(StorageTestMixin, TestCase):
+    storage = storage.WriteThroughStorage()
+
+    def test_reads_from_cache(self):
+        create_token(self.user)
+        self.storage.get(self.user.pk, DOMAIN)
+        with self.assertNumQueries(0):
+            oauth_token = self.storage.get(self.user.pk, DOMAIN)
+        self.assertEqual('access-token', oauth_token.access_token)
+        self.assertIsNotNone(oauth_token.pk)
+
+    def test_writes_to_database(self):
+        self.storage.put(make_token(self.user))
+        self.assertEqual('access-token', CanvasOAuth2Token.objects.get(user=self.user).access_token)
+
+    @override_settings(CANVAS_OAUTH_TOKEN_STORAGE='canvas_oauth.storage.WriteThroughStorage')
+    def test_database_changes_evict_cache(self):
+        token_storage = storage.get_storage()
+        token_storage.put(make_token(self.user))
+        CanvasOAuth2Token.objects.filter(user=self.user).delete()
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            token_storage.get(self.user.pk, DOMAIN)
+
+
+class TestGetStorage(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='jsmith')
+        self.request = make_request(self.user)
+
+    def test_default(self):
+        self.assertIsInstance(storage.get_storage(), storage.DatabaseStorage)
+        self.assertIs(storage.get_storage(), storage.get_storage())
+
+    @override_settings(CANVAS_OAUTH_TOKEN_STORAGE='canvas_oauth.storage.CacheStorage')
+    def test_get_oauth_token(self):
+        self.assertIsInstance(storage.get_storage(), storage.CacheStorage)
+        storage.get_storage().put(make_token(self.user))
+        with self.assertNumQueries(0):
+            self.assertEqual('access-token', get_oauth_token(self.request))
+
+    @override_settings(CANVAS_OAUTH_TOKEN_STORAGE='canvas_oauth.storage.CacheStorage',
+                       CANVAS_OAUTH_REFRESH_LOCK='cache')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refresh(self, mock_get_access_token):
+        expires = timezone.now() + timedelta(hours=1)
+        mock_get_access_token.return_value = ('new-access-token', expires, None)
+        storage.get_storage().put(make_token(self.user, expires_in=-60))
+        self.assertEqual('new-access-token', get_oauth_token(self.request))
+
+        oauth_token = storage.get_storage().get(self.user.pk, DOMAIN)
+        self.assertEqual('new-access-token', oauth_token.access_token)
+        self.assertEqual(expires, oauth_token.expires)
+        # Another request with the stale token reuses the refreshed one
+        refresh_oauth_token(self.request, make_token(self.user, expires_in=-60))
+        mock_get_access_token.assert_called_once()
+
+    @override_settings(CANVAS_OAUTH_TOKEN_STORAGE='canvas_oauth.storage.CacheStorage')
+    @patch('canvas_oauth.refresh.canvas.get_access_token')
+    def test_get_oauth_tokens(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        other_user = User.objects.create_user(username='asmith')
+        storage.get_storage().put_many([make_token(self.user), make_token(other_user, expires_in=-60)])
+        results = get_oauth_tokens([self.user, other_user])
+        self.assertEqual({self.user.pk: ('access-token', None), other_user.pk: ('new-access-token', None)}, results)
+        self.assertEqual('new-access-token', storage.get_storage().get(other_user.pk, DOMAIN).access_token)
@@ -0,0 +1,131 @@
+import time
+from threading import Thread
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from canvas_oauth import throttle
+from canvas_oauth.tests.utils import make_response
+from canvas_oauth.throttle import Throttle, get_throttle, get_throttle_stats
+
+
+def rate_limit_response(remaining, cost=None):
+    headers = {'X-Rate-Limit-Remaining': str(remaining)}
+    if cost is not None:
+        headers['X-Request-Cost'] = str(cost)
+    return make_response(headers=headers)
+
+
+@override_settings(CANVAS_OAUTH_API_MAX_CONCURRENCY=8)
+class TestThrottle(SimpleTestCase):
+
+    def setUp(self):
+        throttle.reset_throttles()
+        self.addCleanup(throttle.reset_throttles)
+
+    def test_unknown_budget_allows_max_concurrency(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        self.assertIsNone(token_throttle.get_budget())
+        self.assertEqual(8, token_throttle.get_concurrency(None))
+
+    def test_concurrency_follows_budget(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        self.assertEqual(8, token_throttle.get_concurrency(700))
+        self.assertEqual(3, token_throttle.get_concurrency(200))
+        self.assertEqual(0, token_throttle.get_concurrency(60))
+
+    def test_records_response_headers(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        token_throttle.acquire()
+        token_throttle.release(rate_limit_response(612.5, 1.25))
+        self.assertAlmostEqual(612.5, token_throttle.get_budget(), delta=1)
+        self.assertEqual(1.25, token_throttle.cost)
+        self.assertEqual(0, token_throttle.in_flight)
+
+    def test_budget_refills(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        token_throttle.release(rate_limit_response(100))
+        self.assertEqual(150, token_throttle.get_budget(token_throttle.updated_at + 5))
+        self.assertEqual(700, token_throttle.get_budget(token_throttle.updated_at + 3600))
+
+    def test_throttled_response_empties_budget(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        token_throttle.acquire()
+        token_throttle.release(make_response(403, text='403 Forbidden (Rate Limit Exceeded)'))
+        self.assertLess(token_throttle.get_budget(), 1)
+        self.assertEqual(1, token_throttle.throttled)
+        self.assertTrue(throttle.is_throttled_response(make_response(429)))
+        self.assertFalse(throttle.is_throttled_response(make_response(403, text='unauthorized')))
+
+    @patch('canvas_oauth.throttle.REFILL_RATE', 1000.0)
+    def test_waits_for_budget(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        token_throttle.release(rate_limit_response(60))
+        token_throttle.in_flight = 0
+        started = time.monotonic()
+        token_throttle.acquire()
+        self.assertGreater(time.monotonic() - started, 0.02)
+        self.assertEqual(1, token_throttle.waits)
+
+    def test_bounds_concurrency(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        # Enough for two requests in flight
+        token_throttle.release(rate_limit_response(160))
+        token_throttle.in_flight = 0
+        token_throttle.acquire()
+        token_throttle.acquire()
+
+        acquired = []
+        thread = Thread(target=lambda: acquired.append(token_throttle.acquire()))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual([], acquired)
+        # A finished request reports a budget with room to spare
+        token_throttle.release(rate_limit_response(700))
+        thread.join(1)
+        self.assertEqual([None], acquired)
+        self.assertEqual(2, token_throttle.in_flight)
+
+    @override_settings(CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS='default')
+    def test_shares_budget_through_cache(self):
+        cache.clear()
+        reporter = Throttle('key', 'canvas.localhost')
+        reporter.release(rate_limit_response(300))
+        other_process = Throttle('key', 'canvas.localhost')
+        other_process.acquire()
+        self.assertAlmostEqual(300, other_process.get_budget(), delta=1)
+
+    @override_settings(CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS='default')
+    def test_publishes_budget_outside_lock(self):
+        token_throttle = Throttle('key', 'canvas.localhost')
+        token_throttle.acquire()
+        locked = []
+
+        def set_shared(*args):
+            # The condition's lock is reentrant, so try it from another thread
+            thread = Thread(target=lambda: locked.append(not token_throttle._condition.acquire(timeout=0.1)))
+            thread.start()
+            thread.join()
+
+        with patch('canvas_oauth.throttle.caches') as mock_caches:
+            mock_caches.__getitem__.return_value.set.side_effect = set_shared
+            token_throttle.release(rate_limit_response(300))
+        self.assertEqual([False], locked)
+
+    def test_throttles_are_per_token_and_domain(self):
+        self.assertIs(get_throttle('canvas.localhost', 'a'), get_throttle('canvas.localhost', 'a'))
+        self.assertIsNot(get_throttle('canvas.localhost', 'a'), get_throttle('canvas.localhost', 'b'))
+        self.assertIsNot(get_throttle('canvas.localhost', 'a'), get_throttle('canvas-beta.localhost', 'a'))
+
+    def test_stats(self):
+        token_throttle = get_throttle('canvas.localhost', 'access-token')
+        token_throttle.acquire()
+        token_throttle.release(rate_limit_response(700, 2))
+        stats = get_throttle_stats()[token_throttle.key]
+        self.assertEqual('canvas.localhost', stats['domain'])
+        self.assertEqual(8, stats['concurrency'])
+        self.assertEqual(1, stats['requests'])
+        self.assertEqual(2, stats['last_cost'])
+        # Only a hash of the token is kept
+        self.assertNotIn('access-token', token_throttle.key)
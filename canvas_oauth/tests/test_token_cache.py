@@ -0,0 +1,126 @@
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from canvas_oauth import token_cache
+from canvas_oauth.exceptions import MissingTokenError
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.tests.utils import create_token, make_request
+
+
+class TestLRUCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = token_cache.LRUCache(2)
+        lru.set('a', 1, 60)
+        lru.set('b', 2, 60)
+        lru.get('a')
+        lru.set('c', 3, 60)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+
+    def test_entries_expire(self):
+        lru = token_cache.LRUCache(2)
+        lru.set('a', 1, 0)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(0, len(lru))
+
+
+@patch('canvas_oauth.token_cache.settings.CANVAS_OAUTH_TOKEN_CACHE_ALIAS', 'default')
+@patch('canvas_oauth.token_cache.settings.CANVAS_OAUTH_TOKEN_CACHE', True)
+class TestTokenCache(TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username='jsmith')
+
+    def get_token(self):
+        return token_cache.get_token(
+            self.user.pk, 'canvas.localhost',
+            lambda: CanvasOAuth2Token.objects.get(user=self.user, domain='canvas.localhost'))
+
+    def test_read_through(self):
+        create_token(self.user)
+        self.assertEqual('access-token', self.get_token().access_token)
+        with self.assertNumQueries(0):
+            oauth_token = self.get_token()
+        self.assertEqual('access-token', oauth_token.access_token)
+        self.assertEqual(self.user.pk, oauth_token.user_id)
+        self.assertEqual({'local_hits': 1, 'shared_hits': 0, 'missing_hits': 0, 'misses': 1, 'local_size': 1},
+                         token_cache.get_cache_stats())
+
+    def test_shared_tier_fills_local_tier(self):
+        create_token(self.user)
+        self.get_token()
+        token_cache._get_local_cache().clear()
+        with self.assertNumQueries(0):
+            self.get_token()
+        self.assertEqual(1, token_cache.get_cache_stats()['shared_hits'])
+
+    def test_cached_token_can_be_saved(self):
+        create_token(self.user)
+        self.get_token()
+        oauth_token = self.get_token()
+        oauth_token.access_token = 'new-access-token'
+        oauth_token.save()
+        self.assertEqual(1, CanvasOAuth2Token.objects.count())
+        self.assertEqual('new-access-token', self.get_token().access_token)
+
+    @patch('canvas_oauth.token_cache.settings.CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT', 0)
+    def test_local_timeout(self):
+        create_token(self.user)
+        self.get_token()
+        self.assertEqual(0, token_cache.get_cache_stats()['local_size'])
+        with self.assertNumQueries(0):
+            self.get_token()
+        self.assertEqual(1, token_cache.get_cache_stats()['shared_hits'])
+
+    def test_expiring_token_is_not_cached(self):
+        create_token(self.user, expires_in=-10)
+        self.get_token()
+        self.get_token()
+        self.assertEqual(2, token_cache.get_cache_stats()['misses'])
+
+    def test_missing_token_is_remembered(self):
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.get_token()
+        with self.assertNumQueries(0):
+            with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+                self.get_token()
+        self.assertEqual(1, token_cache.get_cache_stats()['missing_hits'])
+
+    def test_created_token_replaces_missing_token(self):
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.get_token()
+        create_token(self.user)
+        self.assertEqual('access-token', self.get_token().access_token)
+
+    def test_deleted_token_is_invalidated(self):
+        create_token(self.user)
+        self.get_token().delete()
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.get_token()
+
+    def test_get_oauth_token(self):
+        create_token(self.user)
+        request = make_request(self.user)
+        get_oauth_token(request)
+
+        request.user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual('access-token', get_oauth_token(request))
+
+    def test_get_oauth_token_missing(self):
+        request = RequestFactory().get('/index')
+        request.user = MagicMock(pk=self.user.pk)
+        request.session = {}
+        for _ in range(2):
+            with self.assertRaises(MissingTokenError):
+                get_oauth_token(request)
+        self.assertEqual(1, token_cache.get_cache_stats()['misses'])
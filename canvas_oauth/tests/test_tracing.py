@@ -0,0 +1,108 @@
+from unittest.mock import MagicMock, patch
+
+import httpx
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from canvas_oauth import canvas, tracing
+from canvas_oauth.exceptions import MissingTokenError
+from canvas_oauth.oauth import get_oauth_token, handle_missing_token
+from canvas_oauth.tests.utils import create_token, make_request
+
+EXPORTER = 'canvas_oauth.tracing.InMemoryExporter'
+
+
+class TestSpans(TestCase):
+
+    def test_disabled_by_default(self):
+        with tracing.span('outer') as span:
+            self.assertIsNone(span)
+            self.assertIsNone(tracing.get_traceparent())
+            tracing.set_attribute('key', 'value')
+
+    @patch('canvas_oauth.tracing.settings.CANVAS_OAUTH_TRACING_EXPORTER', EXPORTER)
+    def test_nested_spans(self):
+        exporter = tracing.get_exporter()
+        exporter.clear()
+        with tracing.span('outer') as outer:
+            with self.assertRaises(ValueError):
+                with tracing.span('inner', {'key': 'value'}):
+                    raise ValueError("boom")
+            self.assertEqual(outer.traceparent, tracing.get_traceparent())
+        self.assertIsNone(tracing.get_current_span())
+
+        inner, outer = exporter.get_spans()
+        self.assertEqual(outer.trace_id, inner.trace_id)
+        self.assertEqual(outer.span_id, inner.parent_id)
+        self.assertIsNone(outer.parent_id)
+        self.assertEqual({'key': 'value'}, inner.attributes)
+        self.assertEqual(('error', 'ValueError: boom'), (inner.status, inner.error))
+        self.assertEqual('ok', outer.status)
+        self.assertGreaterEqual(outer.duration, inner.duration)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        patcher = patch('canvas_oauth.tracing.settings.CANVAS_OAUTH_TRACING_EXPORTER', EXPORTER)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.exporter = tracing.get_exporter()
+        self.exporter.clear()
+        self.user = User.objects.create_user(username='jsmith')
+        self.request = make_request(self.user, '/')
+        self.request.session['canvas_oauth_canvas_domain'] = 'canvas.example.edu'
+
+    def test_get_oauth_token(self):
+        create_token(self.user, domain='canvas.example.edu')
+        get_oauth_token(self.request)
+        get_oauth_token(self.request)
+        first, second = self.exporter.get_spans('canvas_oauth.get_oauth_token')
+        self.assertEqual({'canvas_oauth.cache_hit': False,
+                          'canvas_oauth.domain': 'canvas.example.edu',
+                          'canvas_oauth.encrypted': False}, first.attributes)
+        self.assertEqual({'canvas_oauth.cache_hit': True}, second.attributes)
+
+    def test_missing_token(self):
+        with self.assertRaises(MissingTokenError):
+            get_oauth_token(self.request)
+        span, = self.exporter.get_spans()
+        self.assertEqual('error', span.status)
+
+    @patch('canvas_oauth.canvas.get_session')
+    def test_refresh_propagates_context(self, mock_get_session):
+        mock_get_session.return_value.post.return_value = MagicMock(
+            status_code=200, json=lambda: {'access_token': 'new-token', 'expires_in': 3600})
+        create_token(self.user, expires_in=0, domain='canvas.example.edu')
+        self.assertEqual('new-token', get_oauth_token(self.request))
+
+        request_span, refresh_span, lookup_span = self.exporter.get_spans()
+        self.assertEqual('canvas_oauth.get_access_token', request_span.name)
+        self.assertEqual(refresh_span.span_id, request_span.parent_id)
+        self.assertEqual(lookup_span.span_id, refresh_span.parent_id)
+        self.assertEqual({'canvas_oauth.domain': 'canvas.example.edu',
+                          'canvas_oauth.grant_type': 'refresh_token',
+                          'http.status_code': 200}, request_span.attributes)
+        headers = mock_get_session.return_value.post.call_args[1]['headers']
+        self.assertEqual({'traceparent': request_span.traceparent}, headers)
+
+    def test_handle_missing_token(self):
+        handle_missing_token(self.request)
+        span, = self.exporter.get_spans()
+        self.assertEqual('canvas_oauth.handle_missing_token', span.name)
+        self.assertEqual({'canvas_oauth.domain': 'canvas.example.edu'}, span.attributes)
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_async_request_propagates_context(self, mock_get_async_client):
+        requests_made = []
+
+        def handler(request):
+            requests_made.append(request)
+            return httpx.Response(200, json={"access_token": "access-token", "expires_in": 3600})
+
+        mock_get_async_client.return_value = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        await canvas.aget_access_token(
+            grant_type='refresh_token', refresh_token='refresh-token', client_id='101',
+            client_secret='fake-secret', redirect_uri=None, domain='canvas.example.edu')
+        span, = self.exporter.get_spans()
+        self.assertEqual(span.traceparent, requests_made[0].headers['traceparent'])
@@ -0,0 +1,87 @@
+"""
+Fixtures and fake responses shared by the test modules.
+"""
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+from django.utils import timezone
+from requests.structures import CaseInsensitiveDict
+
+from canvas_oauth.models import CanvasOAuth2Token
+
+
+def create_token(user, access_token='access-token', refresh_token='refresh-token', expires_in=3600,
+                 domain=None):
+    """Saves a token for the user that expires in `expires_in` seconds, by
+    default for CANVAS_OAUTH_CANVAS_DOMAIN."""
+    return CanvasOAuth2Token.objects.create(
+        user=user,
+        domain=domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+        access_token=access_token,
+        refresh_token=refresh_token,
+        expires=timezone.now() + timedelta(seconds=expires_in))
+
+
+def make_request(user, path='/index'):
+    request = RequestFactory().get(path)
+    request.user = user
+    request.session = {}
+    return request
+
+
+class TokenTestMixin(object):
+    """Sets up `self.user` with a token valid for an hour, `self.oauth_token`,
+    and `self.request`, a request made by the user."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.oauth_token = create_token(self.user)
+        self.request = make_request(self.user)
+
+
+def make_response(status_code=200, headers=None, json=None, text=''):
+    """Returns a mock `requests.Response`."""
+    r = MagicMock()
+    r.status_code = status_code
+    r.headers = headers or {}
+    r.json.return_value = json
+    r.text = text
+    return r
+
+
+class Body(object):
+    """A response body that drops the connection after `fail_after` bytes."""
+
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = fail_after
+        self.position = 0
+
+    def read(self, size):
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+        end = len(self.data) if self.fail_after is None else self.fail_after
+        chunk = self.data[self.position:min(self.position + size, end)]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+def make_real_response(status_code=200, headers=None, body=b'', url='https://canvas.localhost/api/v1/courses/1',
+                       fail_after=None):
+    """Returns a `requests.Response` that reads `body` from the connection,
+    for code that streams or caches responses."""
+    r = requests.Response()
+    r.status_code = status_code
+    r.reason = 'Reason'
+    r.url = url
+    r.headers = CaseInsensitiveDict(headers or {})
+    r.raw = Body(body, fail_after)
+    r.encoding = 'utf-8'
+    return r
@@ -0,0 +1,207 @@
+"""
+Rate-limit-aware throttling of Canvas API requests, per token and domain.
+
+Canvas gives each access token a bucket of request units.  Every request is
+charged a flat amount up front while it runs, and its actual cost when it
+finishes; the bucket refills at a steady rate, and once it runs dry Canvas
+answers 403 "Rate Limit Exceeded" (or 429).  Responses report what is left
+in X-Rate-Limit-Remaining and what they cost in X-Request-Cost.
+
+A Throttle tracks that budget from the response headers and only lets as
+many requests run at once as the estimated budget can pay for, keeping
+`RESERVE` units in hand.  When the budget is short, requests wait for it to
+refill instead of being throttled.  Throttles are shared by the threads of
+a process; with CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS set, the last reported
+budget is also shared between processes through the Django cache.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from canvas_oauth import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PATTERN = "canvas_oauth:throttle:%s:%s"
+
+# The size of a Canvas rate limit bucket, the units Canvas charges each
+# request while it runs, and how many units per second the bucket refills
+BUCKET_SIZE = 700.0
+IN_FLIGHT_COST = 50.0
+REFILL_RATE = 10.0
+
+# Units kept in the bucket, so that other clients of the token are not
+# throttled either
+RESERVE = 50.0
+
+# The longest a request waits for the budget before going ahead anyway
+MAX_WAIT = 60
+
+# Throttles are kept for this many tokens per process
+MAX_THROTTLES = 1000
+
+_throttles = OrderedDict()
+_throttles_lock = threading.Lock()
+
+
+def is_throttled_response(r):
+    if r.status_code == 429:
+        return True
+    return r.status_code == 403 and 'Rate Limit Exceeded' in r.text
+
+
+class Throttle(object):
+
+    def __init__(self, key, domain):
+        self.key = key
+        self.domain = domain
+        self.remaining = None
+        self.updated_at = None
+        self.cost = None
+        self.in_flight = 0
+        self.requests = 0
+        self.waits = 0
+        self.throttled = 0
+        self._condition = threading.Condition()
+
+    def get_budget(self, now=None):
+        """Returns the estimated units left in the bucket, not counting
+        requests in flight, or None if Canvas has not reported it yet."""
+        if self.remaining is None:
+            return None
+        now = time.monotonic() if now is None else now
+        return min(BUCKET_SIZE, self.remaining + REFILL_RATE * (now - self.updated_at))
+
+    def get_concurrency(self, budget):
+        max_concurrency = settings.CANVAS_OAUTH_API_MAX_CONCURRENCY
+        if budget is None:
+            return max_concurrency
+        return max(0, min(max_concurrency, int((budget - RESERVE) // IN_FLIGHT_COST)))
+
+    def acquire(self):
+        """Blocks until a request fits in the budget, then counts it as in
+        flight.  Every call must be followed by `release`."""
+        self._load_shared()
+        deadline = time.monotonic() + MAX_WAIT
+        waited = False
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                budget = self.get_budget(now)
+                if self.in_flight < self.get_concurrency(budget) or now >= deadline:
+                    break
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                    metrics.increment('canvas_oauth_api_throttle_waits_total', domain=self.domain)
+                if budget is None:
+                    # Wait for a request in flight to finish
+                    delay = deadline - now
+                else:
+                    # Wait for the bucket to refill enough for one more request
+                    needed = RESERVE + IN_FLIGHT_COST * (self.in_flight + 1) - budget
+                    delay = min(max(needed / REFILL_RATE, 0.01), deadline - now)
+                self._condition.wait(delay)
+            self.in_flight += 1
+            self.requests += 1
+
+    def release(self, r=None):
+        """Records the response of a request, or None if it failed, and lets
+        waiting requests re-check the budget."""
+        remaining = None
+        with self._condition:
+            self.in_flight -= 1
+            if r is not None:
+                remaining = self._record(r)
+            self._condition.notify_all()
+        # The cache may be a network round trip, so other threads should not
+        # wait on it
+        if remaining is not None:
+            self._save_shared(remaining)
+
+    def _record(self, r):
+        """Updates the budget from a response, returning the units Canvas
+        reported left, if any."""
+        if is_throttled_response(r):
+            logger.warning("Canvas throttled a request to %s", self.domain)
+            self.throttled += 1
+            metrics.increment('canvas_oauth_api_throttled_total', domain=self.domain)
+            return self._set_remaining(0.0)
+        remaining = r.headers.get('X-Rate-Limit-Remaining')
+        if remaining is None:
+            return None
+        cost = r.headers.get('X-Request-Cost')
+        if cost is not None:
+            self.cost = float(cost)
+        return self._set_remaining(float(remaining))
+
+    def _set_remaining(self, remaining):
+        self.remaining = remaining
+        self.updated_at = time.monotonic()
+        return remaining
+
+    def _save_shared(self, remaining):
+        """Reports the budget to other processes."""
+        alias = settings.CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS
+        if alias:
+            caches[alias].set(self.key, (remaining, time.time()), int(BUCKET_SIZE / REFILL_RATE))
+
+    def _load_shared(self):
+        """Adopts the budget last reported to another process, if newer."""
+        alias = settings.CANVAS_OAUTH_API_THROTTLE_CACHE_ALIAS
+        if not alias:
+            return
+        shared = caches[alias].get(self.key)
+        if shared is None:
+            return
+        remaining, reported_at = shared
+        updated_at = time.monotonic() - (time.time() - reported_at)
+        with self._condition:
+            if self.updated_at is None or updated_at > self.updated_at:
+                self.remaining = remaining
+                self.updated_at = updated_at
+
+    def get_stats(self):
+        budget = self.get_budget()
+        return {
+            'domain': self.domain,
+            'remaining': budget,
+            'concurrency': self.get_concurrency(budget),
+            'in_flight': self.in_flight,
+            'last_cost': self.cost,
+            'requests': self.requests,
+            'waits': self.waits,
+            'throttled': self.throttled,
+        }
+
+
+def get_throttle(domain, access_token):
+    """Returns the throttle for the given token and domain.  Tokens are
+    only kept as a hash."""
+    key = KEY_PATTERN % (domain, hashlib.sha256(access_token.encode()).hexdigest()[:32])
+    with _throttles_lock:
+        throttle = _throttles.get(key)
+        if throttle is None:
+            throttle = _throttles[key] = Throttle(key, domain)
+            while len(_throttles) > MAX_THROTTLES:
+                _throttles.popitem(last=False)
+        else:
+            _throttles.move_to_end(key)
+    return throttle
+
+
+def get_throttle_stats():
+    """Reports the estimated budget, allowed concurrency and counters of
+    each throttle, keyed by cache key."""
+    with _throttles_lock:
+        throttles = list(_throttles.values())
+    return {throttle.key: throttle.get_stats() for throttle in throttles}
+
+
+def reset_throttles():
+    with _throttles_lock:
+        _throttles.clear()
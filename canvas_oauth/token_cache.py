@@ -0,0 +1,251 @@
+"""
+Opt-in read-through cache in front of the CanvasOAuth2Token table.
+
+The first tier is a bounded, in-process LRU; the second tier is an optional
+Django cache shared by all processes.  Entries never outlive the point at
+which the token would be refreshed.  Saving or deleting a token clears it
+from the shared tier and from the in-process tier of the process that made
+the change, but other processes keep their in-process copy until it times
+out, after CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT seconds.  Users without a
+token are remembered in the shared tier only, so that a token created by
+another process is seen right away.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from canvas_oauth import metrics, settings, tracing
+from canvas_oauth.models import CanvasOAuth2Token
+
+KEY_PATTERN = "canvas_oauth:token:%s:%s"
+
+# Stored in the shared tier for users known to have no token
+MISSING = 'missing'
+
+
+class LRUCache(object):
+    """A thread-safe LRU mapping whose entries also expire after a timeout."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, deadline = entry
+            if deadline <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_local = None
+_local_lock = threading.Lock()
+
+_stats = {'local_hits': 0, 'shared_hits': 0, 'missing_hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _incr(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+    metrics.increment('canvas_oauth_token_cache_total', result=stat)
+    tracing.set_attribute('canvas_oauth.cache_hit', stat != 'misses')
+
+
+def _get_local_cache():
+    global _local
+    if _local is None:
+        with _local_lock:
+            if _local is None:
+                _local = LRUCache(settings.CANVAS_OAUTH_TOKEN_CACHE_SIZE)
+    return _local
+
+
+def _get_shared_cache():
+    alias = settings.CANVAS_OAUTH_TOKEN_CACHE_ALIAS
+    return caches[alias] if alias else None
+
+
+def _to_values(oauth_token):
+    return {f.attname: getattr(oauth_token, f.attname) for f in oauth_token._meta.concrete_fields}
+
+
+def _from_values(values):
+    oauth_token = CanvasOAuth2Token(**values)
+    oauth_token._state.adding = False
+    return oauth_token
+
+
+def _get_timeout(oauth_token):
+    """Seconds the token may be cached: never past the moment it is due to be
+    refreshed, so a cached token never needs refreshing."""
+    refresh_at = oauth_token.expires - settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+    remaining = (refresh_at - timezone.now()).total_seconds()
+    return min(settings.CANVAS_OAUTH_TOKEN_CACHE_TIMEOUT, remaining)
+
+
+def _set_local(key, values, timeout):
+    """Stores the token's values in the in-process tier, for no longer than
+    CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT, since other processes cannot
+    invalidate it."""
+    local_timeout = settings.CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT
+    if local_timeout is not None:
+        timeout = min(timeout, local_timeout)
+    if timeout > 0:
+        _get_local_cache().set(key, values, timeout)
+
+
+def get_token(user_id, domain, loader):
+    """Returns the token for the given user and Canvas domain from the cache,
+    falling back to `loader()` on a miss.  Raises CanvasOAuth2Token.DoesNotExist
+    if the user has no token, whether that is known from the cache or from
+    `loader`.
+    """
+    key = KEY_PATTERN % (user_id, domain)
+    oauth_token = _get_local_token(key)
+    if oauth_token is not None:
+        return oauth_token
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        oauth_token = _from_shared_values(key, user_id, shared_cache.get(key))
+        if oauth_token is not None:
+            return oauth_token
+
+    _incr('misses')
+    try:
+        oauth_token = loader()
+    except CanvasOAuth2Token.DoesNotExist:
+        if shared_cache is not None:
+            shared_cache.set(key, MISSING, settings.CANVAS_OAUTH_TOKEN_CACHE_MISSING_TIMEOUT)
+        raise
+    set_token(oauth_token)
+    return oauth_token
+
+
+async def aget_token(user_id, domain, aloader):
+    """Async version of `get_token`, where `aloader` is a coroutine function."""
+    key = KEY_PATTERN % (user_id, domain)
+    oauth_token = _get_local_token(key)
+    if oauth_token is not None:
+        return oauth_token
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        oauth_token = _from_shared_values(key, user_id, await shared_cache.aget(key))
+        if oauth_token is not None:
+            return oauth_token
+
+    _incr('misses')
+    try:
+        oauth_token = await aloader()
+    except CanvasOAuth2Token.DoesNotExist:
+        if shared_cache is not None:
+            await shared_cache.aset(key, MISSING, settings.CANVAS_OAUTH_TOKEN_CACHE_MISSING_TIMEOUT)
+        raise
+    timeout = _get_timeout(oauth_token)
+    if timeout > 0:
+        values = _to_values(oauth_token)
+        _set_local(key, values, timeout)
+        if shared_cache is not None:
+            await shared_cache.aset(key, values, timeout)
+    return oauth_token
+
+
+def _get_local_token(key):
+    values = _get_local_cache().get(key)
+    if values is None:
+        return None
+    _incr('local_hits')
+    return _from_values(values)
+
+
+def _from_shared_values(key, user_id, values):
+    if values == MISSING:
+        _incr('missing_hits')
+        raise CanvasOAuth2Token.DoesNotExist("No token found for user %s" % user_id)
+    if values is None:
+        return None
+    _incr('shared_hits')
+    oauth_token = _from_values(values)
+    timeout = _get_timeout(oauth_token)
+    _set_local(key, values, timeout)
+    return oauth_token
+
+
+def set_token(oauth_token):
+    """Stores the token in both cache tiers."""
+    timeout = _get_timeout(oauth_token)
+    if timeout <= 0:
+        return
+    key = KEY_PATTERN % (oauth_token.user_id, oauth_token.domain)
+    values = _to_values(oauth_token)
+    _set_local(key, values, timeout)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(key, values, timeout)
+
+
+def invalidate(user_id, domain):
+    """Removes any cached token, or knowledge of a missing token, for the
+    given user and Canvas domain from both cache tiers."""
+    key = KEY_PATTERN % (user_id, domain)
+    _get_local_cache().delete(key)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete(key)
+
+
+def clear():
+    """Empties the in-process tier and resets the statistics."""
+    _get_local_cache().clear()
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
+
+
+def get_cache_stats():
+    """Returns hit and miss counters along with the in-process tier's size."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['local_size'] = len(_get_local_cache())
+    return stats
+
+
+def invalidate_token(sender, instance, **kwargs):
+    if settings.CANVAS_OAUTH_TOKEN_CACHE:
+        invalidate(instance.user_id, instance.domain)
+
+
+post_save.connect(invalidate_token, sender=CanvasOAuth2Token,
+                  dispatch_uid='canvas_oauth_invalidate_saved_token')
+post_delete.connect(invalidate_token, sender=CanvasOAuth2Token,
+                    dispatch_uid='canvas_oauth_invalidate_deleted_token')
@@ -0,0 +1,171 @@
+"""
+Optional tracing spans for token lookups, refreshes, token requests and the
+OAuth dance.
+
+The exporter is chosen with the CANVAS_OAUTH_TRACING_EXPORTER setting, a
+dotted path to a class with an `export(span)` method, which is called as
+each span ends.  By default tracing is disabled and no spans are created.
+The current span is tracked in a context variable, so nested spans share a
+trace in both threads and tasks, and it is propagated to Canvas in a W3C
+`traceparent` header.
+"""
+import contextvars
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils.module_loading import import_string
+
+from canvas_oauth import settings
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('canvas_oauth_span', default=None)
+
+
+class Span(object):
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else '%032x' % random.getrandbits(128)
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def duration(self):
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    @property
+    def traceparent(self):
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __repr__(self):
+        return '<Span %s %s>' % (self.name, self.span_id)
+
+
+class InMemoryExporter(object):
+    """Keeps finished spans in memory, e.g. for tests."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def get_spans(self, name=None):
+        with self._lock:
+            return [span for span in self.spans if name is None or span.name == name]
+
+    def clear(self):
+        with self._lock:
+            del self.spans[:]
+
+
+class LoggingExporter(object):
+    """Logs finished spans at debug level."""
+
+    def export(self, span):
+        logger.debug("%s trace=%s span=%s parent=%s duration=%.6fs status=%s %s",
+                     span.name, span.trace_id, span.span_id, span.parent_id,
+                     span.duration, span.status, span.attributes)
+
+
+_exporter = None
+_exporter_path = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    """Returns the configured exporter, instantiated once per process, or None
+    if tracing is disabled."""
+    global _exporter, _exporter_path
+    path = settings.CANVAS_OAUTH_TRACING_EXPORTER
+    if path != _exporter_path:
+        with _exporter_lock:
+            if path != _exporter_path:
+                _exporter = import_string(path)() if path else None
+                _exporter_path = path
+    return _exporter
+
+
+def get_current_span():
+    return _current_span.get()
+
+
+def is_recording():
+    return _current_span.get() is not None
+
+
+def set_attribute(key, value):
+    """Sets an attribute on the current span, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.attributes[key] = value
+
+
+def get_traceparent():
+    """Returns the `traceparent` header value for the current span, if any."""
+    span = _current_span.get()
+    return span.traceparent if span is not None else None
+
+
+@contextmanager
+def span(name, attributes=None):
+    """Records the block as a span, a child of the current span.  Yields the
+    span, or None if tracing is disabled.
+    """
+    exporter = get_exporter()
+    if exporter is None:
+        yield None
+        return
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = 'error'
+        current.error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        current.end_time = time.time()
+        _current_span.reset(token)
+        try:
+            exporter.export(current)
+        except Exception:
+            logger.exception("Unable to export span %s", current.name)
+
+
+def traced(name):
+    """Decorates a function, or coroutine function, to run in a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if get_exporter() is None:
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if get_exporter() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+import sys
+
+import django
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the canvas_oauth micro-benchmarks.")
+    parser.add_argument('benchmarks', nargs='*', help="Only run benchmarks whose name contains one of these.")
+    parser.add_argument('--iterations', type=int, help="Override the number of timed iterations.")
+    parser.add_argument('--save', metavar='FILE', help="Save the results as a baseline.")
+    parser.add_argument('--compare', metavar='FILE', help="Compare the results against a saved baseline.")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="Percentage slowdown against the baseline treated as a regression.")
+    args = parser.parse_args()
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'canvas_oauth.tests.django_settings'
+    django.setup()
+    logging.disable(logging.CRITICAL)
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    from benchmarks import bench_oauth, harness
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    env = bench_oauth.Environment()
+    try:
+        results = harness.run(env, args.benchmarks, args.iterations)
+    finally:
+        env.close()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    baseline = harness.load(args.compare) if args.compare else None
+    print(harness.format_results(results, baseline))
+    if args.save:
+        harness.save(results, args.save)
+
+    if baseline:
+        regressions = harness.find_regressions(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        sys.exit(bool(regressions))
@@ -20,20 +20,23 @@ setup(
     description='A reusable Django app used to handle OAuth2 flow with Canvas.',
     long_description=README,
     license="License :: OSI Approved :: MIT License",
-    packages=find_packages(),
-    install_requires=['Django>=2.0', 'requests'],
+    packages=find_packages(exclude=['benchmarks']),
+    install_requires=['Django>=4.2', 'requests', 'cryptography', 'asgiref>=3.6'],
+    extras_require={
+        'async': ['httpx'],
+    },
     include_package_data=True,
     zip_safe=False,
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',
-        'Framework :: Django :: 2.0',
+        'Framework :: Django :: 4.2',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],